@@ -1,18 +1,48 @@
 import multiprocess
+import multiprocess.pool
 import atexit
+import os
 from functools import wraps
 
 _common_pool = None
-def setup():
+_pool_config = (None, None) #(processes, initializer) for the pool made the first time a task is submitted
+def setup(processes=None, initializer=None):
+    """Sets up the shared worker pool (one process per core unless processes is given), replacing any existing pool.
+    initializer (optional) is called once in each worker process when it starts, e.g. to warm caches.
+    The worker processes are only started when the first task is submitted, so searches that never use them don't pay for them."""
+    global _common_pool, _pool_config
+    _join_pool()
+    _common_pool = None
+    _pool_config = (processes, initializer)
+def set_executor(executor):
+    """Replaces the shared worker pool with another executor backend, e.g. Distributed.Coordinator for running tasks on other machines.
+    Any object with the multiprocess.Pool methods apply_async(func, args, callback=...) (returning an object with get()), close() and join() works."""
     global _common_pool
-    _common_pool = multiprocess.Pool()
+    _join_pool()
+    _common_pool = executor
+def _pool():
+    global _common_pool
+    if _common_pool is None:
+        processes, initializer = _pool_config
+        _common_pool = multiprocess.Pool(processes, initializer=initializer)
+    return _common_pool
 def _join_pool():
     if _common_pool is not None:
         _common_pool.close()
         _common_pool.join()
 atexit.register(_join_pool)
+def _forget_inherited_pool():
+    global _common_pool
+    if isinstance(_common_pool, multiprocess.pool.Pool): #its workers belong to the parent, so a forked process starts its own pool when it needs one
+        _common_pool = None
+os.register_at_fork(after_in_child=_forget_inherited_pool)
 
 import math
+import queue
+import time
+
+import Perf
+import Profiling
 
 class _BatchSentinel():
     pass
@@ -28,54 +58,140 @@ def batch(batch_size):
         return wrapper
     return wrap
 
-def batch_map(func, input_args: list, batch_size: int, with_task=None, with_batch=None) -> list:
-    """Batch runs a function in different processes using a ProcessPoolExecutor
+#Scheduling: tasks are sent to the pool as soon as there is room for them rather than a batch at a time, so a slow task (e.g. a
+#large structure for robocrys) only holds up its own worker. Tasks go in chunks - one at a time to start with, then as many as take
+#about TARGET_CHUNK_S by the measured task times, so cheap tasks aren't dominated by the cost of sending them - and the chunks get
+#smaller towards the end so the last tasks are still shared out between the workers. Given a predicted cost for each task, the most
+#expensive are started first (longest processing time first), so the run doesn't end waiting on one big task started late.
+#batch_size only sets how many results are handed to with_batch at a time (e.g. for checkpointing), not how the tasks are scheduled.
+TARGET_CHUNK_S = 0.2
+CHUNKS_PER_WORKER_AT_THE_END = 4
+CHUNKS_IN_FLIGHT_PER_WORKER = 2 #so each worker has its next chunk waiting when it finishes one
+
+def _timed_task(func, *args):
+    """Runs a task inside a worker process and returns its result along with the worker's wall and CPU time."""
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    result = func(*args)
+    return result, time.perf_counter()-wallStart, time.process_time()-cpuStart
+
+def _timed_chunk(func, tasks):
+    return [_timed_task(func, *task) for task in tasks]
+
+def _worker_count(executor):
+    processes = getattr(executor, "_processes", None) #multiprocess.Pool
+    if processes is not None:
+        return processes
+    if hasattr(executor, "workers"): #Distributed.Coordinator - workers can join while tasks are running
+        return max(len(executor.workers()), 1)
+    return os.cpu_count() or 1
+
+def _chunk_size(computeTimes, remaining, workers):
+    if len(computeTimes) == 0:
+        return 1
+    meanTime = sum(computeTimes)/len(computeTimes)
+    size = int(TARGET_CHUNK_S/meanTime) if meanTime > 0 else remaining
+    return max(1, min(size, math.ceil(remaining/(CHUNKS_PER_WORKER_AT_THE_END*workers))))
+
+def batch_map(func, input_args: list, batch_size: int, with_task=None, with_batch=None, stage_name=None, cost=None) -> list:
+    """Batch runs a function in different processes using the shared worker pool (see the notes on scheduling above)
 
     Args:
         func: The function to batch
         input_args: A 2d array where each element is the arguments to pass to the function for a given task
-        batch_size: The number of tasks to run before collecting
-        callback: (optional) A function taking one argument, returning None.
+        batch_size: The number of results handed to with_batch at a time
+        with_task: (optional) A function taking one argument, returning None.
             Called after the completion of each task
             Args:
                 result: The result of the task
         with_batch: (optional) A function taking one argument, returning None. 
-            Called after the completion of each batch. 
+            Called once every task of a batch (batch_size consecutive tasks, in the order they are started) has completed, batch by batch.
             Args:
                 batch_results: An array containing the results of the batch
+        stage_name: (optional) The name recorded for this call in the perf log (defaults to the name of func)
+        cost: (optional) The predicted cost of each task - a list, or a function taking a task's arguments (e.g. the number of sites of a
+            structure). Tasks are started most expensive first, and batches are made in that order.
         
     Returns:
-        The array of results
+        The array of results, in the order of input_args
     """
-    results = []
-
-    iterations = math.ceil(len(input_args) / batch_size)
-
-    for batch_idx in range(iterations):
-        slice_min = batch_idx*batch_size
-        slice_max = min((batch_idx+1)*batch_size, len(input_args))
+    tasks = [task if type(task) == list else [task] for task in input_args]
+    order = list(range(len(tasks))) #the order the tasks are started in
+    if cost is not None:
+        costs = [cost(*task) for task in tasks] if callable(cost) else list(cost)
+        order.sort(key=lambda i: costs[i], reverse=True)
+    batchOf = {taskIndex: position//batch_size for position, taskIndex in enumerate(order)}
+    iterations = math.ceil(len(tasks) / batch_size)
+    remainingInBatch = [min(batch_size, len(tasks)-batch_idx*batch_size) for batch_idx in range(iterations)]
+    taskResults = [None]*len(tasks)
 
-        sliced = input_args[slice_min:slice_max]
+    computeTimes = [] #wall time spent on each task inside the worker
+    cpuTimes = []
+    latencies = [] #time from submitting a task's chunk to its results arriving back in this process (compute + queueing + IPC)
+    chunkSizes = []
+    finishedChunks = queue.Queue() #filled by the pool's callbacks
 
-        futures = []
-        for task in sliced:
-            if type(task) != list:
-                task = [task]
-            future = _common_pool.apply_async(func, task, callback=with_task)
-            futures.append(future)
+    profileSpec = Profiling.worker_profile_spec() #only set while a filter chosen for profiling is running
+    if profileSpec is not None:
+        taskFunc = lambda *args: Profiling.profiled_task(profileSpec, func, *args)
+    else:
+        taskFunc = func
 
-        batch = []        
-        for future in futures:
-            result = future.get()
+    def batchResults(taskIndices):
+        batch = []
+        for taskIndex in taskIndices:
+            result = taskResults[taskIndex]
             if result is not None:
                 if result is not BATCH_NONE_RESULT:
                     batch.append(result)
                 else:
                     batch.append(None)
-        if with_batch is not None:
-            with_batch(batch)
+        return batch
 
-        results.extend(batch)
+    with Perf.stage(stage_name if stage_name is not None else getattr(func, "__name__", str(func)), "batch_map",
+                    rows_in=len(input_args), batch_size=batch_size, ordered_by_cost=cost is not None) as perfEntry:
+        nextTask = 0
+        inFlight = 0
+        nextBatch = 0
+        while nextBatch < iterations:
+            workers = _worker_count(_pool())
+            while nextTask < len(tasks) and inFlight < CHUNKS_IN_FLIGHT_PER_WORKER*workers:
+                chunk = order[nextTask:nextTask+_chunk_size(computeTimes, len(tasks)-nextTask, workers)]
+                nextTask += len(chunk)
+                submitTime = time.perf_counter()
+                _pool().apply_async(_timed_chunk, [taskFunc, [tasks[i] for i in chunk]],
+                                    callback=lambda timedResults, chunk=chunk, submitTime=submitTime: finishedChunks.put((chunk, submitTime, timedResults, None)),
+                                    error_callback=lambda error: finishedChunks.put((None, None, None, error)))
+                chunkSizes.append(len(chunk))
+                inFlight += 1
+
+            chunk, submitTime, timedResults, error = finishedChunks.get()
+            if error is not None:
+                raise error
+            inFlight -= 1
+            latency = time.perf_counter()-submitTime
+            for taskIndex, (result, computeTime, cpuTime) in zip(chunk, timedResults):
+                taskResults[taskIndex] = result
+                latencies.append(latency)
+                computeTimes.append(computeTime)
+                cpuTimes.append(cpuTime)
+                remainingInBatch[batchOf[taskIndex]] -= 1
+                if with_task is not None:
+                    with_task(result)
+            while nextBatch < iterations and remainingInBatch[nextBatch] == 0:
+                if with_batch is not None:
+                    with_batch(batchResults(order[nextBatch*batch_size:(nextBatch+1)*batch_size]))
+                nextBatch += 1
+
+        results = batchResults(range(len(tasks)))
+        perfEntry["rows_out"] = len(results)
+        perfEntry["batches"] = iterations
+        perfEntry["chunks"] = len(chunkSizes)
+        perfEntry["max_chunk_size"] = max(chunkSizes, default=0)
+        perfEntry["worker_cpu_s"] = round(sum(cpuTimes), 6)
+        perfEntry["task_compute"] = Perf.latency_summary(computeTimes)
+        perfEntry["task_latency"] = Perf.latency_summary(latencies)
+        perfEntry["peak_rss_children_mb"] = Perf.peak_rss_mb(children=True)
 
     return results
 
@@ -128,6 +244,22 @@ if __name__ == "__main__":
             self.assertListEqual(results, TASKS_RESULTS)
             self.assertListEqual(batches, BATCH_3_RESULTS)
 
+        def test_cost_order(self):
+            """
+                Most expensive tasks are started (and batched) first, results still come back in input order
+            """
+            batches = []
+            results = batch_map(lambda a, b: a * b, TASKS, 3, with_batch=lambda batch: batches.append(batch), cost=lambda a, b: a)
+
+            self.assertListEqual(results, TASKS_RESULTS)
+            self.assertListEqual(batches, list(chunk(TASKS_RESULTS[::-1], 3)))
+
+        def test_chunk_sizes(self):
+            self.assertEqual(_chunk_size([], 1000, 4), 1) #nothing measured yet
+            self.assertEqual(_chunk_size([2**-10]*8, 10000, 4), int(TARGET_CHUNK_S*2**10))
+            self.assertEqual(_chunk_size([2**-10]*8, 1000, 4), math.ceil(1000/(CHUNKS_PER_WORKER_AT_THE_END*4))) #the last tasks are shared out
+            self.assertEqual(_chunk_size([5.0], 1000, 4), 1)
+
         def test_decorator(self):
             @batch(2)
             def foo(value):
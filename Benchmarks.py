@@ -0,0 +1,363 @@
+"""
+Benchmark suite for the filters, stage I/O, batching and start-up time.
+
+Everything runs offline on synthetic datasets shaped like GNoME and Materials Project records, so no database download
+or API key is needed. Usage:
+
+    python Benchmarks.py                                  #all sizes (10k, 100k, 1M rows), compare against benchmark_baselines.json
+    python Benchmarks.py --sizes 10k --filters Inorganic BinaryComp
+    python Benchmarks.py --sizes 10k 100k --save-baseline #store these timings as the new baseline
+    python Benchmarks.py --skip filters io batching       #start-up time only, with the import time of each package
+
+Results for every run are written to benchmark_results.json. When a baseline file exists, each benchmark is compared
+against it and anything slower than the baseline by more than --threshold is reported as a regression (and the
+script exits with status 1). Baselines are machine specific, so generate them on the machine you compare on.
+
+Note that the per-row Python filters get slow at 1M rows (tens of minutes for the formula filters) - use --filters
+and --sizes to pick what you need.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+from pymatgen.core.composition import Composition
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+
+import Batching
+import Compositions
+from Filters import Analysis
+from Util import SaveDictAsJSON, ReadJSONFile, BlockPrint, EnablePrint
+from StructureEncoding import encode_structure
+from StageIO import STAGE_FORMATS, INDEX_SUFFIX, SaveStage, ReadStage, zstandard
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1M": 1_000_000}
+BATCH_SIZES = [1, 10, 100]
+WORKER_COUNTS = [1, 2, 4]
+
+#Filters that need structures (CIF files or "structure" entries) are benchmarked on a small structure-bearing subset rather than the full dataset
+STRUCTURE_FILTERS = ["Dimensionality", "PutStructuresIntoDB", "GetCondensedStructures", "GetStructures"]
+
+#Rough element abundance in GNoME/MP - common anions and cations are picked more often, so filter selectivity is realistic
+ELEMENT_WEIGHTS = {"O": 30, "Li": 8, "Na": 6, "K": 4, "Mg": 6, "Ca": 5, "Sr": 3, "Ba": 4, "Al": 5, "Si": 6, "P": 5, "S": 6,
+                   "F": 5, "Cl": 4, "Br": 2, "I": 2, "N": 5, "C": 4, "H": 4, "B": 3, "Se": 3, "Te": 2, "Ti": 4, "V": 4,
+                   "Cr": 3, "Mn": 5, "Fe": 6, "Co": 5, "Ni": 5, "Cu": 5, "Zn": 4, "Zr": 3, "Nb": 3, "Mo": 3, "W": 3,
+                   "Ag": 2, "Sn": 3, "Sb": 2, "Bi": 3, "La": 3, "Ce": 2, "Nd": 2, "Eu": 1, "Y": 2, "U": 1, "Th": 1,
+                   "Pb": 2, "Ga": 2, "Ge": 2, "In": 2, "Cs": 2, "Rb": 2, "Pd": 1, "Pt": 1, "Au": 1, "Hf": 1, "Ta": 1}
+NELEMENTS_WEIGHTS = {1: 2, 2: 20, 3: 40, 4: 28, 5: 10}
+CRYSTAL_SYSTEMS = ["triclinic", "monoclinic", "orthorhombic", "tetragonal", "trigonal", "hexagonal", "cubic"]
+
+
+def _formula(elements, amounts):
+    divisor = math.gcd(*amounts)
+    return "".join(f"{elem}{amount//divisor if amount//divisor != 1 else ''}" for elem, amount in zip(elements, amounts))
+
+def SyntheticRecords(numOfRows, shape="gnome", seed=0):
+    """
+    Generates numOfRows records with random (but reproducible) compositions.
+
+    shape="gnome" gives the column names MaterialSearch_GNOME produces after renaming (MaterialId, pretty_formula, elements, nelements, ...),
+    shape="mp" gives the properties of a default Materials Project query (material_id, pretty_formula, spacegroup.number, nsites, nelements).
+    """
+    rng = random.Random(seed)
+    elementPool = list(ELEMENT_WEIGHTS.keys())
+    elementWeights = list(ELEMENT_WEIGHTS.values())
+    nelemPool = list(NELEMENTS_WEIGHTS.keys())
+    nelemWeights = list(NELEMENTS_WEIGHTS.values())
+    records = []
+    for i in range(numOfRows):
+        nelements = rng.choices(nelemPool, nelemWeights)[0]
+        elements = []
+        while(len(elements) < nelements):
+            elem = rng.choices(elementPool, elementWeights)[0]
+            if(elem not in elements):
+                elements.append(elem)
+        amounts = [rng.randint(1, 8) for _ in elements]
+        formula = _formula(elements, amounts)
+        nsites = sum(amounts)
+        spacegroup = rng.randint(1, 230)
+        if(shape == "gnome"):
+            records.append({"MaterialId": f"{i:010x}",
+                            "full_formula": formula,
+                            "pretty_formula": formula,
+                            "elements": sorted(elements),
+                            "nelements": nelements,
+                            "nsites": nsites,
+                            "volume": round(nsites*rng.uniform(10, 25), 3),
+                            "density": round(rng.uniform(1, 12), 3),
+                            "spacegroup.number": spacegroup,
+                            "spacegroup.crystal_system": rng.choice(CRYSTAL_SYSTEMS),
+                            "Decomposition Energy Per Atom": round(rng.uniform(-0.2, 0), 4)})
+        else:
+            records.append({"material_id": f"mp-{i+1}",
+                            "pretty_formula": formula,
+                            "spacegroup.number": spacegroup,
+                            "nsites": nsites,
+                            "nelements": nelements})
+    return records
+
+def SyntheticStructure(formula, seed=0):
+    """A small structure for the given (reduced) formula: atoms on a jittered grid in a roughly cubic cell, ~15 A^3 per atom."""
+    rng = np.random.default_rng(seed)
+    species = []
+    for elem, amount in Composition(formula).get_el_amt_dict().items():
+        species += [elem]*int(amount)
+    numOfSites = len(species)
+    gridSize = math.ceil(numOfSites**(1/3))
+    gridPoints = np.array([(i, j, k) for i in range(gridSize) for j in range(gridSize) for k in range(gridSize)], dtype=float)
+    gridPoints = gridPoints[rng.permutation(len(gridPoints))[:numOfSites]]
+    fracCoords = (gridPoints + 0.5 + rng.uniform(-0.1, 0.1, gridPoints.shape))/gridSize
+    length = (15*numOfSites)**(1/3)
+    lattice = Lattice.from_parameters(length*rng.uniform(0.9, 1.1), length*rng.uniform(0.9, 1.1), length*rng.uniform(0.9, 1.1), 90, 90, 90)
+    return Structure(lattice, species, fracCoords)
+
+def AddStructures(records, numWithStructures, homeDir=None):
+    """
+    Gives the first numWithStructures records a structure (stored in its compact encoding, as in a stage file) and returns that subset.
+    If homeDir is given, the structures are also written as by_id/{MaterialId}.CIF files, which is where the GNoME filters look for them.
+    """
+    subset = [dict(record) for record in records[:numWithStructures]]
+    if(homeDir is not None):
+        os.makedirs(os.path.join(homeDir, "by_id"), exist_ok=True)
+    for i, record in enumerate(subset):
+        struct = SyntheticStructure(record["pretty_formula"], seed=i)
+        if(homeDir is not None):
+            struct.to(filename=os.path.join(homeDir, "by_id", f"{record['MaterialId']}.CIF"), fmt="cif")
+        record["structure"] = encode_structure(struct)
+    return subset
+
+
+def _time(func, repeat=1):
+    """Best-of-repeat wall time of func(), along with the value returned by the last call."""
+    best = math.inf
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        best = min(best, time.perf_counter()-start)
+    return best, value
+
+def _record(benchmarks, name, seconds, rows, **extra):
+    benchmarks[name] = {"seconds": round(seconds, 6), "rows": rows, "rows_per_s": round(rows/seconds, 2) if seconds > 0 else None, **extra}
+    print(f"  {name:<55} {seconds:>10.4f} s  {rows:>9} rows" + (f"  {extra}" if extra else ""))
+
+
+def BenchmarkFilters(benchmarks, sizeName, records, structureRecords, workDir, filterNames, repeat):
+    analysis = Analysis("benchmark", [], workDir, "gnome", stageCache=False)
+    registry = analysis.FilterRegistry()
+    for filterName in filterNames:
+        rowsIn = structureRecords if filterName in STRUCTURE_FILTERS else records
+        #the instance-bound filters use these to name their batch/structure directories
+        analysis.previousFilter, analysis.previousFilterCounter = "Database", 0
+        analysis.currentFilter, analysis.currentFilterCounter = filterName, 1
+        stageDir = tempfile.mkdtemp(prefix=f"{filterName}_", dir=workDir)
+        os.chdir(stageDir)
+        try:
+            BlockPrint()
+            seconds, output = _time(lambda: registry[filterName]([dict(record) for record in rowsIn]), repeat)
+            EnablePrint()
+            sys.stderr = sys.__stderr__
+            _record(benchmarks, f"filter/{filterName}/{sizeName}", seconds, len(rowsIn), rows_out=len(output))
+        except Exception as e:
+            EnablePrint()
+            sys.stderr = sys.__stderr__
+            print(f"  filter/{filterName}/{sizeName}: failed ({type(e).__name__}: {e})")
+            benchmarks[f"filter/{filterName}/{sizeName}"] = {"error": f"{type(e).__name__}: {e}"}
+        finally:
+            os.chdir(workDir)
+            shutil.rmtree(stageDir, ignore_errors=True)
+
+def BenchmarkStageIO(benchmarks, sizeName, records, structureRecords, workDir, repeat):
+    os.chdir(workDir)
+    fileName = f"stage_{sizeName}"
+    seconds, _ = _time(lambda: SaveDictAsJSON(fileName, records), repeat)
+    _record(benchmarks, f"io/SaveDictAsJSON/{sizeName}", seconds, len(records), bytes=os.path.getsize(f"{fileName}.json"))
+    seconds, _ = _time(lambda: ReadJSONFile(fileName), repeat)
+    _record(benchmarks, f"io/ReadJSONFile/{sizeName}", seconds, len(records), bytes=os.path.getsize(f"{fileName}.json"))
+    os.remove(f"{fileName}.json")
+    for stageFormat in STAGE_FORMATS:
+        if(stageFormat == "json" or (stageFormat == "jsonl.zst" and zstandard is None)):
+            continue
+        seconds, path = _time(lambda: SaveStage(fileName, records, stageFormat), repeat)
+        _record(benchmarks, f"io/SaveStage/{stageFormat}/{sizeName}", seconds, len(records), bytes=os.path.getsize(path))
+        seconds, _ = _time(lambda: ReadStage(fileName), repeat)
+        _record(benchmarks, f"io/ReadStage/{stageFormat}/{sizeName}", seconds, len(records), bytes=os.path.getsize(path))
+        os.remove(path)
+        os.remove(path + INDEX_SUFFIX)
+
+    BlockPrint()
+    loadSeconds, loaded = _time(lambda: Analysis._loadStructures(structureRecords), repeat)
+    storeSeconds, _ = _time(lambda: Analysis._storeStructures(loaded), repeat)
+    EnablePrint()
+    sys.stderr = sys.__stderr__
+    _record(benchmarks, f"io/_loadStructures/{sizeName}", loadSeconds, len(structureRecords))
+    _record(benchmarks, f"io/_storeStructures/{sizeName}", storeSeconds, len(structureRecords))
+
+
+def _batchTask(formula):
+    #a cheap but not trivial task, roughly the cost of a formula filter
+    return len(formula)*sum(ord(c) for c in formula)
+
+def BenchmarkBatching(benchmarks, sizeName, records, workerCounts, batchSizes, repeat, maxTasks):
+    tasks = [record["pretty_formula"] for record in records[:maxTasks]]
+    for workers in workerCounts:
+        Batching.setup(workers, initializer=Compositions.warm)
+        for batchSize in batchSizes:
+            seconds, _ = _time(lambda: Batching.batch_map(_batchTask, tasks, batchSize), repeat)
+            _record(benchmarks, f"batch_map/workers={workers}/batch_size={batchSize}/{sizeName}", seconds, len(tasks))
+
+
+#Cold start: a fresh interpreter importing MaterialSearchCore, and then running the cheap GNoME filters (which is all a quick search or a
+#resumed one needs). Heavy dependencies (robocrys, pymatgen's graph/local_env/matproj modules, smact) are only imported by the filters
+#and database paths that use them, and the worker pool is only started by the first batch_map call, so neither path should load them.
+COLD_START_TARGET_S = 2.0
+STARTUP_PATHS = {
+    "import": "import MaterialSearchCore",
+    "gnome_cheap_filters": "\n".join([
+        "import tempfile",
+        "import MaterialSearchCore",
+        "from Filters import Analysis",
+        "results = [{'MaterialId': str(i), 'pretty_formula': formula, 'elements': elements, 'nelements': len(elements)} for i, (formula, elements) in",
+        "           enumerate([('NaCl', ['Na', 'Cl']), ('Fe2O3', ['Fe', 'O']), ('CH4', ['C', 'H']), ('UO2', ['U', 'O']), ('MoS2', ['Mo', 'S'])]*20)]",
+        "filters = Analysis('startup', [], tempfile.gettempdir(), 'gnome', stageCache=False).FilterRegistry()",
+        "for name in ['Inorganic', 'AntiActinide', 'ContainsMetal', 'BinaryComp', 'ContainsOxygen']:",
+        "    results = filters[name](results)",
+    ]),
+}
+
+def ImportTimesBySubsystem(importtimeOutput):
+    """
+    Seconds spent importing each top-level package (numpy, pymatgen, Filters, ...), from the output of python -X importtime.
+    Self times are added up, so nothing is counted twice.
+    """
+    subsystems = {}
+    for line in importtimeOutput.splitlines():
+        if(not line.startswith("import time:") or "self [us]" in line):
+            continue
+        selfTime, _, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        subsystem = name.split(".")[0]
+        subsystems[subsystem] = subsystems.get(subsystem, 0) + int(selfTime)/1e6
+    return dict(sorted(subsystems.items(), key=lambda item: item[1], reverse=True))
+
+def BenchmarkStartup(benchmarks, repeat, top=8):
+    repositoryDir = os.path.dirname(os.path.abspath(__file__))
+    for pathName, script in STARTUP_PATHS.items():
+        def run():
+            return subprocess.run([sys.executable, "-X", "importtime", "-c", script], cwd=repositoryDir, capture_output=True, text=True, check=True).stderr
+        seconds, importtimeOutput = _time(run, repeat)
+        subsystems = ImportTimesBySubsystem(importtimeOutput)
+        _record(benchmarks, f"startup/{pathName}", seconds, 1, imports_s=round(sum(subsystems.values()), 3),
+                subsystems={name: round(value, 3) for name, value in list(subsystems.items())[:top]})
+        for name, value in list(subsystems.items())[:top]:
+            print(f"      {name:<30} {value:>8.3f} s")
+    if(benchmarks["startup/gnome_cheap_filters"]["seconds"] > COLD_START_TARGET_S):
+        print(f"  Cold start of the cheap GNoME filter path is over its {COLD_START_TARGET_S} s target.")
+
+
+def CompareToBaseline(benchmarks, baseline, threshold):
+    """Returns a list of (name, baseline seconds, current seconds, ratio) for every benchmark that got slower than threshold allows."""
+    regressions = []
+    for name, result in benchmarks.items():
+        if(name not in baseline or "seconds" not in result or "seconds" not in baseline[name]):
+            continue
+        ratio = result["seconds"]/max(baseline[name]["seconds"], 1e-9)
+        if(ratio > threshold):
+            regressions.append((name, baseline[name]["seconds"], result["seconds"], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for MaterialsSearching filters, stage I/O and batching.")
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES.keys()), choices=list(SIZES.keys()))
+    parser.add_argument("--filters", nargs="+", default=None, help="Filter names to benchmark (default: every registered filter)")
+    parser.add_argument("--structures", type=int, default=20, help="Number of records given structures for the structure filters and structure I/O")
+    parser.add_argument("--workers", nargs="+", type=int, default=WORKER_COUNTS)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=BATCH_SIZES)
+    parser.add_argument("--batch-tasks", type=int, default=10_000, help="Maximum number of tasks given to batch_map")
+    parser.add_argument("--repeat", type=int, default=1, help="Best-of-N timings")
+    parser.add_argument("--skip", nargs="+", default=[], choices=["filters", "io", "batching", "startup"])
+    parser.add_argument("--baseline", default="benchmark_baselines.json")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the baseline instead of comparing against it")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Slowdown ratio above which a benchmark counts as a regression")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args(argv)
+
+    startDir = os.getcwd()
+    baselinePath = os.path.abspath(args.baseline)
+    outputPath = os.path.abspath(args.output)
+    workDir = tempfile.mkdtemp(prefix="MaterialsSearching_bench_")
+    benchmarks = {}
+    Batching.setup(initializer=Compositions.warm)
+    try:
+        if("startup" not in args.skip):
+            print("Startup:")
+            BenchmarkStartup(benchmarks, args.repeat)
+        sizes = args.sizes if not {"filters", "io", "batching"} <= set(args.skip) else [] #no datasets needed for the start-up benchmarks
+        for sizeName in sizes:
+            print(f"\nGenerating synthetic datasets ({sizeName} rows).")
+            records = SyntheticRecords(SIZES[sizeName], "gnome")
+            structureRecords = AddStructures(records, args.structures, homeDir=workDir)
+            filterNames = args.filters if args.filters is not None else list(Analysis("benchmark", [], workDir, "gnome", stageCache=False).FilterRegistry().keys())
+            if("filters" not in args.skip):
+                print("Filters:")
+                BenchmarkFilters(benchmarks, sizeName, records, structureRecords, workDir, filterNames, args.repeat)
+            if("io" not in args.skip):
+                print("Stage I/O:")
+                BenchmarkStageIO(benchmarks, sizeName, records, structureRecords, workDir, args.repeat)
+                mpRecords = SyntheticRecords(SIZES[sizeName], "mp", seed=1)
+                os.chdir(workDir)
+                seconds, _ = _time(lambda: SaveDictAsJSON("mp_stage", mpRecords), args.repeat)
+                _record(benchmarks, f"io/SaveDictAsJSON/mp/{sizeName}", seconds, len(mpRecords))
+                seconds, _ = _time(lambda: ReadJSONFile("mp_stage"), args.repeat)
+                _record(benchmarks, f"io/ReadJSONFile/mp/{sizeName}", seconds, len(mpRecords))
+            if("batching" not in args.skip):
+                print("Batching:")
+                BenchmarkBatching(benchmarks, sizeName, records, args.workers, args.batch_sizes, args.repeat, args.batch_tasks)
+    finally:
+        os.chdir(startDir)
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    run = {"date": datetime.now().isoformat(timespec="seconds"), "machine": platform.node(), "python": platform.python_version(),
+           "cpus": os.cpu_count(), "benchmarks": benchmarks}
+    with open(outputPath, "w") as f:
+        json.dump(run, f, indent=4)
+    print(f"\nResults written to {outputPath}")
+
+    if(args.save_baseline):
+        baseline = {}
+        if(os.path.isfile(baselinePath)):
+            with open(baselinePath, "r") as f:
+                baseline = json.load(f)["benchmarks"]
+        baseline.update(benchmarks) #keeps baselines for benchmarks that weren't part of this run
+        with open(baselinePath, "w") as f:
+            json.dump({**run, "benchmarks": baseline}, f, indent=4)
+        print(f"Baseline saved to {baselinePath}")
+        return 0
+
+    if(not os.path.isfile(baselinePath)):
+        print(f"No baseline found at {baselinePath} - run with --save-baseline to create one.")
+        return 0
+    with open(baselinePath, "r") as f:
+        baseline = json.load(f)["benchmarks"]
+    regressions = CompareToBaseline(benchmarks, baseline, args.threshold)
+    if(len(regressions) == 0):
+        print(f"No regressions against {baselinePath} (threshold {args.threshold}x).")
+        return 0
+    print(f"\n{len(regressions)} regression(s) against {baselinePath} (threshold {args.threshold}x):")
+    for name, baselineSeconds, seconds, ratio in sorted(regressions, key=lambda regression: -regression[3]):
+        print(f"  {name:<55} {baselineSeconds:>10.4f} s -> {seconds:>10.4f} s  ({ratio:.2f}x)")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
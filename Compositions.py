@@ -0,0 +1,363 @@
+from functools import lru_cache
+
+import numpy as np
+from scipy import sparse
+from pymatgen.core.composition import Composition
+from pymatgen.core.periodic_table import Element
+
+from ResultSet import ResultSet
+
+#A material x element matrix of amounts, for filters that only need to know which elements a formula has and how much of each.
+#
+#Formulas are parsed once per process: every distinct formula gets a row in a process-wide sparse matrix, and a stage's
+#results are mapped onto those rows by their pretty_formula. Later stages of a search (which only ever contain formulas
+#seen in earlier stages) therefore never parse a formula again, and the filters become NumPy operations over the rows
+#instead of Python loops over dictionaries.
+#The matrix is kept as CSR arrays with spare capacity, so adding rows doesn't copy the rows already there, and it is bounded
+#like the caches below: once it would hold more than COMPOSITION_CACHE_SIZE formulas it is emptied and started again.
+#Columns are indexed by atomic number - 1, so column i is the element with Z = i+1.
+
+NUMBER_OF_ELEMENTS = 118
+COMPOSITION_CACHE_SIZE = 2**18 #distinct formulas kept parsed at once - a few hundred MB at most, and more than MP has formulas
+
+ELEMENT_SET_MODES = ("ContainsAny", "ContainsAll", "ContainsOnly", "ExcludeAny", "ExcludeAll", "ExcludeOnly")
+
+_formulaRows = {} #formula -> row of the matrix
+_indptr = np.zeros(1, dtype=np.int64) #CSR arrays of the matrix, with spare capacity after the rows in use
+_indices = np.zeros(0, dtype=np.int64)
+_data = np.zeros(0)
+
+
+#Shared, bounded caches of parsed formulas and element lookups.
+#Every formula filter used to build a new Composition (and often 118 Element objects) for every material it looked at, so the
+#same formula was parsed once per filter per stage. These caches live for the whole process - i.e. for a whole MaterialSearch
+#run, and for the lifetime of each Batching worker, which warms them when it starts (see warm()).
+#Cached objects are shared between callers, so treat them as read-only.
+
+@lru_cache(maxsize=COMPOSITION_CACHE_SIZE)
+def get_composition(formula) -> Composition:
+    """The pymatgen Composition for a formula string, parsed only once per process."""
+    return Composition(formula)
+
+@lru_cache(maxsize=COMPOSITION_CACHE_SIZE)
+def formula_elements(formula) -> frozenset:
+    """The set of element symbols in a formula string."""
+    return frozenset(get_composition(formula).as_dict().keys())
+
+@lru_cache(maxsize=COMPOSITION_CACHE_SIZE)
+def oxidation_state_guess(formula) -> Composition:
+    """Composition(formula).add_charges_from_oxi_state_guesses(), which is one of the slowest calls in pymatgen, computed once per formula."""
+    return get_composition(formula).add_charges_from_oxi_state_guesses()
+
+@lru_cache(maxsize=None) #at most one entry per element
+def get_element(symbol) -> Element:
+    return Element(symbol)
+
+#named element groups used by the filters, each one a property of pymatgen's Element. They can also be used in place of an
+#element symbol in parameterized filters, e.g. ("ContainsAny", ["transition_metal", "F"])
+ELEMENT_GROUPS = {"metal": "is_metal",
+                  "transition_metal": "is_transition_metal",
+                  "lanthanoid": "is_lanthanoid",
+                  "actinoid": "is_actinoid",
+                  "halogen": "is_halogen"}
+
+@lru_cache(maxsize=None)
+def element_group(group) -> frozenset:
+    """Symbols of every element in a named group from ELEMENT_GROUPS, e.g. element_group("metal")."""
+    return frozenset(elements_where(lambda elem: getattr(elem, ELEMENT_GROUPS[group])))
+
+def warm():
+    """Fills the element caches. Used as the Batching pool initializer so worker processes start with warm caches."""
+    for z in range(1, NUMBER_OF_ELEMENTS+1):
+        get_element(Element.from_Z(z).symbol)
+    for group in ELEMENT_GROUPS:
+        element_group(group)
+
+def cache_stats():
+    """Hit/miss counts of the process-wide caches, for the perf log."""
+    stats = {}
+    for name, cachedFunction in [("composition", get_composition), ("formula_elements", formula_elements),
+                                 ("oxidation_state_guess", oxidation_state_guess), ("element", get_element)]:
+        info = cachedFunction.cache_info()
+        stats[name] = {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+    stats["composition_matrix_rows"] = len(_formulaRows)
+    return stats
+
+
+def element_column(symbol):
+    return get_element(symbol).Z - 1
+
+def element_columns(symbols):
+    return np.array([element_column(symbol) for symbol in symbols], dtype=np.int64)
+
+def element_symbol(column):
+    return Element.from_Z(int(column)+1).symbol
+
+
+def _parse(formula):
+    amounts = get_composition(formula).get_el_amt_dict()
+    columns = np.array([element_column(symbol) for symbol in amounts.keys()], dtype=np.int64)
+    order = np.argsort(columns)
+    return columns[order], np.array(list(amounts.values()), dtype=float)[order]
+
+def _clear():
+    global _formulaRows, _indptr, _indices, _data
+    _formulaRows = {}
+    _indptr = np.zeros(1, dtype=np.int64)
+    _indices = np.zeros(0, dtype=np.int64)
+    _data = np.zeros(0)
+
+def _withCapacity(array, size):
+    """array, or a copy of it with room for at least size entries (doubling, so rows are only copied O(log n) times)."""
+    if(len(array) >= size):
+        return array
+    grown = np.zeros(max(size, 2*len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+def _append(parsedRows):
+    """Appends rows of (columns, amounts) to the matrix."""
+    global _indptr, _indices, _data
+    numOfRows, numOfEntries = len(_formulaRows)-len(parsedRows), _indptr[len(_formulaRows)-len(parsedRows)]
+    lengths = np.array([len(columns) for columns, _ in parsedRows], dtype=np.int64)
+    _indptr = _withCapacity(_indptr, numOfRows+len(parsedRows)+1)
+    _indptr[numOfRows+1:numOfRows+len(parsedRows)+1] = numOfEntries + np.cumsum(lengths)
+    _indices = _withCapacity(_indices, numOfEntries+lengths.sum())
+    _data = _withCapacity(_data, numOfEntries+lengths.sum())
+    if(len(parsedRows) != 0):
+        _indices[numOfEntries:numOfEntries+lengths.sum()] = np.concatenate([columns for columns, _ in parsedRows])
+        _data[numOfEntries:numOfEntries+lengths.sum()] = np.concatenate([amounts for _, amounts in parsedRows])
+
+def _matrix():
+    """The process-wide matrix (a view of its arrays - only valid until rows are next added)."""
+    numOfRows = len(_formulaRows)
+    numOfEntries = _indptr[numOfRows]
+    return sparse.csr_matrix((_data[:numOfEntries], _indices[:numOfEntries], _indptr[:numOfRows+1]), shape=(numOfRows, NUMBER_OF_ELEMENTS), copy=False)
+
+def rows_for(formulas):
+    """Row numbers in the process-wide matrix for the given formulas, parsing any formula that hasn't been seen before."""
+    newFormulas = [formula for formula in dict.fromkeys(formulas) if formula not in _formulaRows]
+    if(len(_formulaRows)+len(newFormulas) > COMPOSITION_CACHE_SIZE and len(_formulaRows) != 0):
+        _clear() #every formula of this call still gets a row, even if there are more than COMPOSITION_CACHE_SIZE of them
+        newFormulas = list(dict.fromkeys(formulas))
+    for formula in newFormulas:
+        _formulaRows[formula] = len(_formulaRows)
+    _append([_parse(formula) for formula in newFormulas])
+    return np.array([_formulaRows[formula] for formula in formulas], dtype=np.int64)
+
+
+class CompositionMatrix():
+    """
+    Sparse (material x element) matrix of element amounts for a list of results, in the order of the results.
+
+    Usage:
+        comps = CompositionMatrix.from_results(results)
+        keep = comps.nelements() == 2
+        filteredResults = comps.select(results, keep)
+    """
+    def __init__(self, formulas):
+        rows = rows_for(formulas) #may add rows to the matrix, so this has to happen before it is looked up
+        self.matrix = _matrix()[rows] #a copy, so it stays valid however the process-wide matrix changes
+
+    @classmethod
+    def from_results(cls, results, formulaKey="pretty_formula"):
+        if(isinstance(results, ResultSet)): #categorical formulas - each distinct formula is only looked up once
+            formulas, codes = results.categorical(formulaKey)
+            comps = cls(list(formulas))
+            comps.matrix = comps.matrix[codes]
+            return comps
+        return cls([result[formulaKey] for result in results])
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def nelements(self):
+        """Number of distinct elements in each material."""
+        return np.diff(self.matrix.indptr)
+
+    def _reduce_rows(self, ufunc, empty):
+        #rows with no elements would break reduceat, so only reduce over the non-empty ones
+        out = np.full(len(self), empty, dtype=float)
+        nonEmpty = self.nelements() > 0
+        if(nonEmpty.any()):
+            out[nonEmpty] = ufunc.reduceat(self.matrix.data, self.matrix.indptr[:-1][nonEmpty])
+        return out
+
+    def max_amount(self):
+        """Largest element amount in each material's formula."""
+        return self._reduce_rows(np.maximum, 0.0)
+
+    def min_amount(self):
+        """Smallest element amount in each material's formula."""
+        return self._reduce_rows(np.minimum, 0.0)
+
+    def amounts(self, symbols):
+        """Dense (materials x len(symbols)) array of the amounts of the given elements (0 where absent)."""
+        return self.matrix[:, element_columns(symbols)].toarray()
+
+    def contains(self, symbols):
+        """Dense boolean (materials x len(symbols)) array, True where a material contains that element."""
+        return self.amounts(symbols) > 0
+
+    def element_set_mask(self, elements, mode):
+        """
+        Boolean mask of the materials that pass an element-set test - the engine behind the parameterized element filters.
+
+        elements is a list of element symbols and/or group names from ELEMENT_GROUPS (a group counts as present if any of its
+        elements is). mode is one of ELEMENT_SET_MODES:
+            ContainsAny/ExcludeAny   - materials with at least one of the elements (or without any of them)
+            ContainsAll/ExcludeAll   - materials with every one of the elements (or without all of them together, e.g. ["C", "H"])
+            ContainsOnly/ExcludeOnly - materials made only of the elements (or with at least one other element, e.g. ["metal"])
+        """
+        if(mode not in ELEMENT_SET_MODES):
+            raise ValueError(f"Element set mode {mode} is not recognised. Options are: {', '.join(ELEMENT_SET_MODES)}")
+        if(len(elements) == 0):
+            raise ValueError(f"{mode} needs at least one element or element group.")
+        terms = [sorted(element_group(element)) if element in ELEMENT_GROUPS else [element] for element in elements]
+        symbols = sorted(set().union(*terms))
+        present = self.contains(symbols)
+        if(mode.endswith("Only")):
+            match = present.sum(axis=1) == self.nelements()
+        else:
+            symbolColumns = {symbol: i for i, symbol in enumerate(symbols)}
+            termPresent = np.column_stack([present[:, [symbolColumns[symbol] for symbol in term]].any(axis=1) for term in terms])
+            match = termPresent.any(axis=1) if mode.endswith("Any") else termPresent.all(axis=1)
+        return match if mode.startswith("Contains") else ~match
+
+    @staticmethod
+    def select(results, mask):
+        """The results for which mask is True, in their original order."""
+        if(isinstance(results, ResultSet)):
+            return results.select(mask)
+        return [results[i] for i in np.flatnonzero(mask)]
+
+
+def elements_where(predicate):
+    """Symbols of every element for which predicate(Element) is True, e.g. elements_where(lambda elem: elem.is_transition_metal)."""
+    symbols = [Element.from_Z(z).symbol for z in range(1, NUMBER_OF_ELEMENTS+1)]
+    return [symbol for symbol in symbols if predicate(get_element(symbol))]
+
+
+if __name__ == "__main__":
+    import unittest
+
+    #one element, several transition metals and X elements, fractional amounts, and the usual binaries/ternaries
+    FORMULAS = ["Fe", "C", "NaCl", "CH4", "H2O", "UO2", "LaNiO3", "CuNi", "Cs2AgBiBr6", "KFe2(CN)6", "Ti2C", "Ti3C2", "Mo3N2", "Nb4C3", "V5N4",
+                "TiC", "Ti2CN", "Ti2NbC", "Ti2NbC2", "Mo2TiC2", "Fe0.5Ni0.5", "Li0.5CoO2", "Ti2C0.5", "Ca7O", "Ca8O", "SiO2", "ZrSiO4", "ThO2", "CeO2"]
+
+    #the per-formula logic the composition matrix replaced, written as the original filters wrote it
+    def oldElements(formula):
+        return set(Composition(formula).as_dict().keys())
+
+    def oldGroup(group):
+        return {Element.from_Z(z).symbol for z in range(1, NUMBER_OF_ELEMENTS+1) if getattr(Element.from_Z(z), ELEMENT_GROUPS[group])}
+
+    def oldElementSet(formula, elements, mode):
+        elems = oldElements(formula)
+        terms = [oldGroup(element) if element in ELEMENT_GROUPS else {element} for element in elements]
+        if(mode.endswith("Only")):
+            match = elems <= set().union(*terms)
+        elif(mode.endswith("Any")):
+            match = any(elems & term for term in terms)
+        else:
+            match = all(elems & term for term in terms)
+        return match if mode.startswith("Contains") else not match
+
+    def oldMXeneRatio(formula): #_checkMXeneRatios, which raised for materials without a transition metal or C/N
+        elemsInFormula = list(Composition(formula).as_dict().keys())
+        M = [elem for elem in elemsInFormula if Element(elem).is_transition_metal]
+        CorN = [elem for elem in elemsInFormula if elem=="C" or elem=="N"]
+        if(len(M) == 0 or len(CorN) == 0):
+            return False
+        elemsAndAmounts = Composition(formula).get_el_amt_dict()
+        return (elemsAndAmounts[M.pop()], elemsAndAmounts[CorN.pop()]) in {(2, 1), (3, 2), (4, 3), (5, 4)}
+
+    class CompositionMatrixTest(unittest.TestCase):
+        def setUp(self):
+            self.comps = CompositionMatrix(FORMULAS)
+
+        def assertMaskEqual(self, mask, expected, message=None):
+            self.assertEqual([formula for formula, keep in zip(FORMULAS, mask) if keep], [formula for formula, keep in zip(FORMULAS, expected) if keep], message)
+
+        def test_original_element_filters(self):
+            halogens, CorN = {"F", "Cl", "Br", "I", "At"}, {"C", "N"}
+            original = {("ContainsAny", ("halogen",)): lambda formula: bool(oldElements(formula) & halogens),                  #_containsHalogen
+                        ("ContainsAny", ("metal",)): lambda formula: bool(oldElements(formula) & oldGroup("metal")),           #_containsMetal
+                        ("ContainsAny", ("lanthanoid", "actinoid")): lambda formula: bool(oldElements(formula) & (oldGroup("lanthanoid") | oldGroup("actinoid"))), #_containsFBlock
+                        ("ExcludeAny", ("actinoid",)): lambda formula: not oldElements(formula) & oldGroup("actinoid"),        #AntiActinide
+                        ("ExcludeAll", ("C", "H")): lambda formula: not ("C" in oldElements(formula) and "H" in oldElements(formula)), #_checkInorganic
+                        ("ExcludeOnly", ("metal",)): lambda formula: not all(elem.is_metal for elem in Composition(formula).elements), #_noIntermetallics
+                        ("ContainsAny", ("transition_metal",)): lambda formula: Composition(formula).contains_element_type("transition_metal"),
+                        ("ContainsAny", ("Cu", "Ni")): lambda formula: bool(oldElements(formula) & {"Cu", "Ni"}),             #_containsCu_or_Ni
+                        ("ContainsAny", ("C", "N")): lambda formula: bool(oldElements(formula) & CorN)}                      #_containsCorN
+            for (mode, elements), oldFilter in original.items():
+                self.assertMaskEqual(self.comps.element_set_mask(list(elements), mode), [oldFilter(formula) for formula in FORMULAS], (mode, elements))
+
+        def test_every_element_set_mode(self):
+            for elements in (["O"], ["C", "H"], ["Ti", "C"], ["transition_metal", "C", "N"], ["metal", "O"], ["Fe", "Ni"]):
+                for mode in ELEMENT_SET_MODES:
+                    self.assertMaskEqual(self.comps.element_set_mask(elements, mode), [oldElementSet(formula, elements, mode) for formula in FORMULAS], (mode, elements))
+
+        def test_nelements_and_amount_ratios(self):
+            self.assertEqual(self.comps.nelements().tolist(), [len(Composition(formula).elements) for formula in FORMULAS])
+            for maxRatio in (1, 2, 3.5, 7):
+                oldRatios = [max(Composition(formula).get_el_amt_dict().values())/min(Composition(formula).get_el_amt_dict().values()) for formula in FORMULAS]
+                self.assertMaskEqual(self.comps.max_amount() <= maxRatio*self.comps.min_amount(), [ratio <= maxRatio for ratio in oldRatios], maxRatio)
+
+        def test_mxene_ratios(self):
+            from Filters import Analysis
+            results = [{"pretty_formula": formula} for formula in FORMULAS]
+            kept = [result["pretty_formula"] for result in Analysis.MXeneRatioFilter(results)]
+            self.assertEqual(kept, [formula for formula in FORMULAS if oldMXeneRatio(formula)])
+            self.assertIn("Ti2C", kept)
+            self.assertNotIn("Ti2NbC", kept) #the last transition metal is Nb, and Nb:C = 1:1
+            anyPair = [result["pretty_formula"] for result in Analysis.MXeneRatioFilter(results, anyPair=True)]
+            amounts = [Composition(formula).get_el_amt_dict() for formula in FORMULAS]
+            self.assertEqual(anyPair, [formula for formula, amount in zip(FORMULAS, amounts)
+                                       if any((amount[M], amount[X]) in {(2, 1), (3, 2), (4, 3), (5, 4)}
+                                              for M in amount if Element(M).is_transition_metal for X in amount if X in ("C", "N"))])
+            self.assertIn("Ti2NbC", anyPair) #Ti:C = 2:1
+
+        def test_element_groups(self):
+            for group in ELEMENT_GROUPS:
+                self.assertEqual(element_group(group), oldGroup(group), group)
+                for mode in ELEMENT_SET_MODES:
+                    self.assertMaskEqual(self.comps.element_set_mask([group], mode), [oldElementSet(formula, [group], mode) for formula in FORMULAS], (mode, group))
+            with self.assertRaises(ValueError):
+                self.comps.element_set_mask(["O"], "ContainsSome")
+            with self.assertRaises(ValueError):
+                self.comps.element_set_mask([], "ContainsAny")
+
+        def assertMatrixCorrect(self, comps, formulas):
+            expected = np.zeros((len(formulas), NUMBER_OF_ELEMENTS))
+            for i, formula in enumerate(formulas):
+                for symbol, amount in Composition(formula).get_el_amt_dict().items():
+                    expected[i, Element(symbol).Z-1] = amount
+            np.testing.assert_array_equal(comps.matrix.toarray(), expected)
+            for elements, mode in ((["transition_metal", "C", "N"], "ContainsAll"), (["metal"], "ExcludeOnly"), (["O", "halogen"], "ContainsAny")):
+                self.assertEqual(comps.element_set_mask(elements, mode).tolist(), [oldElementSet(formula, elements, mode) for formula in formulas])
+
+        def test_matrix_is_rebuilt_when_full(self):
+            global COMPOSITION_CACHE_SIZE
+            cacheSize, COMPOSITION_CACHE_SIZE = COMPOSITION_CACHE_SIZE, 8
+            try:
+                _clear()
+                first = CompositionMatrix(FORMULAS[:6])
+                self.assertEqual(len(_formulaRows), 6)
+                again = CompositionMatrix(FORMULAS[4:8]) #two new formulas fill the matrix exactly
+                self.assertEqual(len(_formulaRows), 8)
+                second = CompositionMatrix(FORMULAS[8:12]) #would overflow, so the matrix is emptied first
+                self.assertEqual(len(_formulaRows), 4)
+                everything = CompositionMatrix(FORMULAS + FORMULAS[:3]) #more formulas than fit still each get a row
+                self.assertEqual(len(_formulaRows), len(FORMULAS))
+                oneByOne = [(CompositionMatrix([formula, FORMULAS[0]]), [formula, FORMULAS[0]]) for formula in FORMULAS[::-1]] #emptied several times
+                #matrices made before a rebuild keep their own rows
+                for comps, formulas in [(first, FORMULAS[:6]), (again, FORMULAS[4:8]), (second, FORMULAS[8:12]), (everything, FORMULAS + FORMULAS[:3])] + oneByOne:
+                    self.assertMatrixCorrect(comps, formulas)
+                self.assertLessEqual(len(_formulaRows), 8)
+                self.assertMatrixCorrect(CompositionMatrix(FORMULAS[::2]), FORMULAS[::2]) #and the matrix keeps working afterwards
+            finally:
+                COMPOSITION_CACHE_SIZE = cacheSize
+                _clear()
+
+    unittest.main()
@@ -0,0 +1,264 @@
+import json
+import math
+import os
+
+import numpy as np
+
+from StructureIndex import material_id
+
+#A similarity index over the condensed structures made by GetCondensedStructures (robocrys's StructureCondenser), so that materials
+#resembling a reference can be found without condensing anything again (see Analysis.SimilarToFilter).
+#
+#Each condensed structure is turned into a sparse feature vector, scaled to unit length so the dot product of two is their cosine similarity:
+#   - "mineral=..."                  the mineral prototype robocrys matched, if any
+#   - "dimensionality=..."           of the structure, and "component_dimensionality=..." the fraction of its components of each dimensionality
+#   - "crystal_system=..."
+#   - "geometry=..."                 the fraction of its (inequivalent) sites with each coordination geometry, e.g. "geometry=octahedral"
+#   - "polyhedron=..."               the same by element, e.g. "polyhedron=Ti:octahedral"
+#   - "connectivity=..."             the fraction of its sites sharing corners, edges or faces with polyhedra of each geometry,
+#                                    e.g. "connectivity=octahedral:edge"
+#weighted by FEATURE_WEIGHTS. The vectors are kept in an inverted index (feature -> the materials that have it) and searched by prefix
+#filtering: the materials with the query's rarest feature are scored, then those with its next rarest, and so on, until the part of the
+#query not looked at yet has a norm below the top-th best similarity found. A material with none of the features looked at can't be
+#more similar than that norm (both vectors are unit length), so the top matches are exact, but common features such as
+#"dimensionality=3" are usually never read and a query costs milliseconds however large the index is.
+#
+#The features of every material are saved in homeDir/CondensedIndex/{database}.jsonl (one JSON record per line) as they are added, so
+#a material condensed in one search can be found by SimilarTo in any other.
+
+CONDENSED_INDEX_DIR_NAME = "CondensedIndex"
+FEATURE_WEIGHTS = {"mineral": 2.0, "dimensionality": 1.0, "component_dimensionality": 0.5, "crystal_system": 0.5, "geometry": 1.0, "polyhedron": 0.5,
+                   "connectivity": 1.0}
+
+
+def condensed_features(condensed):
+    """The unit-length feature vector {feature: weight} of a condensed structure (the output of StructureCondenser.condense_structure)."""
+    counts = {}
+    def add(kind, value, amount=1.0):
+        feature = f"{kind}={value}"
+        counts[feature] = counts.get(feature, 0.0) + FEATURE_WEIGHTS[kind]*amount
+
+    mineral = condensed.get("mineral") or {}
+    if(mineral.get("type") is not None):
+        add("mineral", mineral["type"])
+    add("dimensionality", condensed["dimensionality"])
+    if(condensed.get("crystal_system") is not None):
+        add("crystal_system", condensed["crystal_system"])
+    components = list((condensed.get("components") or {}).values())
+    for component in components:
+        add("component_dimensionality", component["dimensionality"], 1/len(components))
+    sites = condensed.get("sites") or {}
+    geometries = {str(index): site["geometry"]["type"] for index, site in sites.items()}
+    for index, site in sites.items():
+        add("geometry", geometries[str(index)], 1/len(sites))
+        add("polyhedron", f"{site['element']}:{geometries[str(index)]}", 1/len(sites))
+        for mode, neighbours in (site.get("nnn") or {}).items(): #mode is corner, edge or face
+            for geometry in sorted({geometries[str(neighbour)] for neighbour in neighbours if str(neighbour) in geometries}):
+                add("connectivity", f"{geometry}:{mode}", 1/len(sites))
+
+    norm = math.sqrt(sum(weight*weight for weight in counts.values()))
+    return {feature: weight/norm for feature, weight in sorted(counts.items())}
+
+def similarity(features, otherFeatures):
+    """The cosine similarity of two feature vectors from condensed_features."""
+    return sum(weight*otherFeatures.get(feature, 0.0) for feature, weight in features.items())
+
+
+class CondensedIndex():
+    """
+    Usage (see Analysis.GetCondensedStructures and Analysis.SimilarToFilter):
+        index = CondensedIndex(homeDir, "gnome")
+        index.add_results(results)                                  #the results with a condensed_struct
+        index.save()
+        matches = index.search(index.features_of("mp-2815"), top=10, within=materialIds)   #[(MaterialId, similarity), ...], most similar first
+    The index file is only read when the index is first used.
+    """
+    def __init__(self, homeDir, database):
+        self.path = os.path.join(homeDir, CONDENSED_INDEX_DIR_NAME, f"{database}.jsonl")
+        self._featuresOf = None #MaterialId -> feature vector
+        self._new = [] #records added since the index was last saved
+        self._postings = None #the inverted index, rebuilt when materials have been added since it was last built
+
+    def _load(self):
+        if(self._featuresOf is None):
+            self._featuresOf = {}
+            if(os.path.isfile(self.path)):
+                with open(self.path, "r") as f:
+                    for line in f:
+                        if(line.strip() != ""):
+                            record = json.loads(line)
+                            self._featuresOf[record["id"]] = record["features"] #a material condensed again replaces its earlier record
+        return self._featuresOf
+
+    def __len__(self):
+        return len(self._load())
+
+    def __contains__(self, materialId):
+        return materialId in self._load()
+
+    def features_of(self, materialId):
+        return self._load()[materialId]
+
+    def add(self, materialId, features):
+        featuresOf = self._load()
+        if(featuresOf.get(materialId) != features):
+            featuresOf[materialId] = features
+            self._new.append({"id": materialId, "features": features})
+            self._postings = None
+
+    def add_results(self, results):
+        """Adds each result with a condensed_struct. Returns how many there were."""
+        added = 0
+        for result in results:
+            if(result.get("condensed_struct") is not None):
+                self.add(material_id(result), condensed_features(result["condensed_struct"]))
+                added += 1
+        return added
+
+    def save(self):
+        """Appends the materials added since the last save to the index file."""
+        if(len(self._new) == 0):
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.writelines(json.dumps(record) + "\n" for record in self._new)
+        self._new = []
+
+    def _build(self):
+        if(self._postings is None):
+            featuresOf = self._load()
+            ids = list(featuresOf)
+            vocabulary = {}
+            rows, columns, weights = [], [], []
+            for row, materialId in enumerate(ids):
+                for feature, weight in featuresOf[materialId].items():
+                    rows.append(row)
+                    columns.append(vocabulary.setdefault(feature, len(vocabulary)))
+                    weights.append(weight)
+            rows, columns, weights = np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64), np.array(weights)
+            order = np.argsort(columns, kind="stable")
+            self._postings = {"ids": ids, "row_of": {materialId: row for row, materialId in enumerate(ids)}, "vocabulary": vocabulary,
+                              "starts": np.searchsorted(columns[order], np.arange(len(vocabulary)+1)), #feature -> its slice of rows
+                              "rows": rows[order],
+                              "row_starts": np.searchsorted(rows, np.arange(len(ids)+1)), #material -> its slice of row_columns/row_weights
+                              "row_columns": columns, "row_weights": weights}
+        return self._postings
+
+    def _score(self, queryVector, rows):
+        """The similarity of the query (a dense vector over the vocabulary) to each of rows, from their stored vectors."""
+        postings = self._postings
+        starts = postings["row_starts"][rows]
+        lengths = postings["row_starts"][rows+1]-starts
+        if(len(rows) == 0):
+            return np.zeros(0)
+        entries = np.repeat(starts-np.cumsum(lengths)+lengths, lengths) + np.arange(lengths.sum()) #every entry of each row, row by row
+        products = queryVector[postings["row_columns"][entries]]*postings["row_weights"][entries]
+        return np.add.reduceat(products, np.cumsum(lengths)-lengths) #every material has at least its dimensionality, so no row is empty
+
+    def search(self, features, top=10, within=None, minSimilarity=0.0):
+        """
+        The top (None for every) materials most similar to the feature vector features, as [(MaterialId, similarity), ...], most similar first.
+        within (optional) only considers the given MaterialIds, and minSimilarity leaves out less similar materials. Materials that share
+        no features with the query aren't returned.
+        """
+        postings = self._build()
+        allowed = None
+        if(within is not None):
+            allowed = np.zeros(len(postings["ids"]), dtype=bool)
+            allowed[[postings["row_of"][materialId] for materialId in within if materialId in postings["row_of"]]] = True
+        queryFeatures = [(postings["vocabulary"][feature], weight) for feature, weight in features.items() if feature in postings["vocabulary"]]
+        starts = postings["starts"]
+        queryFeatures.sort(key=lambda pair: starts[pair[0]+1]-starts[pair[0]]) #rarest first
+        queryVector = np.zeros(len(postings["vocabulary"]))
+        for column, weight in queryFeatures:
+            queryVector[column] = weight
+        unreadNorms = np.sqrt(np.cumsum([weight*weight for _, weight in queryFeatures][::-1])[::-1]) #norm of the query from each feature on
+
+        seen = np.zeros(len(postings["ids"]), dtype=bool)
+        candidateRows, candidateScores = [], []
+        threshold = minSimilarity
+        for i, (column, _) in enumerate(queryFeatures):
+            if(unreadNorms[i] < threshold): #no material not seen yet can make the top any more
+                break
+            rows = postings["rows"][starts[column]:starts[column+1]]
+            rows = rows[~seen[rows] if allowed is None else ~seen[rows] & allowed[rows]]
+            seen[rows] = True
+            candidateRows.append(rows)
+            candidateScores.append(self._score(queryVector, rows))
+            if(top is not None and sum(len(scores) for scores in candidateScores) >= top):
+                scores = np.concatenate(candidateScores)
+                threshold = max(threshold, np.partition(scores, len(scores)-top)[len(scores)-top]) #the top-th best so far
+
+        rows = np.concatenate(candidateRows) if len(candidateRows) != 0 else np.zeros(0, dtype=np.int64)
+        scores = np.concatenate(candidateScores) if len(candidateScores) != 0 else np.zeros(0)
+        keep = scores >= minSimilarity
+        rows, scores = rows[keep], scores[keep]
+        order = np.lexsort((rows, -scores)) #most similar first, ties in the order the materials were added
+        if(top is not None):
+            order = order[:top]
+        return [(postings["ids"][row], float(score)) for row, score in zip(rows[order], scores[order])]
+
+if __name__ == "__main__":
+    import random
+    import tempfile
+    import time
+    import unittest
+
+    def condensed(mineral, dimensionality, sites, crystalSystem="cubic"):
+        """A condensed structure with the parts condensed_features uses. sites is [(element, geometry, {mode: [neighbouring sites]}), ...]."""
+        return {"mineral": {"type": mineral}, "dimensionality": dimensionality, "crystal_system": crystalSystem,
+                "components": {"0": {"dimensionality": dimensionality}},
+                "sites": {str(i): {"element": element, "geometry": {"type": geometry}, "nnn": nnn} for i, (element, geometry, nnn) in enumerate(sites)}}
+
+    ROCK_SALT = condensed("Rock Salt", 3, [("Na", "octahedral", {"edge": [0, 1]}), ("Cl", "octahedral", {"edge": [0, 1]})])
+    PEROVSKITE = condensed("Perovskite", 3, [("Sr", "cuboctahedral", {"face": [1]}), ("Ti", "octahedral", {"corner": [1], "face": [0]})])
+    LAYERED = condensed(None, 2, [("Mo", "trigonal prismatic", {"edge": [0]}), ("S", "trigonal non-coplanar", {"edge": [1]})], "hexagonal")
+
+    class CondensedIndexTest(unittest.TestCase):
+        def test_features(self):
+            features = condensed_features(ROCK_SALT)
+            self.assertAlmostEqual(similarity(features, features), 1.0)
+            self.assertIn("connectivity=octahedral:edge", features)
+            self.assertGreater(similarity(features, condensed_features(condensed("Rock Salt", 3, [("K", "octahedral", {"edge": [0, 1]}),
+                                                                                                    ("Br", "octahedral", {"edge": [0, 1]})]))), 0.9)
+            self.assertLess(similarity(features, condensed_features(LAYERED)), 0.1)
+
+        def test_search_and_reload(self):
+            results = [{"MaterialId": "nacl", "condensed_struct": ROCK_SALT}, {"MaterialId": "srtio3", "condensed_struct": PEROVSKITE},
+                       {"MaterialId": "mos2", "condensed_struct": LAYERED}, {"MaterialId": "uncondensed"}]
+            with tempfile.TemporaryDirectory() as homeDir:
+                index = CondensedIndex(homeDir, "test")
+                self.assertEqual(index.add_results(results), 3)
+                index.save()
+                reloaded = CondensedIndex(homeDir, "test")
+                self.assertEqual(len(reloaded), 3)
+                query = reloaded.features_of("srtio3")
+                matches = reloaded.search(query, top=None)
+                self.assertEqual([materialId for materialId, _ in matches], ["srtio3", "nacl"]) #mos2 shares nothing with it
+                self.assertAlmostEqual(matches[0][1], 1.0)
+                self.assertEqual(reloaded.search(query, top=1), matches[:1])
+                self.assertEqual(reloaded.search(query, within=["nacl", "mos2"]), [("nacl", matches[1][1])])
+                self.assertEqual(reloaded.search(query, minSimilarity=0.5), [("srtio3", matches[0][1])])
+
+        def test_search_is_exact(self):
+            minerals = [f"mineral {i}" for i in range(200)] + [None]*200
+            geometries = ["octahedral", "tetrahedral", "trigonal planar", "square planar", "cuboctahedral", "linear"]
+            elements = ["Na", "Cl", "Ti", "O", "Mo", "S", "Fe", "Cu"]
+            generator = random.Random(0)
+            index = CondensedIndex(tempfile.gettempdir(), "unsaved")
+            for i in range(20_000):
+                sites = [(generator.choice(elements), generator.choice(geometries), {generator.choice(["corner", "edge", "face"]): [0, 1]})
+                         for _ in range(generator.randint(1, 4))]
+                index.add(f"id{i}", condensed_features(condensed(generator.choice(minerals), generator.choice([0, 1, 2, 3]), sites)))
+            index._build()
+            queries = [f"id{i}" for i in range(0, 20_000, 200)]
+            start = time.perf_counter()
+            matches = [index.search(index.features_of(materialId), top=5) for materialId in queries]
+            print(f"\n{len(queries)} searches of {len(index)} materials: {1000*(time.perf_counter()-start)/len(queries):.2f} ms each")
+            for materialId, found in zip(queries, matches):
+                query = index.features_of(materialId)
+                everything = sorted((similarity(query, features) for features in index._load().values()), reverse=True)
+                self.assertIn(materialId, [match for match, _ in found])
+                np.testing.assert_allclose([score for _, score in found], everything[:5])
+
+    unittest.main()
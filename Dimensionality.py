@@ -0,0 +1,271 @@
+from collections import Counter
+
+import numpy as np
+
+#A fast pre-screen for the dimensionality of a structure, used by DimensionalityFilter before the exact analysis.
+#
+#The exact analysis (Analysis._get_dimensionality) builds a StructureGraph with MinimumDistanceNN and runs pymatgen's
+#get_structure_components on it, which is slow for every structure, including the dense 3D frameworks that make up most of
+#GNoME. The pre-screen works directly on NumPy arrays of the lattice and fractional coordinates:
+#   1) the nearest-neighbour distance of every site, from a KD-tree over the periodic images of the cell,
+#   2) a vacuum gap test: if the atoms leave an empty slab along a lattice direction that is wider than the longest possible
+#      bond, nothing can be bonded across it, so the structure cannot be periodic in that direction,
+#   3) the bonds MinimumDistanceNN would make (every neighbour closer than (1+tol) x the site's nearest-neighbour distance), from
+#      the same KD-tree, and the dimensionality of each bonded component from the lattice translations of the cycles it contains
+#      (found with a union-find over the sites - the same quantity the Larsen algorithm in get_structure_components computes).
+#Structures where the answer could depend on details the pre-screen does not model - disorder, isolated sites, or a bond length
+#within rounding distance of the bonding cut-off - are not classified, and are escalated to the exact analysis.
+#The exact analysis itself can use the vectorized neighbour search too (see bonded_structure below).
+#SciPy's KD-tree and pymatgen's graph modules are imported inside the functions that use them, so importing this module (and Filters) is quick.
+
+BOND_TOL = 0.1 #MinimumDistanceNN defaults, which the exact analysis uses
+NN_CUTOFF = 10.0
+BORDERLINE_TOL = 1e-6 #relative distance from the bonding cut-off within which a bond is too close to call (rounding differences only)
+INITIAL_SEARCH_RADIUS = 4.0 #Angstrom, grown as needed
+ESCALATION_REASONS = ("disordered", "isolated site", "borderline bond", "prescreen off", "prescreen failed") #reasons for which the exact analysis is run
+
+
+def interplanar_spacings(latticeMatrix):
+    """Distance between neighbouring lattice planes normal to each reciprocal lattice vector (one per fractional coordinate)."""
+    return 1.0/np.linalg.norm(np.linalg.inv(latticeMatrix).T, axis=1)
+
+def periodic_images(fracCoords, latticeMatrix, radius):
+    """
+    Cartesian coordinates of every periodic image of the sites that can be within radius of a site in the home cell.
+    Returns (coordinates, site index of each image, lattice translation of each image).
+    """
+    ranges = [np.arange(-n, n+1) for n in np.ceil(radius/interplanar_spacings(latticeMatrix)).astype(int) + 1]
+    translations = np.stack(np.meshgrid(*ranges, indexing="ij"), axis=-1).reshape(-1, 3)
+    imageFrac = (fracCoords[None, :, :] + translations[:, None, :]).reshape(-1, 3)
+    siteIndices = np.tile(np.arange(len(fracCoords)), len(translations))
+    return imageFrac @ latticeMatrix, siteIndices, np.repeat(translations, len(fracCoords), axis=0)
+
+def nearest_neighbor_distances(fracCoords, latticeMatrix, cutoff=NN_CUTOFF):
+    """Distance from each site to its nearest neighbour (inf if there is none within cutoff)."""
+    from scipy.spatial import cKDTree
+    cartCoords = fracCoords @ latticeMatrix
+    radius = min(INITIAL_SEARCH_RADIUS, cutoff)
+    while(True):
+        imageCoords, _, _ = periodic_images(fracCoords, latticeMatrix, radius)
+        distances, _ = cKDTree(imageCoords).query(cartCoords, k=2, distance_upper_bound=radius) #k=2: the nearest is the site itself
+        nearest = distances[:, 1]
+        if(np.isfinite(nearest).all() or radius >= cutoff):
+            return nearest
+        radius = min(2*radius, cutoff) #some sites have no neighbour within radius, so look further
+
+def vacuum_gap_dimension_bound(fracCoords, latticeMatrix, maxBondLength):
+    """Upper bound on the dimensionality: 3 minus the number of lattice directions with an empty slab wider than maxBondLength."""
+    spacings = interplanar_spacings(latticeMatrix)
+    bound = 3
+    for k in range(3):
+        heights = np.sort(fracCoords[:, k] % 1.0)*spacings[k]
+        gaps = np.diff(np.append(heights, heights[0] + spacings[k])) #including the gap across the cell boundary
+        if(gaps.max() > maxBondLength):
+            bound -= 1
+    return bound
+
+def bonds(fracCoords, latticeMatrix, radii):
+    """
+    Every pair (i, j, translation) with image j + translation closer than radii[i] to site i, along with its length.
+    Returns arrays (i, j, translations, lengths).
+    """
+    from scipy.spatial import cKDTree
+    cartCoords = fracCoords @ latticeMatrix
+    imageCoords, siteIndices, translations = periodic_images(fracCoords, latticeMatrix, radii.max())
+    neighbourLists = cKDTree(imageCoords).query_ball_point(cartCoords, radii)
+    i = np.repeat(np.arange(len(fracCoords)), [len(neighbours) for neighbours in neighbourLists])
+    images = np.concatenate([np.asarray(neighbours, dtype=np.int64) for neighbours in neighbourLists])
+    lengths = np.linalg.norm(imageCoords[images] - cartCoords[i], axis=1)
+    notSelf = lengths > 1e-8
+    return i[notSelf], siteIndices[images][notSelf], translations[images][notSelf], lengths[notSelf]
+
+def bonded_dimensionality(numOfSites, i, j, translations):
+    """
+    Largest dimensionality of the bonded components of a periodic structure, given its bonds (site i bonded to site j in the cell
+    translated by translation). A component's dimensionality is the rank of the lattice translations around its cycles.
+    """
+    parent = list(range(numOfSites))
+    offset = [np.zeros(3, dtype=np.int64) for _ in range(numOfSites)] #translation of each site relative to its parent
+    cycles = {site: [] for site in range(numOfSites)} #lattice translations around cycles, kept at each root
+
+    def find(site):
+        path = []
+        while(parent[site] != site):
+            path.append(site)
+            site = parent[site]
+        root = site
+        for node in reversed(path): #path compression, keeping offsets relative to the root
+            if(parent[node] != root):
+                offset[node] = offset[node] + offset[parent[node]]
+                parent[node] = root
+        return root
+
+    for a, b, translation in zip(i, j, translations):
+        rootA, rootB = find(a), find(b)
+        #b + translation is bonded to a, so relative to the root b should sit at offset[a] + translation
+        shift = offset[a] + translation - offset[b]
+        if(rootA == rootB):
+            if(shift.any()):
+                cycles[rootA].append(shift)
+        else:
+            parent[rootB] = rootA
+            offset[rootB] = shift
+            cycles[rootA] += cycles.pop(rootB)
+
+    ranks = [np.linalg.matrix_rank(np.array(vectors)) if len(vectors) != 0 else 0 for vectors in cycles.values()]
+    return int(max(ranks))
+
+
+#Neighbour backends for the exact analysis. MinimumDistanceNN.get_bonded_structure searches for the neighbours of one site at a
+#time, which dominates the analysis for large cells. These backends find the neighbours of every site in one call and then apply the
+#same bonding rule, so the StructureGraph - and the dimensionality get_structure_components finds in it - is the same.
+#   "pymatgen" - MinimumDistanceNN.get_bonded_structure, site by site
+#   "celllist" - pymatgen's Structure.get_neighbor_list (a compiled periodic cell list)
+#   "kdtree"   - a SciPy KD-tree over the periodic images (see bonds above)
+NEIGHBOR_BACKENDS = ("pymatgen", "celllist", "kdtree")
+DEFAULT_NEIGHBOR_BACKEND = "celllist"
+
+def neighbor_list(structure, radius, backend=DEFAULT_NEIGHBOR_BACKEND):
+    """Every neighbour within radius of every site, as arrays (centre site, neighbour site, neighbour's lattice translation, distance)."""
+    if(backend == "celllist"):
+        centres, neighbours, translations, distances = structure.get_neighbor_list(radius)
+        return centres, neighbours, np.rint(translations).astype(np.int64), distances
+    fracCoords = np.array(structure.frac_coords, dtype=float)
+    wrapped = fracCoords % 1.0 #bonds() works in the home cell, so translations are shifted back to the original coordinates below
+    centres, neighbours, translations, distances = bonds(wrapped, np.array(structure.lattice.matrix, dtype=float), np.full(len(structure), radius))
+    shift = np.rint(wrapped - fracCoords).astype(np.int64)
+    return centres, neighbours, translations + shift[neighbours] - shift[centres], distances
+
+def minimum_distance_bonds(structure, backend=DEFAULT_NEIGHBOR_BACKEND, tol=BOND_TOL, cutoff=NN_CUTOFF):
+    """
+    The bonds MinimumDistanceNN(tol, cutoff) makes, for all sites at once: every neighbour closer than (1+tol) x the distance from the
+    site to its nearest neighbour. Returns arrays (site, neighbour site, neighbour's lattice translation, distance, nearest-neighbour distance of site).
+    """
+    numOfSites = len(structure)
+    radius = min(INITIAL_SEARCH_RADIUS, cutoff)
+    while(True): #only search as far as needed - a cutoff-sized sphere holds hundreds of neighbours per site
+        centres, neighbours, translations, distances = neighbor_list(structure, radius, backend)
+        nearest = np.full(numOfSites, np.inf)
+        np.minimum.at(nearest, centres, distances)
+        if(np.isfinite(nearest).all() or radius >= cutoff):
+            break
+        radius = min(2*radius, cutoff)
+    if(not np.isfinite(nearest).all()):
+        raise ValueError(f"No neighbours within {cutoff} A of some sites.") #as MinimumDistanceNN, which fails on min() of no neighbours
+    bondRadii = (1+tol)*nearest
+    if(bondRadii.max() > radius):
+        centres, neighbours, translations, distances = neighbor_list(structure, min(bondRadii.max(), cutoff), backend)
+    bonded = distances < bondRadii[centres]
+    return centres[bonded], neighbours[bonded], translations[bonded], distances[bonded], nearest
+
+def bonded_structure(structure, backend=DEFAULT_NEIGHBOR_BACKEND, tol=BOND_TOL, cutoff=NN_CUTOFF):
+    """The StructureGraph MinimumDistanceNN(tol, cutoff).get_bonded_structure(structure) would build, using the given neighbour backend."""
+    from pymatgen.analysis.graphs import StructureGraph
+    from pymatgen.analysis.local_env import MinimumDistanceNN
+    if(backend not in NEIGHBOR_BACKENDS):
+        raise ValueError(f"Neighbour backend {backend} is not recognised. Options are: {', '.join(NEIGHBOR_BACKENDS)}")
+    if(backend == "pymatgen" or not structure.is_ordered): #disordered structures are left to pymatgen's handling of disorder
+        return MinimumDistanceNN(tol=tol, cutoff=cutoff).get_bonded_structure(structure.copy())
+    centres, neighbours, translations, distances, nearest = minimum_distance_bonds(structure, backend, tol, cutoff)
+    graph = StructureGraph.from_empty_graph(structure.copy(), name="bonds", edge_weight_name="weight", edge_weight_units="")
+    for centre, neighbour, translation, distance in zip(centres.tolist(), neighbours.tolist(), translations.tolist(), distances.tolist()):
+        graph.add_edge(centre, neighbour, to_jimage=tuple(translation), weight=nearest[centre]/distance, warn_duplicates=False)
+    return graph
+
+
+def prescreen_dimensionality(structure, tol=BOND_TOL, cutoff=NN_CUTOFF):
+    """
+    Returns (dimensionality, reason). dimensionality is None when the structure should be escalated to the exact analysis,
+    and reason says why (or how the structure was classified).
+    """
+    if(not structure.is_ordered):
+        return None, "disordered"
+    fracCoords = np.array(structure.frac_coords, dtype=float) % 1.0
+    latticeMatrix = np.array(structure.lattice.matrix, dtype=float)
+    nearest = nearest_neighbor_distances(fracCoords, latticeMatrix, cutoff)
+    if(not np.isfinite(nearest).all()):
+        return None, "isolated site" #MinimumDistanceNN has no neighbours to choose from - the exact analysis decides what happens
+    radii = (1+tol)*nearest
+    if(vacuum_gap_dimension_bound(fracCoords, latticeMatrix, radii.max()) == 0):
+        return 0, "vacuum gaps"
+    i, j, translations, lengths = bonds(fracCoords, latticeMatrix, radii*(1+BORDERLINE_TOL))
+    borderline = np.abs(lengths - radii[i]) <= BORDERLINE_TOL*radii[i]
+    if(borderline.any()):
+        return None, "borderline bond"
+    bonded = lengths < radii[i]
+    return bonded_dimensionality(len(fracCoords), i[bonded], j[bonded], translations[bonded]), "bond graph"
+
+
+class PrescreenStats():
+    """Counts of how the structures in a DimensionalityFilter run were classified, for the perf log."""
+    def __init__(self):
+        self.reasons = Counter()
+        self.verified = 0
+        self.mismatches = [] #(MaterialId, prescreened dimensionality, exact dimensionality)
+
+    def add(self, reason):
+        self.reasons[reason] += 1
+
+    def add_verification(self, materialId, prescreenedDim, exactDim):
+        self.verified += 1
+        if(prescreenedDim != exactDim):
+            self.mismatches.append((materialId, prescreenedDim, exactDim))
+
+    def summary(self):
+        total = sum(self.reasons.values())
+        escalated = sum(count for reason, count in self.reasons.items() if reason in ESCALATION_REASONS)
+        summary = {"structures": total,
+                   "skipped_exact": total-escalated,
+                   "skip_rate": round((total-escalated)/total, 4) if total != 0 else None,
+                   "reasons": dict(self.reasons)}
+        if(self.verified != 0):
+            summary["verified"] = self.verified
+            summary["mismatches"] = self.mismatches
+        return summary
+
+
+if __name__ == "__main__":
+    import unittest
+    from pymatgen.core.lattice import Lattice
+    from pymatgen.core.structure import Structure
+    from Filters import Analysis
+
+    def layered(): #MoS2-like slab with a wide vacuum gap along c
+        return Structure(Lattice.hexagonal(3.16, 18.0), ["Mo", "S", "S"], [[1/3, 2/3, 0.25], [2/3, 1/3, 0.16], [2/3, 1/3, 0.34]])
+    def chain(): #1D chains along a
+        return Structure(Lattice.orthorhombic(2.5, 8.0, 8.0), ["Si", "O"], [[0, 0, 0], [0.5, 0, 0]])
+    def molecular(): #isolated dimers
+        return Structure(Lattice.cubic(8.0), ["Cl", "Cl"], [[0, 0, 0], [0.25, 0, 0]])
+    def rocksalt():
+        return Structure.from_spacegroup("Fm-3m", Lattice.cubic(5.64), ["Na", "Cl"], [[0, 0, 0], [0.5, 0.5, 0.5]])
+    def triclinic(): #3D, with a strongly skewed cell
+        return Structure(Lattice.from_parameters(3.1, 4.2, 5.3, 70, 100, 115), ["Ti", "O", "O"], [[0, 0, 0], [0.3, 0.5, 0.1], [0.7, 0.2, 0.6]])
+
+    class DimensionalityPrescreenTest(unittest.TestCase):
+        def test_matches_exact_analysis(self):
+            for name, structure in [("layered", layered()), ("chain", chain()), ("molecular", molecular()), ("rocksalt", rocksalt()), ("triclinic", triclinic())]:
+                with self.subTest(name=name):
+                    dim, reason = prescreen_dimensionality(structure)
+                    self.assertIsNotNone(dim, reason)
+                    self.assertEqual(dim, Analysis._get_dimensionality(structure))
+
+        def test_supercell_does_not_change_dimensionality(self):
+            for structure in [layered(), chain(), rocksalt()]:
+                self.assertEqual(prescreen_dimensionality(structure)[0], prescreen_dimensionality(structure*(2, 1, 3))[0])
+
+        def test_neighbor_backends_build_the_same_graph(self):
+            unwrapped = Structure(triclinic().lattice, triclinic().species, triclinic().frac_coords + [[1, 0, -2], [0, 3, 0], [-1, -1, 1]])
+            for name, structure in [("layered", layered()*(3, 3, 1)), ("chain", chain()), ("rocksalt", rocksalt()), ("unwrapped", unwrapped)]:
+                reference = bonded_structure(structure, "pymatgen")
+                for backend in NEIGHBOR_BACKENDS:
+                    with self.subTest(name=name, backend=backend):
+                        graph = bonded_structure(structure, backend)
+                        self.assertEqual(graph.graph.number_of_edges(), reference.graph.number_of_edges())
+                        self.assertEqual(Analysis._get_dimensionality(structure, backend), Analysis._get_dimensionality(structure, "pymatgen"))
+
+        def test_disordered_structures_are_escalated(self):
+            structure = rocksalt()
+            structure.replace(0, {"Na": 0.5, "K": 0.5})
+            self.assertEqual(prescreen_dimensionality(structure), (None, "disordered"))
+
+    unittest.main()
@@ -0,0 +1,376 @@
+import argparse
+import importlib
+import itertools
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import dill
+from multiprocess.managers import BaseManager
+
+#A multi-node executor backend for Batching.batch_map.
+#
+#The coordinator is the process running the search. It serves a task queue and a result queue over TCP; worker processes -
+#on this machine or any other that can reach it - pull tasks from the task queue, run them and push back the results.
+#Usage, on the machine running the search:
+#   import Batching, Distributed
+#   Batching.set_executor(Distributed.Coordinator(host="0.0.0.0", port=50000, authkey=b"secret"))
+#   MaterialSearch(...)        #batch_map tasks (e.g. GetCondensedStructures) now run on the workers
+#and on every worker machine (with this repository and its dependencies installed, started from the repository directory):
+#   python Distributed.py coordinator-host:50000 --authkey secret --processes 32 --initializer Compositions.warm
+#
+#Tasks and results are serialised with dill, as with the local multiprocess pool, so the same filters run unchanged. batch_map
+#callbacks and batch directories (and so resuming an interrupted stage) work exactly as with the local pool, since they all run
+#in the coordinator. Files that a task itself writes are written in the worker's working directory (problem children are sent back and written by the coordinator).
+#Tasks arrive as pickles, which run code when they are loaded, so the coordinator only listens on 127.0.0.1 unless given another
+#host, and both ends need a non-empty authkey; give host="0.0.0.0" (all interfaces) only on a network you trust.
+#Workers send a heartbeat while they are alive; the tasks of a worker that stops sending them (crashed, killed, lost its node)
+#are put back on the queue for another worker. If there are tasks but no worker for connectTimeout seconds (none ever connected, or
+#every one has gone), the tasks fail with a TimeoutError rather than the search waiting forever.
+
+DEFAULT_PORT = 50000
+HEARTBEAT_INTERVAL = 5 #seconds between heartbeats from each worker
+WORKER_TIMEOUT = 60 #seconds without a heartbeat after which a worker's tasks are handed to other workers
+CONNECT_TIMEOUT = 600 #seconds with tasks waiting but no worker after which the tasks fail
+POLL_INTERVAL = 0.5 #seconds between checks for new tasks/messages
+
+
+class _QueueManager(BaseManager):
+    pass
+_QueueManager.register("get_tasks")
+_QueueManager.register("get_results")
+_QueueManager.register("get_closed")
+
+
+class DistributedResult():
+    """The coordinator's handle on a submitted task - the distributed equivalent of multiprocess.pool.AsyncResult."""
+    def __init__(self, callback=None, error_callback=None):
+        self._callback = callback
+        self._errorCallback = error_callback
+        self._event = threading.Event()
+        self._success = None
+        self._value = None
+
+    def _set(self, success, value):
+        self._success, self._value = success, value
+        if(success and self._callback is not None):
+            self._callback(value)
+        if(not success and self._errorCallback is not None):
+            self._errorCallback(value)
+        self._event.set()
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        if(not self.ready()):
+            raise ValueError("Task has not finished yet.")
+        return self._success
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        if(not self._event.wait(timeout)):
+            raise TimeoutError("Task did not finish in time.")
+        if(not self._success):
+            raise self._value
+        return self._value
+
+
+def _checkAuthkey(authkey):
+    if(not isinstance(authkey, bytes) or len(authkey) == 0):
+        raise ValueError("authkey has to be a non-empty bytes string, shared by the coordinator and its workers.")
+
+class Coordinator():
+    """
+    Executor that hands batch_map tasks to remote workers (see run_worker). Has the parts of the multiprocess.Pool interface
+    that Batching uses: apply_async, close and join.
+
+    authkey (bytes) has to be given and is checked by every connecting worker. host is the interface to listen on - 127.0.0.1
+    by default, so only workers on this machine can connect. port=0 picks a free port; the address workers should connect to
+    is in self.address. Tasks fail with a TimeoutError if no worker is connected for connectTimeout seconds while they wait.
+    """
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, authkey=None, workerTimeout=WORKER_TIMEOUT, connectTimeout=CONNECT_TIMEOUT):
+        _checkAuthkey(authkey)
+        self.workerTimeout = workerTimeout
+        self.connectTimeout = connectTimeout
+        self._tasks = queue.Queue()
+        self._results = queue.Queue()
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._taskIds = itertools.count()
+        self._pending = {} #taskId -> DistributedResult
+        self._payloads = {} #taskId -> serialised task, kept until it finishes so that it can be requeued
+        self._running = {} #taskId -> workerId
+        self._lastSeen = {} #workerId -> time of its last message
+        self._exited = set() #workers that have said they are exiting
+        self._lastWorkerTime = time.monotonic() #when a worker was last connected, or when there were last no tasks
+
+        manager = BaseManager(address=(host, port), authkey=authkey)
+        manager.register("get_tasks", callable=lambda: self._tasks)
+        manager.register("get_results", callable=lambda: self._results)
+        manager.register("get_closed", callable=lambda: self._closed)
+        self._server = manager.get_server()
+        self.address = (socket.gethostname() if host in ("", "0.0.0.0") else host, self._server.address[1])
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def apply_async(self, func, args=(), kwds={}, callback=None, error_callback=None):
+        if(self._closed.is_set()):
+            raise ValueError("Coordinator is closed.")
+        taskId = next(self._taskIds)
+        result = DistributedResult(callback, error_callback)
+        payload = dill.dumps((func, tuple(args), dict(kwds)), recurse=True) #recurse: also sends the globals a function uses, which remote workers don't have
+        with self._lock:
+            self._pending[taskId] = result
+            self._payloads[taskId] = payload
+        self._tasks.put((taskId, payload))
+        return result
+
+    def _collect(self):
+        #the queues are served until every worker has exited (or timed out), since a worker that is still waiting on a
+        #queue when the server stops would never get an answer
+        while(not (self._closed.is_set() and len(self._pending) == 0 and len(self._lastSeen) == 0)):
+            try:
+                message = self._results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                message = None
+            if(message is not None):
+                self._handle(*message)
+            self._requeueLostTasks()
+            self._failUnservedTasks()
+
+    def _handle(self, kind, workerId, taskId=None, success=None, payload=None):
+        with self._lock:
+            if(workerId in self._exited):
+                return
+            if(kind == "exiting"):
+                self._exited.add(workerId)
+                self._lastSeen.pop(workerId, None)
+                return
+            self._lastSeen[workerId] = time.monotonic()
+            if(kind == "started"):
+                self._running[taskId] = workerId
+                return
+            if(kind != "done" or taskId not in self._pending): #heartbeat, or a requeued task finishing a second time
+                return
+            result = self._pending.pop(taskId)
+            del self._payloads[taskId]
+            self._running.pop(taskId, None)
+        try:
+            value = dill.loads(payload)
+        except Exception as e: #e.g. an exception type that can't be rebuilt here
+            success, value = False, RuntimeError(f"Result of task {taskId} from worker {workerId} could not be deserialised: {e}")
+        result._set(success, value)
+
+    def _requeueLostTasks(self):
+        now = time.monotonic()
+        with self._lock:
+            lostWorkers = [workerId for workerId, lastSeen in self._lastSeen.items() if now-lastSeen > self.workerTimeout]
+            for workerId in lostWorkers:
+                del self._lastSeen[workerId]
+                lostTasks = [taskId for taskId, runningOn in self._running.items() if runningOn == workerId]
+                if(len(lostTasks) != 0):
+                    print(f"Worker {workerId} stopped responding - requeueing {len(lostTasks)} task(s).")
+                for taskId in lostTasks:
+                    del self._running[taskId]
+                    self._tasks.put((taskId, self._payloads[taskId]))
+
+    def _failUnservedTasks(self):
+        now = time.monotonic()
+        with self._lock:
+            if(len(self._lastSeen) != 0 or len(self._pending) == 0):
+                self._lastWorkerTime = now
+                return
+            if(now-self._lastWorkerTime <= self.connectTimeout):
+                return
+            unserved = list(self._pending.values())
+            self._pending.clear()
+            self._payloads.clear()
+            self._running.clear()
+            while(True):
+                try:
+                    self._tasks.get_nowait()
+                except queue.Empty:
+                    break
+        print(f"No worker connected to {self.address[0]}:{self.address[1]} within {self.connectTimeout} s - failing {len(unserved)} task(s).")
+        for result in unserved:
+            result._set(False, TimeoutError(f"No worker connected to the coordinator at {self.address[0]}:{self.address[1]} within {self.connectTimeout} s."))
+
+    def workers(self):
+        """Ids (host:pid) of the workers heard from recently."""
+        with self._lock:
+            return list(self._lastSeen)
+
+    def close(self):
+        """Stops accepting tasks. Workers exit once the tasks already submitted are done (see join)."""
+        self._closed.set()
+
+    def join(self):
+        """Waits for every submitted task to finish and for the workers to exit, then stops serving the queues."""
+        self._collector.join()
+        self._server.stop_event.set()
+
+
+def run_worker(address, authkey, initializer=None):
+    """
+    Pulls tasks from the coordinator at address until it closes (or disappears), running each one in this process.
+    authkey has to match the coordinator's. initializer (optional) is called once before the first task, as with Batching.setup.
+    """
+    _checkAuthkey(authkey)
+    manager = _QueueManager(address=tuple(address), authkey=authkey)
+    manager.connect()
+    tasks = manager.get_tasks()
+    results = manager.get_results()
+    closed = manager.get_closed()
+    workerId = f"{socket.gethostname()}:{os.getpid()}"
+    if(initializer is not None):
+        initializer()
+
+    stopped = threading.Event()
+    def heartbeat():
+        heartbeatResults = manager.get_results() #proxies should not be shared between threads
+        while(not stopped.wait(HEARTBEAT_INTERVAL)):
+            try:
+                heartbeatResults.put(("heartbeat", workerId))
+            except (EOFError, OSError):
+                return
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    try:
+        results.put(("heartbeat", workerId))
+        while(True):
+            try:
+                taskId, payload = tasks.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if(closed.is_set()):
+                    break
+                continue
+            results.put(("started", workerId, taskId))
+            try:
+                func, args, kwds = dill.loads(payload)
+                success, value = True, func(*args, **kwds)
+            except Exception as e:
+                e.add_note(f"Raised on worker {workerId}:\n{traceback.format_exc()}")
+                success, value = False, e
+            try:
+                serialisedValue = dill.dumps(value)
+            except Exception as e:
+                success, serialisedValue = False, dill.dumps(RuntimeError(f"Result of task {taskId} could not be serialised on worker {workerId}: {e}"))
+            results.put(("done", workerId, taskId, success, serialisedValue))
+        stopped.set()
+        results.put(("exiting", workerId)) #lets the coordinator stop serving the queues once every worker has gone
+    except (EOFError, OSError): #the coordinator has gone away
+        return
+    finally:
+        stopped.set()
+
+
+def _importInitializer(path):
+    moduleName, _, functionName = path.rpartition(".")
+    return getattr(importlib.import_module(moduleName), functionName)
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs worker processes for a coordinator (see Distributed.Coordinator).")
+    parser.add_argument("address", help="host:port of the coordinator")
+    parser.add_argument("--authkey", required=True, help="must match the coordinator's authkey")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="number of worker processes to run on this machine")
+    parser.add_argument("--initializer", default=None, help="function called once in each worker before its first task, e.g. Compositions.warm")
+    args = parser.parse_args()
+
+    host, _, port = args.address.rpartition(":")
+    address = (host, int(port))
+    authkey = args.authkey.encode()
+    if(len(authkey) == 0):
+        parser.error("--authkey can't be empty.")
+    initializer = _importInitializer(args.initializer) if args.initializer is not None else None
+
+    import multiprocess
+    processes = [multiprocess.Process(target=run_worker, args=(address, authkey, initializer)) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    print(f"{len(processes)} worker(s) connected to {args.address}.")
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__" and sys.argv[1:2] != ["test"]:
+    main()
+elif __name__ == "__main__": #python Distributed.py test
+    import tempfile
+    import unittest
+    import multiprocess
+    import Batching
+
+    sys.argv = sys.argv[:1]
+    AUTHKEY = b"test"
+    TASKS = [[i, i+1] for i in range(13)]
+    TASKS_RESULTS = [a*b for a, b in TASKS]
+
+    class DistributedTest(unittest.TestCase):
+        """Runs a coordinator and several workers on this machine."""
+        def setUp(self):
+            self.coordinator = Coordinator(host="127.0.0.1", port=0, authkey=AUTHKEY, workerTimeout=3)
+            self.workers = [multiprocess.Process(target=run_worker, args=(self.coordinator.address, AUTHKEY)) for _ in range(3)]
+            for worker in self.workers:
+                worker.start()
+            Batching.set_executor(self.coordinator)
+
+        def tearDown(self):
+            Batching.setup(processes=1) #closes the coordinator, which lets the workers exit
+            for worker in self.workers:
+                worker.join(10)
+                self.assertFalse(worker.is_alive())
+
+        def test_batch_map(self):
+            batches = []
+            tasksDone = []
+            results = Batching.batch_map(lambda a, b: a * b, TASKS, 3, with_task=tasksDone.append, with_batch=batches.append)
+            self.assertListEqual(results, TASKS_RESULTS)
+            self.assertListEqual(batches, [TASKS_RESULTS[i:i+3] for i in range(0, len(TASKS), 3)])
+            self.assertListEqual(sorted(tasksDone), sorted(TASKS_RESULTS))
+
+        def test_errors_reach_the_coordinator(self):
+            def fails(value):
+                raise KeyError(value)
+            with self.assertRaises(KeyError):
+                Batching.batch_map(fails, [1, 2], 2)
+
+        def test_lost_worker_tasks_are_requeued(self):
+            with tempfile.TemporaryDirectory() as directory:
+                marker = os.path.join(directory, "crashed")
+                def crashesOnce(value):
+                    if(value == 3 and not os.path.exists(marker)):
+                        open(marker, "w").close()
+                        os._exit(1) #the worker dies without reporting back
+                    return value * value
+                results = Batching.batch_map(crashesOnce, list(range(6)), 6)
+            self.assertListEqual(results, [value * value for value in range(6)])
+
+        def test_tasks_fail_when_no_worker_connects(self):
+            coordinator = Coordinator(port=0, authkey=AUTHKEY, connectTimeout=1)
+            Batching.set_executor(coordinator)
+            start = time.monotonic()
+            with self.assertRaises(TimeoutError):
+                Batching.batch_map(lambda value: value, [1, 2, 3], 3)
+            Batching.setup(processes=1) #closes and joins the coordinator, which has no tasks or workers left
+            self.assertLess(time.monotonic()-start, 30)
+            joined = Coordinator(port=0, authkey=AUTHKEY, connectTimeout=1) #join returns if nothing was ever submitted, too
+            joined.close()
+            joined.join()
+
+        def test_authkey_is_required(self):
+            self.assertEqual(self.coordinator.address[0], "127.0.0.1")
+            for authkey in (None, b"", ""):
+                with self.assertRaises(ValueError):
+                    Coordinator(port=0, authkey=authkey)
+                with self.assertRaises(ValueError):
+                    run_worker(self.coordinator.address, authkey)
+
+    unittest.main()
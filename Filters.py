@@ -4,28 +4,93 @@ from datetime import datetime
 import os
 import re
 from pymatgen.core.structure import Structure
-from pymatgen.analysis.dimensionality import get_structure_components
-from pymatgen.analysis.local_env import MinimumDistanceNN
 from pymatgen.core.periodic_table import Element
-from robocrys import StructureCondenser
-from Util import SaveDictAsJSON, ReadJSONFile, ListOfTheElements, ConvertJSONresultsToExcel, ConvertJSONresultsToHTML, BlockPrint, EnablePrint
-import smact
+from Util import SaveDictAsJSON, ReadJSONFile, rowwise, is_rowwise, ListOfTheElements, ConvertJSONresultsToExcel, ConvertJSONresultsToHTML, BlockPrint, EnablePrint
 import numpy as np
 import itertools
-from smact.screening import pauling_test
-import pandas as pd
+from functools import wraps
+from contextlib import ExitStack, nullcontext
 
 from Batching import batch_map
+import Perf
+import Profiling
+import Dimensionality
+from StageCache import StageCache, stage_key, directory_state, side_outputs, UNCACHEABLE_FILTERS
+from StructureIndex import StructureIndex, DEDUPLICATION_MODES, representatives, material_id
+from ResultSet import ResultSet, columnar, is_columnar
+from StageIO import (StageFile, ReadStage, SaveStage, StageWriter, EncodeRows, IterStageChunks, StageBlocks, ReadStageBlock, PrefetchChunks, BackgroundWriter,
+                     DEFAULT_STAGE_FORMAT, DEFAULT_CHUNK_SIZE)
+from Compositions import CompositionMatrix, ELEMENT_SET_MODES, elements_where, get_composition, get_element, formula_elements, element_group, cache_stats
+from OxidationStates import species_of, is_charge_balanced, guess_oxidation_states, by_formula
+from StructureEncoding import encode_structure, decode_structure
+from CondensedIndex import CondensedIndex, condensed_features
+
+PARALLEL_BLOCKS_PER_CORE = 2 #see Analysis.ParallelFilterBlocks
+GNOME_ONLY_FILTERS = ["Dimensionality", "GetStructures", "PutStructuresIntoDB"] #read each material's structure from homeDir/by_id/{MaterialId}.CIF, which only GNoME has
 
 class Analysis:
 
-    def __init__(self, searchName:str, orderOfFilters:list, homeDir:str, database:str):
-        #orderOfFilters is the order of the keys from 'filters' dictionary
+    def __init__(self, searchName:str, orderOfFilters:list, homeDir:str, database:str, profileFilters:list=[], profiler:str="cprofile", stageCache:bool=True, chunkSize:int=None,
+                 stageFormat:str=DEFAULT_STAGE_FORMAT, parallelParse:bool=False, limit:int=None, deduplicate:str=None, pipelined:bool=False):
+        #orderOfFilters is the order of the keys from 'filters' dictionary, or of (name, parameters) pairs for the parameterized filters,
+        #e.g. ["Inorganic", ("ContainsAny", ["Cu", "Ni"]), ("Dimensionality", {"dim": 2})] - see ParameterizedFilterRegistry
+        #profileFilters is a list of filter names to run under a profiler (see Profiling.py) - the profiles are written into the search directory
+        #stageCache turns the shared cache of stage results in homeDir/StageCache on or off (see StageCache.py)
+        #chunkSize (optional) turns on out-of-core mode - stages are read, filtered and written chunkSize rows at a time (see StreamFilter)
+        #stageFormat is the format new stage files are saved in (see StageIO.py) - every format can be read whatever this is
+        #parallelParse (with chunkSize) parses the blocks of JSON-lines stages in the Batching worker processes, filtering them there too
+        #limit (optional) stops the search once this many materials have been identified (see LimitedPipeline)
+        #deduplicate (optional) runs the expensive structure analyses once per class of equivalent structures - "fingerprint" or "matcher" (see StructureIndex.py)
+        #pipelined (with chunkSize) overlaps reading, filtering and writing the chunks of a stage (see StreamFilter)
         self.searchName = searchName
         self.database = database
         self.homeDir = homeDir
+        self.profileFilters = profileFilters
+        self.stageCache = StageCache(homeDir) if stageCache else None
+        self.chunkSize = chunkSize
+        self.stageFormat = stageFormat
+        self.parallelParse = parallelParse
+        self.pipelined = pipelined
+        self.limit = limit
+        if(deduplicate is not None and deduplicate not in DEDUPLICATION_MODES):
+            raise ValueError(f"deduplicate is one of {', '.join(DEDUPLICATION_MODES)}, not {deduplicate}.")
+        self.deduplicate = deduplicate
+        self.structureIndex = StructureIndex(homeDir, database, confirm=deduplicate=="matcher") if deduplicate is not None else None
+        self.condensedIndex = CondensedIndex(homeDir, database) #filled by GetCondensedStructures, searched by SimilarTo
+
+        stages = []
+        for counter, filter in enumerate(orderOfFilters):
+            tag, analysisType, params = self.ResolveFilter(filter)
+            if(tag in profileFilters or Analysis.FilterName(filter) in profileFilters):
+                analysisType = Profiling.profiled(analysisType, f"{counter+1}_{tag}", profiler)
+                analysisType.rowwise = False #each call writes a complete profile, so a profiled filter is given the whole stage at once
+            stages.append((tag, analysisType, params))
+
+        counter = 0
+        while(counter < len(stages)):
+            tag, analysisType, params = stages[counter]
+            self.previousFilter = Analysis.FilterTag(orderOfFilters[counter-1])
+            self.previousFilterCounter = counter
+            self.currentFilter = tag
+            self.currentFilterCounter = counter+1
+            prevAnalysisTag = self.previousFilter
+            if(counter==0):
+                if(self.database == "mp"):
+                    prevAnalysisTag = "MPquery"
+                elif(self.database == "gnome"):
+                    prevAnalysisTag = "Database"
+            if(self.limit is not None):
+                pipelineStages = self._pipelineStages(stages, counter)
+                if(len(pipelineStages) != 0):
+                    self.LimitedPipeline(pipelineStages, prevAnalysisTag, counter)
+                    counter += len(pipelineStages)
+                    continue
+            self.ReadAnalyseWrite(analysisType, prevAnalysisTag, tag, counter, params)
+            counter += 1
 
 
+    def FilterRegistry(self) -> dict:
+        """Returns the dictionary of every filter that can be used in orderOfFilters, keyed by name."""
         #########################################################################################################################################################
         #PUT IN NEW FILTERS IN THIS DICTIONARY. Format is "Name": Analysis.functionName  (leave the ones that start with 'self' in the dictionary below as is - they're fine as they are)
         filters = {
@@ -49,61 +114,320 @@ class Analysis:
                     "Contains3orLessElem": Analysis.TernaryOrLessCompoundFilter,
                     "AntiActinide": Analysis.AntiActinideFilter,
                     "ChargeBalance": Analysis.ChargeBalanceFilter,
+                    "ChargeAnnotation": Analysis.ChargeAnnotationFilter,       #Adds the guessed oxidation states of each material
                     "GetStructures": self.GetStructures                        #Acquires the structures for the results for the previous filter
         }
         #########################################################################################################################################################
+        return filters
 
-        for counter, filter in enumerate(orderOfFilters):
-            self.previousFilter = orderOfFilters[counter-1]
-            self.previousFilterCounter = counter
-            self.currentFilter = orderOfFilters[counter]
-            self.currentFilterCounter = counter+1
-            if(counter==0):
-                if(self.database == "mp"):
-                    firstFilterName = "MPquery"
-                elif(self.database == "gnome"):
-                    firstFilterName = "Database"
-                self.ReadAnalyseWrite(filters[filter], firstFilterName, filter, counter)
-            else:
-                self.ReadAnalyseWrite(filters[filter], orderOfFilters[counter-1], filter, counter)
 
+    def ParameterizedFilterRegistry(self) -> dict:
+        """
+        Returns the dictionary of every filter that takes parameters, keyed by name. Each takes (results, parameters).
+
+        These are used in orderOfFilters as (name, parameters) pairs, e.g.
+            ("ContainsAny", ["Cu", "Ni"])            - saves materials that contain Cu or Ni
+            ("ExcludeAll", ["C", "H"])               - removes materials that contain both C and H
+            ("ContainsAny", ["transition_metal"])    - element groups from Compositions.ELEMENT_GROUPS can be used in place of symbols
+            ("Dimensionality", {"dim": 2})           - dictionaries are passed on as keyword arguments
+        and their stages are named after both, e.g. 2_ContainsAny-Cu-Ni.json (see FilterTag).
+        """
+        filters = {mode: rowwise(lambda results, elements, mode=mode: Analysis.ElementSetFilter(results, mode, elements)) for mode in ELEMENT_SET_MODES} #see CompositionMatrix.element_set_mask
+        filters.update({
+                    "NElements": rowwise(lambda results, params: Analysis.NElementsFilter(results, **params)),      #e.g. {"minElements": 2, "maxElements": 3}
+                    "AmountRatio": rowwise(lambda results, params: Analysis.AmountRatioFilter(results, **params)),  #e.g. {"maxRatio": 5}
+                    "MXeneRatio": rowwise(lambda results, params: Analysis.MXeneRatioFilter(results, **params)),    #e.g. {"ratios": [[2, 1], [3, 2]], "XElements": ["C"], "anyPair": True}
+                    "SimilarTo": lambda results, params: self.SimilarToFilter(results, **params),                   #e.g. {"reference": "mp-2815", "top": 20}
+                    "Range": Analysis.ColumnRangeFilter,                                                        #e.g. {"nsites": [None, 20], "Decomposition Energy Per Atom": [None, 0]}
+                    "OneOf": Analysis.ColumnValueFilter,                                                        #e.g. {"spacegroup.crystal_system": ["hexagonal", "trigonal"]}
+                    "Dimensionality": rowwise(lambda results, params: self.DimensionalityFilter(results, requiredDim=params.get("dim", 2),  #e.g. {"dim": 2, "verify": True}
+                                                                                                prescreen=params.get("prescreen", True), verify=params.get("verify", False),
+                                                                                                backend=params.get("backend", Dimensionality.DEFAULT_NEIGHBOR_BACKEND)))
+        })
+        return filters
+
+    @staticmethod
+    def FilterName(filter) -> str:
+        """The registry name of an orderOfFilters entry - the entry itself, or the name of a (name, parameters) pair."""
+        return filter if isinstance(filter, str) else filter[0]
 
-    def ReadAnalyseWrite(self, analysisType, prevAnalysisTag, newAnalysisTag, numberInQueue): #numberInQueue is to show the order each filter was applied in
+    @staticmethod
+    def FilterTag(filter) -> str:
+        """
+        The analysis tag of an orderOfFilters entry, used to name its stage files.
+
+        Parameterized filters are tagged with their name and parameters, keeping only characters that are safe in file names on every OS:
+            ("ContainsAny", ["Cu", "Ni"]) -> "ContainsAny-Cu-Ni"
+            ("Dimensionality", {"dim": 2}) -> "Dimensionality-dim=2"
+        """
+        if(isinstance(filter, str)):
+            return filter
+        name, params = filter
+        def tagValue(value):
+            if(isinstance(value, (list, tuple))):
+                return ",".join(f"({tagValue(item)})" if isinstance(item, (list, tuple)) else tagValue(item) for item in value)
+            return str(value)
+        if(isinstance(params, dict)):
+            parts = [f"{key}={tagValue(value)}" for key, value in params.items()]
+        else:
+            parts = [tagValue(param) for param in params]
+        return re.sub(r"[^A-Za-z0-9_.,=()+-]", "", "-".join([name] + parts))
+
+    def ResolveFilter(self, filter):
+        """Returns (analysis tag, filter function taking only results, parameters) for an orderOfFilters entry."""
+        if(isinstance(filter, str)):
+            filters = self.FilterRegistry()
+            if(filter not in filters):
+                raise ValueError(f"Filter {filter} is not recognised. Options are: {', '.join(filters)}")
+            return filter, filters[filter], None
+        if(not isinstance(filter, (tuple, list)) or len(filter) != 2):
+            raise ValueError(f"Parameterized filters are given as (name, parameters) pairs, not {filter}.")
+        name, params = filter
+        filters = self.ParameterizedFilterRegistry()
+        if(name not in filters):
+            raise ValueError(f"Parameterized filter {name} is not recognised. Options are: {', '.join(filters)}")
+        function = filters[name]
+        @wraps(function) #so the stage cache fingerprints the registered function
+        def analysisType(results):
+            return function(results, params)
+        return Analysis.FilterTag(filter), analysisType, params
+
+
+    def ReadAnalyseWrite(self, analysisType, prevAnalysisTag, newAnalysisTag, numberInQueue, params=None): #numberInQueue is to show the order each filter was applied in
         """AnalysisType is the name of the method used to analyse the data, e.g. NonPolar.
            prevAnalysisTag is the text appeneded to the end of the analysis file you want to load.
-           newAnalysisTag that will be appended to the end of the analysis file you want to create."""
+           newAnalysisTag that will be appended to the end of the analysis file you want to create.
+           params are the parameters of a parameterized filter (None otherwise)."""
         
-        if(not os.path.isfile(f"{numberInQueue+1}_{newAnalysisTag}.json")):
+        if(StageFile(f"{numberInQueue+1}_{newAnalysisTag}") is None): #in any format
             print(f"\nStarting {newAnalysisTag} analysis:")
-            results = ReadJSONFile(f"{numberInQueue}_{prevAnalysisTag}")
-            analysisResults = analysisType(results)
-            SaveDictAsJSON(f"{numberInQueue+1}_{newAnalysisTag}", analysisResults)
-            if(self.database == "mp"):
-                ConvertJSONresultsToHTML(f"{numberInQueue+1}_{newAnalysisTag}")
-            elif(self.database == "gnome"):
-                ConvertJSONresultsToExcel(f"{numberInQueue+1}_{newAnalysisTag}")
-            print(f"{newAnalysisTag} analysis complete.")
-            # ^ numberInQueue+1 starts from 1, hence numberInQueue without the +1 is the previous numberInQueue
-            if(type(results) == dict):
-                numOfMatInPrevAnal = len(list(results.keys()))
-                numOfMatInCurrentAnal = len(list(analysisResults.keys()))
-            elif(type(results) == list):
-                numOfMatInPrevAnal = len(results)
-                numOfMatInCurrentAnal = len(analysisResults)
-            print(f"{numOfMatInCurrentAnal} materials identified.")
-            print(f"{numOfMatInPrevAnal-numOfMatInCurrentAnal} materials removed from previous analysis ({prevAnalysisTag}).")
-            #logging
-            with open("SearchLog.txt", mode="a") as f:
-                f.write(f"{newAnalysisTag}: {numOfMatInCurrentAnal}\n")
+            prevFileName = f"{numberInQueue}_{prevAnalysisTag}"
+            newFileName = f"{numberInQueue+1}_{newAnalysisTag}"
+
+            #the same filter may already have been applied to identical data, in this search or another one
+            cacheKey = None
+            cached = None
+            if(self.stageCache is not None and newAnalysisTag.split("-")[0] not in UNCACHEABLE_FILTERS): #parameterized filters are tagged "{name}-{parameters}"
+                cacheKey = stage_key(StageFile(prevFileName), newAnalysisTag, analysisType, self.CacheParams(params))
+                if(newAnalysisTag not in self.profileFilters and newAnalysisTag.split("-")[0] not in self.profileFilters): #a profiled filter has to actually run - profileFilters can name it with or without its parameters
+                    with Perf.stage(newAnalysisTag, "stage_cache_fetch") as perfEntry:
+                        cached = self.stageCache.fetch(cacheKey, newFileName)
+                        perfEntry["hit"] = cached is not None
+
+            if(cached is not None):
+                print(f"{newAnalysisTag} results taken from the stage cache (first computed in search {cached['search']}).")
+                numOfMatInPrevAnal = cached["rows_in"]
+                numOfMatInCurrentAnal = cached["rows_out"]
+            else:
+                before = directory_state() if cacheKey is not None else None #to find the files the stage writes besides its output
+                if(self.chunkSize is not None and is_rowwise(analysisType)): #out-of-core - only one chunk of the stage is in memory at a time
+                    numOfMatInPrevAnal, numOfMatInCurrentAnal = self.StreamFilter(analysisType, prevFileName, newFileName, newAnalysisTag)
+                else:
+                    if(self.chunkSize is not None):
+                        print(f"{newAnalysisTag} needs the whole of the previous stage at once, so it is read into memory.")
+                    with Perf.stage(newAnalysisTag, "read", bytes_read=Perf.file_size(StageFile(prevFileName))) as perfEntry:
+                        results = ReadStage(prevFileName)
+                        perfEntry["rows_out"] = len(results)
+                    if(self.limit is not None and len(results) > self.limit): #e.g. a filter that needs whole stages at the start of a limited search
+                        print(f"{newAnalysisTag} needs the whole of the previous stage at once, so it is only given the first {self.limit} materials.")
+                        results = results[:self.limit]
+                    with Perf.stage(newAnalysisTag, "filter", rows_in=len(results)) as perfEntry:
+                        filterInput = ResultSet.from_records(results) if is_columnar(analysisType) else results #@columnar filters take a ResultSet
+                        analysisResults = ResultSet.as_records(analysisType(filterInput))
+                        perfEntry["columnar"] = filterInput is not results
+                        perfEntry["rows_out"] = len(analysisResults)
+                        perfEntry["caches"] = cache_stats() #cumulative over the whole run
+                    with Perf.stage(newAnalysisTag, "write", rows_in=len(analysisResults), format=self.stageFormat) as perfEntry:
+                        perfEntry["bytes_written"] = Perf.file_size(SaveStage(newFileName, analysisResults, self.stageFormat))
+                    # ^ numberInQueue+1 starts from 1, hence numberInQueue without the +1 is the previous numberInQueue
+                    if(type(results) == dict):
+                        numOfMatInPrevAnal = len(list(results.keys()))
+                        numOfMatInCurrentAnal = len(list(analysisResults.keys()))
+                    elif(type(results) == list):
+                        numOfMatInPrevAnal = len(results)
+                        numOfMatInCurrentAnal = len(analysisResults)
+                    del results, filterInput, analysisResults #not needed for the report, which is made from the stage file
+                self.ReportStage(newFileName, newAnalysisTag, numOfMatInCurrentAnal)
+                if(cacheKey is not None):
+                    self.stageCache.store(cacheKey, newFileName, {"search": self.searchName, "filter": newAnalysisTag,
+                                                                  "rows_in": numOfMatInPrevAnal, "rows_out": numOfMatInCurrentAnal},
+                                          side_outputs(before, newFileName))
+            self.LogStage(newAnalysisTag, prevAnalysisTag, numOfMatInPrevAnal, numOfMatInCurrentAnal)
         else:
             print(f"{newAnalysisTag} analysis has already been done for search {self.searchName}.")
 
+    def CacheParams(self, params):
+        """What goes into a stage's cache key besides its filter parameters - the search options that can change its output."""
+        if(self.limit is None and self.deduplicate is None):
+            return params
+        return {"params": params, "limit": self.limit, "deduplicate": self.deduplicate}
+
+    def ReportStage(self, newFileName, newAnalysisTag, numOfMatInCurrentAnal):
+        """Writes the report (HTML for MP, Excel for GNoME) for a stage file that has just been written."""
+        with Perf.stage(newAnalysisTag, "report", rows_in=numOfMatInCurrentAnal) as perfEntry:
+            if(self.database == "mp"):
+                ConvertJSONresultsToHTML(newFileName, self.chunkSize)
+                perfEntry["bytes_written"] = Perf.file_size(f"{newFileName}.html")
+            elif(self.database == "gnome"):
+                ConvertJSONresultsToExcel(newFileName, self.chunkSize)
+                perfEntry["bytes_written"] = Perf.file_size(f"{newFileName}.xlsx")
+        print(f"{newAnalysisTag} analysis complete.")
+
+    def LogStage(self, newAnalysisTag, prevAnalysisTag, numOfMatInPrevAnal, numOfMatInCurrentAnal):
+        print(f"{numOfMatInCurrentAnal} materials identified.")
+        print(f"{numOfMatInPrevAnal-numOfMatInCurrentAnal} materials removed from previous analysis ({prevAnalysisTag}).")
+        #logging
+        with open("SearchLog.txt", mode="a") as f:
+            f.write(f"{newAnalysisTag}: {numOfMatInCurrentAnal}\n")
+
+
+    def StreamFilter(self, analysisType, prevFileName, newFileName, newAnalysisTag):
+        """
+        Out-of-core version of the read, filter and write steps of ReadAnalyseWrite, for filters marked @rowwise.
+        The previous stage is read self.chunkSize rows at a time and each chunk is filtered and appended to the new stage file before the next
+        is read, so peak memory is set by the chunk size rather than by the size of the stage. The new stage file is identical to the one
+        ReadAnalyseWrite would write in one go. Returns (rows read, rows kept) for the whole stage.
+
+        With pipelined, the next chunk is read and decoded, and the previous one encoded and written, in background threads while this one
+        is filtered (see StageIO.PrefetchChunks and StageIO.BackgroundWriter). The files written are the same.
+
+        With parallelParse, a previous stage saved in a JSON-lines format (with its index) is instead handed to the Batching worker processes
+        a block at a time - each worker parses and filters its blocks and sends back only the rows kept, already encoded, which are written in order.
+        """
+        totals = {"rows_in": 0, "rows_out": 0, "chunks": 0}
+        blocks = StageBlocks(prevFileName) if self.parallelParse else None
+        with Perf.stage(newAnalysisTag, "stream", bytes_read=Perf.file_size(StageFile(prevFileName)), chunk_size=self.chunkSize,
+                        format=self.stageFormat, parallel=blocks is not None, pipelined=self.pipelined) as perfEntry:
+            with StageWriter(newFileName, self.stageFormat) as stageWriter, BackgroundWriter(stageWriter) if self.pipelined else nullcontext(stageWriter) as writer:
+                if(blocks is not None):
+                    for encodedResults in Analysis.ParallelFilterBlocks(analysisType, *blocks, self.stageFormat, totals, newAnalysisTag):
+                        writer.writeEncoded(*encodedResults)
+                else:
+                    chunks = IterStageChunks(prevFileName, self.chunkSize)
+                    for analysisResults in Analysis.FilterChunks(analysisType, PrefetchChunks(chunks) if self.pipelined else chunks, totals):
+                        writer.write(analysisResults)
+            perfEntry.update(totals)
+            perfEntry["bytes_written"] = Perf.file_size(writer.path)
+            perfEntry["caches"] = cache_stats() #cumulative over the whole run
+        return totals["rows_in"], totals["rows_out"]
+
+    @staticmethod
+    def FilterChunks(analysisType, chunks, totals):
+        """Generator applying a @rowwise filter to each chunk of a stage in turn. The rows in and out are added up in totals."""
+        for chunk in chunks:
+            filterInput = ResultSet.from_records(chunk) if is_columnar(analysisType) else chunk #@columnar filters take a ResultSet
+            analysisResults = ResultSet.as_records(analysisType(filterInput))
+            totals["rows_in"] += len(chunk)
+            totals["rows_out"] += len(analysisResults)
+            totals["chunks"] += 1
+            yield analysisResults
+
+    @staticmethod
+    def _filterBlock(analysisType, path, block, stageFormat):
+        #runs in a worker process - the rows kept are sent back encoded, which is much cheaper to pass between processes than the rows themselves
+        totals = {"rows_in": 0, "rows_out": 0, "chunks": 0}
+        analysisResults = next(Analysis.FilterChunks(analysisType, [ReadStageBlock(path, block)], totals))
+        return totals, EncodeRows(analysisResults, stageFormat)
+
+    @staticmethod
+    def ParallelFilterBlocks(analysisType, path, blocks, stageFormat, totals, stageName):
+        """
+        Generator like FilterChunks, with the blocks of a JSON-lines stage file parsed and filtered in the worker processes, a few per core at a time.
+        Yields the rows kept from each block encoded for a StageWriter for stageFormat (see StageIO.EncodeRows), in order.
+        """
+        window = PARALLEL_BLOCKS_PER_CORE*(os.cpu_count() or 1) #blocks in flight at once, which bounds how many rows are held here
+        for start in range(0, len(blocks), window):
+            tasks = [[analysisType, path, block, stageFormat] for block in blocks[start:start+window]]
+            for blockTotals, encodedResults in batch_map(Analysis._filterBlock, tasks, len(tasks), stage_name=stageName):
+                for key in totals:
+                    totals[key] += blockTotals[key]
+                yield encodedResults
+
+
+    def _pipelineStages(self, stages, counter):
+        """The stages from counter on that LimitedPipeline can run together - @rowwise filters, up to the first stage that needs the whole of its input or has already been done."""
+        pipelineStages = []
+        for n, (tag, analysisType, params) in enumerate(stages[counter:]):
+            if(not is_rowwise(analysisType) or StageFile(f"{counter+n+1}_{tag}") is not None):
+                break
+            pipelineStages.append((tag, analysisType, params))
+        return pipelineStages
+
+    def LimitedPipeline(self, stages, prevAnalysisTag, numberInQueue):
+        """
+        Runs consecutive @rowwise filters (stages, a list of (tag, filter, parameters)) together, for searches with a limit.
+        The previous stage is read a chunk at a time and each chunk is passed through every filter in turn, each filter's output being appended
+        to its own stage file. Reading stops as soon as the last filter has kept self.limit materials, so a quick look at the first few matches
+        doesn't cost a pass over the whole database. Chunks start at self.limit rows and double up to the chunk size (chunkSize or
+        StageIO.DEFAULT_CHUNK_SIZE), so little more than needed is read however selective the filters are.
+
+        The last stage holds the first self.limit materials to pass every filter (all of them if there are fewer); the stages before it hold every
+        material they kept from the part of the previous stage that was read. These stages are not taken from or added to the stage cache.
+        """
+        tags = [tag for tag, _, _ in stages]
+        prevFileName = f"{numberInQueue}_{prevAnalysisTag}"
+        newFileNames = [f"{numberInQueue+n+1}_{tag}" for n, tag in enumerate(tags)]
+        totals = [{"rows_in": 0, "rows_out": 0, "chunks": 0} for _ in stages]
+        print(f"\nStarting {', '.join(tags)} analysis, stopping once {self.limit} materials have been identified:")
+        with Perf.stage(tags[-1], "pipeline", bytes_read=Perf.file_size(StageFile(prevFileName)), stages=tags, limit=self.limit,
+                        format=self.stageFormat) as perfEntry:
+            with ExitStack() as writers:
+                stageWriters = [writers.enter_context(StageWriter(newFileName, self.stageFormat)) for newFileName in newFileNames]
+                numOfMatIdentified = 0
+                chunks = Analysis.GrowingChunks(IterStageChunks(prevFileName, min(self.limit, self.chunkSize or DEFAULT_CHUNK_SIZE)), self.chunkSize or DEFAULT_CHUNK_SIZE)
+                for chunk in chunks:
+                    for (tag, analysisType, params), writer, stageTotals in zip(stages, stageWriters, totals):
+                        chunk = next(Analysis.FilterChunks(analysisType, [chunk], stageTotals))
+                        if(writer is stageWriters[-1]):
+                            stageTotals["rows_in"] -= max(len(chunk)-(self.limit-numOfMatIdentified), 0) #materials kept beyond the limit are dropped, not removed by the filter
+                            chunk = chunk[:self.limit-numOfMatIdentified]
+                            numOfMatIdentified += len(chunk)
+                        writer.write(chunk)
+                        if(len(chunk) == 0):
+                            break
+                    if(numOfMatIdentified >= self.limit):
+                        break
+                chunks.close() #closes the previous stage file without reading the rest of it
+            totals[-1]["rows_out"] = numOfMatIdentified
+            perfEntry["rows_in"] = totals[0]["rows_in"]
+            perfEntry["rows_out"] = numOfMatIdentified
+            perfEntry["stage_rows"] = {tag: [stageTotals["rows_in"], stageTotals["rows_out"]] for tag, stageTotals in zip(tags, totals)}
+            perfEntry["caches"] = cache_stats() #cumulative over the whole run
+
+        for tag, newFileName, stageTotals in zip(tags, newFileNames, totals):
+            self.ReportStage(newFileName, tag, stageTotals["rows_out"])
+        if(numOfMatIdentified >= self.limit):
+            print(f"Limit of {self.limit} materials reached after reading {totals[0]['rows_in']} materials from {prevAnalysisTag}.")
+        previousTags = [prevAnalysisTag] + tags[:-1]
+        for tag, previousTag, stageTotals in zip(tags, previousTags, totals):
+            print(f"{tag}:")
+            self.LogStage(tag, previousTag, stageTotals["rows_in"], stageTotals["rows_out"])
+
+    @staticmethod
+    def GrowingChunks(chunks, maxChunkSize):
+        """Joins up consecutive chunks so each one is twice as big as the one before, up to maxChunkSize rows."""
+        chunkSize = None
+        pending = []
+        for chunk in chunks:
+            pending += chunk
+            chunkSize = chunkSize or len(chunk)
+            if(len(pending) >= chunkSize):
+                yield pending
+                pending = []
+                chunkSize = min(2*chunkSize, maxChunkSize)
+        if(len(pending) != 0):
+            yield pending
+
 
 #########################################################################################################################################################
 #This where you'll define your filters. So that the code functions, you need to write your filters in a specific way:
 #   1) Indented by 1 (this is so that the function is inside the Analysis class)
 #   2) With "@staticmethod" written above the function (see below). Only deviate from this if you know what you're doing and are familiar with Python classes.
 #   3) All filters have only one positional argument - results. See InorganicFilter and DimensionalityFilter.
+#   4) (Optional) With "@columnar" written below "@staticmethod", the filter is given a ResultSet (see ResultSet.py) instead of a list of dictionaries,
+#      so it can select rows with NumPy masks, e.g. return results.select(results["nsites"] <= 20). Looping over it still works as for a list.
+#   5) (Optional) With "@rowwise" written below "@staticmethod", the filter is marked as keeping or removing each material independently of the others,
+#      so in out-of-core mode (chunkSize) it is given the stage a chunk at a time rather than all at once.
 
     @staticmethod
     def _containsHalogen(formula):
@@ -112,7 +436,7 @@ class Analysis:
 
         This is the core function of ContainsHalogenFilter.
         """
-        elemsInFormula = list(Composition(formula).as_dict().keys())
+        elemsInFormula = formula_elements(formula)
         halogens = ["F", "Cl", "Br", "I", "At"]
         if(set(elemsInFormula) & set(halogens)):
             return True
@@ -120,20 +444,16 @@ class Analysis:
             return False
     
     @staticmethod
+    @rowwise
     def ContainsHalogenFilter(results):
         """
         Halogen filter.
 
         This function only saves materials that contain a halogen.
 
-        This function is dependant on the _containsHalogen function.
+        This function uses ElementSetFilter, which gives the same results as looping over the _containsHalogen function.
         """
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Analysis._containsHalogen(formula)):
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ContainsAny", ["halogen"])
     
     @staticmethod
     def _containsOxygen(formula):
@@ -142,7 +462,7 @@ class Analysis:
 
         This is the core function of ContainsOxygenFilter.
         """
-        elemsInFormula = list(Composition(formula).as_dict().keys())
+        elemsInFormula = formula_elements(formula)
         oxygen = ["O"]
         if(set(elemsInFormula) & set(oxygen)):
             return True
@@ -150,20 +470,16 @@ class Analysis:
             return False
     
     @staticmethod
+    @rowwise
     def ContainsOxygenFilter(results):
         """
         Oxygen filter.
 
         This function only saves materials that contain oxygen.
 
-        This function is dependant on the _containsOxygen function.
+        This function uses ElementSetFilter, which gives the same results as looping over the _containsOxygen function.
         """
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Analysis._containsOxygen(formula)):
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ContainsAny", ["O"])
 
     def _getStructure(self, result):
         """
@@ -186,7 +502,7 @@ class Analysis:
         
         This function returns False if C and H are both present in the formula of a material, and True otherwise.
         """
-        elems = list(Composition(formula).as_dict().keys())
+        elems = formula_elements(formula)
         if("C" in elems and "H" in elems):
             status=False
         else:
@@ -194,45 +510,91 @@ class Analysis:
         return status
 
     @staticmethod
+    @rowwise
     def InorganicFilter(results):
         """
         Inorganic filter.
 
         This function only saves materials that do not contain both C and H based on their formula.
 
-        This function is dependant on the _checkInorganic function.
+        This function uses ElementSetFilter, which gives the same results as looping over the _checkInorganic function.
         """
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Analysis._checkInorganic(formula)): #returns True if not organic (if C and H aren't both in the formula)
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ExcludeAll", ["C", "H"])
 
     @staticmethod
-    def _get_dimensionality(structure):
+    def _get_dimensionality(structure, backend=Dimensionality.DEFAULT_NEIGHBOR_BACKEND):
         """
         The core of the DimensionalityFilter filter.
         
-        Input: Pymatgen structure object.
+        Input: Pymatgen structure object, and (optionally) how to find the neighbours of its sites - see Dimensionality.NEIGHBOR_BACKENDS.
         Output: Overall dimensionality for the structure.
         """
-        mdd = MinimumDistanceNN()
-        structure_copy = structure.copy()
-        bonded_structure = mdd.get_bonded_structure(structure_copy) #make StructureGraph
+        from pymatgen.analysis.dimensionality import get_structure_components #imported when first needed, as it takes a couple of seconds
+        bonded_structure = Dimensionality.bonded_structure(structure, backend) #make StructureGraph (the same one MinimumDistanceNN().get_bonded_structure makes)
         return max(x["dimensionality"] for x in get_structure_components(bonded_structure))
         #^ Alex says that he takes the “max” of the dimensionalities at the end because that is just to be consistent with the robocrys
         #condense function (e.g., what do you do when there are more than one bonded component in the structure with different
         #dimensionalities, safest is just to take the max dimensionality).
 
-    def DimensionalityFilter(self, results, requiredDim=2):
+    @staticmethod
+    def _dimensionality(structure, stats, prescreen=True, verify=False, materialId=None, backend=Dimensionality.DEFAULT_NEIGHBOR_BACKEND):
+        """
+        The dimensionality of a structure, from the fast pre-screen in Dimensionality.py where it can classify the structure and
+        from _get_dimensionality otherwise.
+
+        With verify=True the exact analysis is run for every structure, its result is the one returned, and any disagreement with
+        the pre-screen is recorded in stats (a Dimensionality.PrescreenStats).
+        """
+        dim, reason = None, "prescreen off"
+        if(prescreen):
+            try:
+                dim, reason = Dimensionality.prescreen_dimensionality(structure)
+            except Exception:
+                dim, reason = None, "prescreen failed"
+        stats.add(reason)
+        if(dim is None):
+            return Analysis._get_dimensionality(structure, backend)
+        if(verify):
+            exactDim = Analysis._get_dimensionality(structure, backend)
+            stats.add_verification(materialId, dim, exactDim)
+            return exactDim
+        return dim
+
+    @staticmethod
+    def _saveProblemChildren(fileName, problemChildren):
+        """
+        Adds problemChildren to fileName.json, keeping the ones already there - a @rowwise filter is called once per chunk of a stage,
+        so each call only has the problem children of its own chunk. A material that is already in the file (e.g. when a stage is
+        run again) is replaced rather than repeated.
+        """
+        if(os.path.isfile(fileName+".json")):
+            newIds = {material_id(result) for result in problemChildren}
+            problemChildren = [result for result in ReadJSONFile(fileName) if material_id(result) not in newIds] + problemChildren
+        SaveDictAsJSON(fileName, problemChildren)
+
+    @staticmethod
+    def _reportPrescreen(stats, perfEntry):
+        summary = stats.summary()
+        perfEntry.update(summary)
+        print(f"Dimensionality pre-screen classified {summary['skipped_exact']}/{summary['structures']} structures without the full bonding analysis.")
+        if("verified" in summary):
+            print(f"Pre-screen checked against the exact analysis for {summary['verified']} structures: {len(summary['mismatches'])} mismatch(es).")
+            for materialId, prescreenedDim, exactDim in summary["mismatches"]:
+                print(f"    {materialId}: pre-screen {prescreenedDim}, exact {exactDim}")
+
+    @rowwise
+    def DimensionalityFilter(self, results, requiredDim=2, prescreen=True, verify=False, backend=Dimensionality.DEFAULT_NEIGHBOR_BACKEND):
         """
         Dimensionality filter.
 
         This function only saves materials that have an overall dimensionality equal to the requiredDim named argument (by default set to 2 as an example).
 
-        This function is dependant on the _get_dimensionality function.
+        This function is dependant on the _get_dimensionality function, which is skipped for the structures that the pre-screen in Dimensionality.py
+        can classify (prescreen=False turns the pre-screen off). verify=True runs both and reports any disagreement, e.g.
+        ("Dimensionality", {"dim": 2, "verify": True}) in orderOfFilters. backend chooses how the exact analysis finds neighbours
+        (see Dimensionality.NEIGHBOR_BACKENDS) - "pymatgen" is the original site-by-site MinimumDistanceNN search.
         """
+        stats = Dimensionality.PrescreenStats()
 
         # Adding a counter because I'd like to know if this filter is still working or if the program died. This is a VERY slow filter.
         counter = 0
@@ -241,30 +603,45 @@ class Analysis:
         # Filter code as normal (with try/except blocks since this filter has been known to ocassionally fail)
         filteredResults=[]
         problemChildren = [] #I've done a search before where the search just keeled over on a certain material (a problem child) - this is why we need a problem children bin.
-        for result in results:
-            struct = self._getStructure(result)
-            try:
-                dim = self._get_dimensionality(struct)
-                if(dim==requiredDim):
+        with Perf.stage(Perf.current_stage(), "dimensionality", rows_in=numOfResults, prescreen=prescreen, verify=verify, backend=backend) as perfEntry:
+            #with deduplicate, the dimensionality is only worked out for the first material of each class of equivalent structures (see StructureIndex.py)
+            if(self.structureIndex is not None):
+                classIds, structures = self.structureIndex.classify(results, self._getStructure)
+                self.structureIndex.save()
+                dims = self.structureIndex.memo(("dimensionality", prescreen, verify, backend)) #class id -> dimensionality (None if it failed)
+                perfEntry["structure_classes"] = len(set(classIds))
+            else:
+                classIds, structures, dims = range(numOfResults), {}, {}
+            for result, classId, i in zip(results, classIds, itertools.count()):
+                if(classId not in dims):
+                    struct = structures.pop(i) if i in structures else self._getStructure(result)
+                    try:
+                        dims[classId] = self._dimensionality(struct, stats, prescreen, verify, result.get("MaterialId"), backend)
+                    except:
+                        dims[classId] = None
+                dim = dims[classId]
+                if(dim is None):
+                    result["FailedOnFilter"] = "Dim"
+                    problemChildren.append(result)
+                elif(dim==requiredDim):
                     result["dim"] = dim
                     filteredResults.append(result)
-            except:
-                result["FailedOnFilter"] = "Dim"
-                problemChildren.append(result)
 
-            # Incrementing the counter
-            counter += 1
-            if(counter%100==0): #print info on progress every 100 entries
-                now = datetime.now()
-                current_time = now.strftime("%H:%M:%S")
-                print(f"[{current_time}]: {counter}/{numOfResults}")
+                # Incrementing the counter
+                counter += 1
+                if(counter%100==0): #print info on progress every 100 entries
+                    now = datetime.now()
+                    current_time = now.strftime("%H:%M:%S")
+                    print(f"[{current_time}]: {counter}/{numOfResults}")
+            self._reportPrescreen(stats, perfEntry)
 
         if(len(problemChildren)!=0):
-            SaveDictAsJSON("ProblemChildren_Dim", problemChildren)
+            self._saveProblemChildren("ProblemChildren_Dim", problemChildren)
         return filteredResults
 
     @staticmethod
-    def DimensionalityIdentifier(results):
+    @rowwise
+    def DimensionalityIdentifier(results, prescreen=True, verify=False, backend=Dimensionality.DEFAULT_NEIGHBOR_BACKEND):
         """
         Important to note, this identifier removes 0D materials
         #(w.r.t. the special atom and its neighbours), but
@@ -275,18 +652,21 @@ class Analysis:
         structures = [struct["structure"] for struct in results]
         filteredResults=[]
         problemChildren = [] #I've done a search where a search has just keeled over on a certain material - this is why we need a problem children bin.
-        for i in range(len(results)):
-            struct = structures[i]
-            try:
-                dim = Analysis._get_dimensionality(struct)
-                results[i]["dim"] = dim
-                filteredResults.append(results[i])
-            except:
-                results[i]["FailedOnFilter"] = "Dim"
-                problemChildren.append(results[i])
+        stats = Dimensionality.PrescreenStats()
+        with Perf.stage(Perf.current_stage(), "dimensionality", rows_in=len(results), prescreen=prescreen, verify=verify, backend=backend) as perfEntry:
+            for i in range(len(results)):
+                struct = structures[i]
+                try:
+                    dim = Analysis._dimensionality(struct, stats, prescreen, verify, results[i].get("MaterialId"), backend)
+                    results[i]["dim"] = dim
+                    filteredResults.append(results[i])
+                except:
+                    results[i]["FailedOnFilter"] = "Dim"
+                    problemChildren.append(results[i])
+            Analysis._reportPrescreen(stats, perfEntry)
         if(len(problemChildren)!=0):
             problemChildren = Analysis._storeStructures(problemChildren)
-            SaveDictAsJSON("ProblemChildren_Dim", problemChildren)
+            Analysis._saveProblemChildren("ProblemChildren_Dim", problemChildren)
         filteredResults = Analysis._storeStructures(filteredResults)
         return filteredResults
 
@@ -297,27 +677,23 @@ class Analysis:
 
         This is the core function of Ni_or_CuFilter.
         """
-        elems = list(Composition(formula).as_dict().keys())
+        elems = formula_elements(formula)
         if("Cu" in elems or "Ni" in elems):
             return True
         else:
             return False
     
     @staticmethod
+    @rowwise
     def Ni_or_CuFilter(results):
         """
         Ni or Cu filter.
 
         This function only saves materials that contain Ni or Cu.
 
-        This function is dependant on the _containsCu_or_Ni function.
+        This function uses ElementSetFilter, which gives the same results as looping over the _containsCu_or_Ni function.
         """
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Analysis._containsCu_or_Ni(formula)):
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ContainsAny", ["Cu", "Ni"])
 
     @staticmethod
     def _containsMetal(formula):
@@ -326,59 +702,116 @@ class Analysis:
 
         This is the core function of ContainsMetalFilter.
         """
-        elemsInFormula = list(Composition(formula).as_dict().keys())
-        allElems = ListOfTheElements()
-        metals = [elem for elem in allElems if Element(elem).is_metal]
+        elemsInFormula = formula_elements(formula)
+        metals = element_group("metal")
         if(set(elemsInFormula) & set(metals)): #if formula contains a metal
             return True
         else:
             return False
     
     @staticmethod
+    @rowwise
     def ContainsMetalFilter(results):
         """
         Metal filter.
 
         This function only saves materials that contain a metal.
 
-        This function is dependant on the _containsMetal function.
+        This function uses ElementSetFilter, which gives the same results as looping over the _containsMetal function.
         """
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Analysis._containsMetal(formula)):
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ContainsAny", ["metal"])
     
 
     
     @staticmethod
+    @rowwise
+    def ElementSetFilter(results, mode, elements):
+        """
+        Element set filter.
+
+        This function saves the materials that pass an element-set test, e.g. ElementSetFilter(results, "ContainsAny", ["Cu", "Ni"]).
+        mode is one of Compositions.ELEMENT_SET_MODES and elements may include group names such as "transition_metal" - see
+        CompositionMatrix.element_set_mask.
+
+        Works on the composition matrix of the results (see Compositions.py), so no per-material Python loop is needed.
+        """
+        return CompositionMatrix.select(results, CompositionMatrix.from_results(results).element_set_mask(elements, mode))
+
+    @staticmethod
+    @rowwise
+    @columnar
+    def ColumnRangeFilter(results, ranges):
+        """
+        Column range filter.
+
+        This function only saves materials where each of the given properties lies within its [minimum, maximum] (inclusive, None for no limit),
+        e.g. ColumnRangeFilter(results, {"nsites": [None, 20]}). Materials without one of the properties are removed.
+        """
+        keep = np.ones(len(results), dtype=bool)
+        for name, (minimum, maximum) in ranges.items():
+            if(name not in results):
+                return results.select(np.zeros(len(results), dtype=bool))
+            values = results[name]
+            if(values.dtype == object): #missing values, or mixed types
+                present = np.array([isinstance(value, (int, float)) and not isinstance(value, bool) for value in values])
+                values = np.where(present, values, np.nan).astype(float)
+            keep &= ~np.isnan(values.astype(float))
+            if(minimum is not None):
+                keep &= values >= minimum
+            if(maximum is not None):
+                keep &= values <= maximum
+        return results.select(keep)
+
+    @staticmethod
+    @rowwise
+    @columnar
+    def ColumnValueFilter(results, allowedValues):
+        """
+        Column value filter.
+
+        This function only saves materials where each of the given properties has one of the allowed values,
+        e.g. ColumnValueFilter(results, {"spacegroup.number": [194, 225]}).
+        """
+        keep = np.ones(len(results), dtype=bool)
+        for name, allowed in allowedValues.items():
+            if(name not in results):
+                return results.select(np.zeros(len(results), dtype=bool))
+            categories, codes = results.categorical(name) #only the distinct values are compared
+            keep &= np.isin(codes, [code for code, value in enumerate(categories.tolist()) if value in allowed])
+        return results.select(keep)
+
+    @staticmethod
+    @rowwise
+    def NElementsFilter(results, minElements=1, maxElements=118):
+        """
+        Number of elements filter.
+
+        This function only saves materials that have between minElements and maxElements (inclusive) distinct elements in their formula.
+
+        Works on the composition matrix of the results (see Compositions.py), so no per-material Python loop is needed.
+        """
+        nelements = CompositionMatrix.from_results(results).nelements()
+        return CompositionMatrix.select(results, (nelements >= minElements) & (nelements <= maxElements))
+
+    @staticmethod
+    @rowwise
     def BinaryCompoundFilter(results):
         """
         Binary compound filter.
 
         This function only saves materials that have exactly 2 elements.
         """
-        filteredResults = []
-        for result in results:
-            NElements = result["nelements"]
-            if(NElements==2):
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.NElementsFilter(results, 2, 2)
 
     @staticmethod
+    @rowwise
     def TernaryOrLessCompoundFilter(results):
         """
         Ternary or less compound filter.
 
         This function only saves materials that have 3 or less elements.
         """
-        filteredResults = []
-        for result in results:
-            NElements = result["nelements"]
-            if(NElements<=3):
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.NElementsFilter(results, 1, 3)
 
     @staticmethod
     def _containsFBlock(formula):
@@ -387,71 +820,36 @@ class Analysis:
 
         This is the core function of ContainsFBlockFilter.
         """
-        elemsInFormula = list(Composition(formula).as_dict().keys())
-        allElems = ListOfTheElements()
-        lanthanides = [elem for elem in allElems if Element(elem).is_lanthanoid]
-        actinides = [elem for elem in allElems if Element(elem).is_actinoid]
-        fBlockElems = lanthanides + actinides
+        elemsInFormula = formula_elements(formula)
+        fBlockElems = element_group("lanthanoid") | element_group("actinoid")
         if(set(elemsInFormula) & set(fBlockElems)):
             return True
         else:
             return False
     
     @staticmethod
+    @rowwise
     def ContainsFBlockFilter(results):
         """
         f-block filter.
 
         This function only saves materials that contain an f-block element.
 
-        This function is dependant on the _containsFBlock function.
+        This function uses ElementSetFilter, which gives the same results as looping over the _containsFBlock function.
         """
-        # Adding a counter because I'd like to know if this filter is still working or if the program died. This is a slow filter.
-        counter = 0
-
-        numOfResults = len(results)
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Analysis._containsFBlock(formula)):
-                filteredResults.append(result)
-
-            # Incrementing the counter
-            counter += 1
-            if(counter%2000==0): #print info on progress every 100 entries
-                now = datetime.now()
-                current_time = now.strftime("%H:%M:%S")
-                print(f"[{current_time}]: {counter}/{numOfResults}")
-
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ContainsAny", ["lanthanoid", "actinoid"])
     
     @staticmethod
+    @rowwise
     def AntiFBlockFilter(results):
         """
         f-block filter.
 
         This function only saves materials that DO NOT contain an f-block element.
 
-        This function is dependant on the _containsFBlock function.
+        This function uses ElementSetFilter, which gives the same results as looping over the _containsFBlock function.
         """
-        # Adding a counter because I'd like to know if this filter is still working or if the program died. This is a slow filter.
-        counter = 0
-
-        numOfResults = len(results)
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(not Analysis._containsFBlock(formula)): #flipping the functionality of the _containsFBlock function to get this 'anti' filter
-                filteredResults.append(result)
-
-            # Incrementing the counter
-            counter += 1
-            if(counter%2000==0): #print info on progress every 100 entries
-                now = datetime.now()
-                current_time = now.strftime("%H:%M:%S")
-                print(f"[{current_time}]: {counter}/{numOfResults}")
-
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ExcludeAny", ["lanthanoid", "actinoid"])
 
     @staticmethod
     def _containsActinide(formula):
@@ -460,70 +858,50 @@ class Analysis:
 
         This is the core function of AntiActinideFilter.
         """
-        elemsInFormula = list(Composition(formula).as_dict().keys())
-        allElems = ListOfTheElements()
-        actinides = [elem for elem in allElems if Element(elem).is_actinoid]
+        elemsInFormula = formula_elements(formula)
+        actinides = element_group("actinoid")
         if(set(elemsInFormula) & set(actinides)):
             return True
         else:
             return False
 
     @staticmethod
+    @rowwise
     def AntiActinideFilter(results):
         """
         Anti-actinide filter.
 
         This function only saves materials that DO NOT contain an actinide.
 
-        This function is dependant on the _containsActinide function.
+        This function uses ElementSetFilter, which gives the same results as looping over the _containsActinide function.
         """
-        # Adding a counter because I'd like to know if this filter is still working or if the program died. This is a slow filter.
-        counter = 0
-
-        numOfResults = len(results)
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(not Analysis._containsActinide(formula)): #flipping the functionality of the _containsActinide function to get this 'anti' filter
-                filteredResults.append(result)
-
-            # Incrementing the counter
-            counter += 1
-            if(counter%2000==0): #print info on progress every 100 entries
-                now = datetime.now()
-                current_time = now.strftime("%H:%M:%S")
-                print(f"[{current_time}]: {counter}/{numOfResults}")
-
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ExcludeAny", ["actinoid"])
 
     @staticmethod
+    @rowwise
     def ContainsTransitionMetalFilter(results):
         """
         Transition metal filter.
 
         This function only saves materials that contain a transition metal.
 
-        This function is dependant on the contains_element_type function from the Pymatgen Composition class.
+        This function uses ElementSetFilter, which gives the same results as pymatgen's Composition.contains_element_type("transition_metal").
         """
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Composition(formula).contains_element_type("transition_metal")):
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ContainsAny", ["transition_metal"])
 
     @staticmethod
+    @rowwise
     def ContainsTMorF_Filter(results):
         filteredResults = []
         for result in results:
             formula = result["pretty_formula"]
-            if(Composition(formula).contains_element_type("transition_metal") or Analysis._containsFBlock):
+            if(get_composition(formula).contains_element_type("transition_metal") or Analysis._containsFBlock):
                 filteredResults.append(result)
         return filteredResults
 
     @staticmethod
     def _noIntermetallics(formula):
-        elements = [elem for elem in Composition(formula).elements]
+        elements = [elem for elem in get_composition(formula).elements]
         metalStatus = [elem.is_metal for elem in elements]
         if(all(metalStatus)):
             return False
@@ -531,20 +909,16 @@ class Analysis:
             return True
     
     @staticmethod
+    @rowwise
     def RemoveIntermetallicsFilter(results):
         """
         No intermetallics filter.
 
         This function removes materials that contain only metal elements.
 
-        This function is dependant on the _noIntermetallics function.
+        This function uses ElementSetFilter, which gives the same results as looping over the _noIntermetallics function.
         """
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Analysis._noIntermetallics(formula)):
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ExcludeOnly", ["metal"])
 
     @staticmethod
     def _containsCorN(formula):
@@ -553,7 +927,7 @@ class Analysis:
 
         This is the core function of ContainsCorNFilter.
         """
-        elemsInFormula = list(Composition(formula).as_dict().keys())
+        elemsInFormula = formula_elements(formula)
         CorN = ["C", "N"]
         if(set(elemsInFormula) & set(CorN)):
             return True
@@ -561,20 +935,16 @@ class Analysis:
             return False
 
     @staticmethod
+    @rowwise
     def ContainsCorNFilter(results):
         """
         C or N filter.
 
         This function only saves materials that contain C or N.
 
-        This function is dependant on the _containsCorN function.
+        This function uses ElementSetFilter, which gives the same results as looping over the _containsCorN function.
         """
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Analysis._containsCorN(formula)):
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.ElementSetFilter(results, "ContainsAny", ["C", "N"])
     
     @staticmethod
     def _checkMXeneRatios(formula): #this method should only be used after ContainsCorNFilter and ContainsTransitionMetalFilter have been applied.
@@ -583,27 +953,64 @@ class Analysis:
 
         This is the core function of CheckMXeneRatioFilter.
         """
-        elemsInFormula = list(Composition(formula).as_dict().keys())
-        M = [elem for elem in elemsInFormula if Element(elem).is_transition_metal].pop()
+        elemsInFormula = list(get_composition(formula).as_dict().keys())
+        M = [elem for elem in elemsInFormula if get_element(elem).is_transition_metal].pop()
         CorN = [elem for elem in elemsInFormula if elem=="C" or elem=="N"].pop()
-        elemsAndAmounts = Composition(formula).get_el_amt_dict()
+        elemsAndAmounts = get_composition(formula).get_el_amt_dict()
         if((elemsAndAmounts[M]==2 and elemsAndAmounts[CorN]==1) or (elemsAndAmounts[M]==3 and elemsAndAmounts[CorN]==2) or (elemsAndAmounts[M]==4 and elemsAndAmounts[CorN]==3) or (elemsAndAmounts[M]==5 and elemsAndAmounts[CorN]==4)):
             return True
         else:
             return False
         
+    MXENE_RATIOS = ((2, 1), (3, 2), (4, 3), (5, 4)) #M:X amounts counted as MXene-like by CheckMXeneRatioFilter
+
+    @staticmethod
+    def _lastMXAmounts(formula, XElements):
+        """The amounts of the last transition metal and the last X element in formula (in the order they are written), or None without both."""
+        elemsAndAmounts = get_composition(formula).get_el_amt_dict()
+        M = [elem for elem in elemsAndAmounts if get_element(elem).is_transition_metal]
+        X = [elem for elem in elemsAndAmounts if elem in XElements]
+        if(len(M) == 0 or len(X) == 0):
+            return None
+        return (elemsAndAmounts[M[-1]], elemsAndAmounts[X[-1]])
+
+    @staticmethod
+    @rowwise
+    def MXeneRatioFilter(results, ratios=MXENE_RATIOS, XElements=("C", "N"), anyPair=False):
+        """
+        MXene ratio filter.
+
+        This function only saves materials where the amounts of a transition metal M and of an X element (C or N by default)
+        in the formula match one of the given (M, X) ratios, e.g. Ti2C or Mo3N2 for the default ratios.
+
+        As in _checkMXeneRatios, M and X are the last transition metal and the last X element in the formula (materials without
+        either are removed). With anyPair=True, any (M, X) pair that matches is enough, e.g. Ti2Nb3C2 is kept for Ti:C = 2:1
+        (then this works on the composition matrix of the results, see Compositions.py).
+        """
+        ratios = {tuple(ratio) for ratio in ratios}
+        if(not anyPair):
+            formulas = [result["pretty_formula"] for result in results]
+            keep = {formula: Analysis._lastMXAmounts(formula, XElements) in ratios for formula in set(formulas)}
+            return CompositionMatrix.select(results, np.array([keep[formula] for formula in formulas], dtype=bool))
+        comps = CompositionMatrix.from_results(results)
+        MAmounts = comps.amounts(elements_where(lambda elem: elem.is_transition_metal)) #materials x transition metals
+        XAmounts = comps.amounts(XElements) #materials x X elements
+        keep = np.zeros(len(comps), dtype=bool)
+        for MAmount, XAmount in ratios:
+            keep |= (MAmounts == MAmount).any(axis=1) & (XAmounts == XAmount).any(axis=1)
+        return CompositionMatrix.select(results, keep)
+
     @staticmethod
+    @rowwise
     def CheckMXeneRatioFilter(results):
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Analysis._checkMXeneRatios(formula)):
-                filteredResults.append(result)
-        return filteredResults
+        """
+        MXene ratio filter with the usual M:X ratios of 2:1, 3:2, 4:3 and 5:4 (use after ContainsTM and ContainsCorN).
+        """
+        return Analysis.MXeneRatioFilter(results)
     
     @staticmethod
     def _7to1RatioRemover(formula):
-        amounts = list(Composition(formula).get_el_amt_dict().values())
+        amounts = list(get_composition(formula).get_el_amt_dict().values())
         smallestAmount = min(amounts)
         largestAmount = max(amounts)
         largestToSmallestRatio = largestAmount/smallestAmount
@@ -613,27 +1020,39 @@ class Analysis:
             return True #only keep a material if the ratio between the largest to smallest elem amount ratio is greater than 7:1
     
     @staticmethod
+    @rowwise
+    def AmountRatioFilter(results, maxRatio=7):
+        """
+        Largest to smallest amount ratio filter.
+
+        This function only saves materials where the ratio between the largest and smallest element amounts in the formula is at most maxRatio.
+        """
+        comps = CompositionMatrix.from_results(results)
+        return CompositionMatrix.select(results, comps.max_amount() <= maxRatio*comps.min_amount())
+
+    @staticmethod
+    @rowwise
     def LargeToSmallAmountRatioFilter7to1(results):
-        filteredResults = []
-        for result in results:
-            formula = result["pretty_formula"]
-            if(Analysis._7to1RatioRemover(formula)):
-                filteredResults.append(result)
-        return filteredResults
+        return Analysis.AmountRatioFilter(results, 7)
 
 
     @staticmethod
     def _get_elements_stoichs(comp:str) -> list:
-        """Returns list of elements and a list of stoichs from a formula string"""
-        comp_dict = Composition(comp).add_charges_from_oxi_state_guesses()
-        elem_symbols = [elem.symbol for elem in comp_dict.keys()]
-        count = comp_dict.values()
+        """Returns list of elements and a list of stoichs from a formula string (one entry per guessed species, see OxidationStates.py)"""
+        species = species_of(comp)
+        elem_symbols = [symbol for symbol, _, _ in species]
+        count = [amount for _, _, amount in species]
         return tuple(elem_symbols), tuple(count)
 
     @staticmethod
-    def _smact_validity(formula, use_pauling_test=True, include_alloys=True):
-        """Check if a formula is valid by SMACT"""
-        elem_symbols, count = Analysis._get_elements_stoichs(formula)
+    def _smact_validity(formula, use_pauling_test=True, include_alloys=True, species=None):
+        """Check if a formula is valid by SMACT (species: the formula's rows from guess_oxidation_states, if they have been guessed already)"""
+        import smact #imported when first needed, like the other dependencies of single filters
+        from smact.screening import pauling_test
+        if(species is None):
+            elem_symbols, count = Analysis._get_elements_stoichs(formula)
+        else:
+            elem_symbols, count = tuple(species["element"].tolist()), tuple(species["amount"].tolist())
         count = [int(c) for c in count]
         #space = smact.element_dictionary(elem_symbols)
         #smact_elems = [e[1] for e in space.items()]
@@ -676,18 +1095,40 @@ class Analysis:
             return False
 
     @staticmethod
+    @rowwise
     def ChargeBalanceFilter(results): #known issue - this does not work for cases where there's only one atom of an element that can undergo charge disproportionation, e.g. BiO2
+        formulas = list(dict.fromkeys(result["pretty_formula"] for result in results)) #each distinct formula is guessed and tested once
+        speciesOf = by_formula(guess_oxidation_states(formulas), len(formulas))
+        validFormulas = {formula for formula, species in zip(formulas, speciesOf) if Analysis._smact_validity(formula, species=species)}
         filteredResults = []
         for result in results:
             formula = result["pretty_formula"]
-            if(Analysis._smact_validity(formula)):
+            if(formula in validFormulas):
                 filteredResults.append(result)
         return filteredResults
 
+    @staticmethod
+    @rowwise
+    def ChargeAnnotationFilter(results):
+        """
+        Keeps every material, adding its guessed oxidation states (see OxidationStates.py):
+            "oxidation_states": [[element, charge, number of sites], ...]  e.g. [["Fe", 2, 1.0], ["Fe", 3, 2.0], ["O", -2, 4.0]] for Fe3O4
+            "charge_balanced": whether a charge balanced guess was found (if not, every charge is 0 - as it also is for a single element,
+                               which is balanced)
+        """
+        formulas = list(dict.fromkeys(result["pretty_formula"] for result in results))
+        speciesOf = dict(zip(formulas, by_formula(guess_oxidation_states(formulas), len(formulas))))
+        for result in results:
+            species = speciesOf[result["pretty_formula"]]
+            result["oxidation_states"] = [[symbol, charge, amount] for symbol, charge, amount in zip(species["element"].tolist(), species["charge"].tolist(), species["amount"].tolist())]
+            result["charge_balanced"] = is_charge_balanced(result["pretty_formula"])
+        return results
+
 
 
     @staticmethod
     def _condense(struct):
+        from robocrys import StructureCondenser #imported when first needed - importing robocrys takes longer than the cheap filters take to run
         BlockPrint()
         condenser = StructureCondenser()
         condensedStruct = condenser.condense_structure(struct)
@@ -696,17 +1137,30 @@ class Analysis:
 
 
     def GetCondensedStructures(self, results):
-        results = results[:14] #for testing purposes I'm using a smaller number of results
-        batch_size = 5
+        #with deduplicate, only the first material of each class of equivalent structures is condensed, and the others are given its condensed structure
+        classIds = None
+        if(self.structureIndex is not None):
+            members = results
+            classIds, _ = self.structureIndex.classify(members, lambda result: decode_structure(result["structure"]))
+            self.structureIndex.save() #the batches below are of one material per class, so they have to be the same classes if the stage is resumed
+            results = [members[i] for i in representatives(classIds)]
+            print(f"{len(results)} distinct structures among {len(members)} materials.")
+        batch_size = 20 #materials per checkpoint file - the workers are kept busy between checkpoints (see Batching.batch_map)
         batchDirName = f"{self.currentFilterCounter}_{self.currentFilter}_batches"
+        inputIds = [material_id(result) for result in results]
+        position = {materialId: i for i, materialId in enumerate(inputIds)}
+        completedResults = []
         if(os.path.isdir(batchDirName)):
             print("Previous batches found. Continuing from last batch.")
-            numOfcompletedBatches = len(os.listdir(batchDirName))
+            batchFiles = os.listdir(batchDirName)
+            numOfcompletedBatches = len(batchFiles)
             print(f"No. of completed batches: {numOfcompletedBatches}")
-            numOfCompletedTasks = batch_size*numOfcompletedBatches
-            task_counter = [numOfCompletedTasks]
+            for batchFile in batchFiles:
+                completedResults += [result for result in ReadJSONFile(os.path.join(batchDirName, batchFile.replace(".json", ""))) if material_id(result) in position]
+            completedIds = {material_id(result) for result in completedResults} #materials finish out of order, so they're resumed by id rather than by position
+            task_counter = [len(completedResults)]
             batch_counter = [numOfcompletedBatches]
-            results = results[numOfCompletedTasks:]
+            results = [result for result, materialId in zip(results, inputIds) if materialId not in completedIds]
         else:
             task_counter = [0]
             batch_counter = [0]
@@ -721,6 +1175,11 @@ class Analysis:
             print(f"[{current_time}]: {task_counter}/{numOfResults}")
         
         def with_batch(batch_results):
+            #problem children are written here, in the search directory - a worker's working directory is wherever its pool was started
+            problemChildren = [result for result in batch_results if result.get("FailedOnFilter") == "CondensedStructures"]
+            if(len(problemChildren) != 0):
+                Analysis._saveProblemChildren("ProblemChildren_GetCondensedStructures", Analysis._storeStructures(problemChildren))
+            batch_results = [result for result in batch_results if result.get("FailedOnFilter") != "CondensedStructures"]
             batch_counter[0] += 1
             print(f"\n\nCompleted batch {batch_counter[0]}\n\n")
             batchDirName = f"{self.currentFilterCounter}_{self.currentFilter}_batches"
@@ -739,31 +1198,54 @@ class Analysis:
                 result["condensed_struct"] = condensedStruct
                 return result
             except:
-                result = Analysis._storeStructures(result)
-                if(os.path.isfile("ProblemChildren_GetCondensedStructures.json")):
-                    problemChild = pd.DataFrame.from_dict(result)
-                    theOtherProblemChildren = pd.read_json("ProblemChildren_GetCondensedStructures.json")
-                    problemChildren=pd.concat([theOtherProblemChildren, problemChild])
-                    problemChildren.to_json("ProblemChildren_GetCondensedStructures.json", orient="records", indent=4)
-                else:
-                    problemChild = pd.DataFrame.from_dict(result)
-                    problemChild.to_json("ProblemChildren_GetCondensedStructures.json", orient="records", indent=4)
-
-        batch_map(filter, results, batch_size, with_task=with_task, with_batch=with_batch)
-        results = Analysis._storeStructures(results)
-        numOfResultsInMemory = len(results)
+                result["FailedOnFilter"] = "CondensedStructures" #sent back, so that with_batch saves it as a problem child
+                return result
 
-        if(numOfResultsInMemory != numOfResults): #only true if the program restarted from some existing batched results
-            allResults = []
-            batchedResults = os.listdir(batchDirName)
-            for batchedResultsFile in batchedResults:
-                resultsListOfDicts=ReadJSONFile(os.path.join(batchDirName, batchedResultsFile.replace(".json", "")))
-                allResults+=resultsListOfDicts
-            results = allResults
+        #largest structures first, since robocrys takes much longer on them
+        condensedResults = batch_map(filter, results, batch_size, with_task=with_task, with_batch=with_batch, stage_name=self.currentFilter,
+                                     cost=lambda result: len(result["structure"]))
+        condensedResults = [result for result in condensedResults if result.get("FailedOnFilter") != "CondensedStructures"]
+        results = completedResults + Analysis._storeStructures(condensedResults)
+        results.sort(key=lambda result: position[material_id(result)]) #back in the order of the previous stage
 
+        if(classIds is not None):
+            results = self.structureIndex.propagate(members, classIds, results)
 
+        self.condensedIndex.add_results(results) #so SimilarTo can find these materials in any later search
+        self.condensedIndex.save()
         return results
 
+    def SimilarToFilter(self, results, reference, top=None, minSimilarity=0.0):
+        """
+        Similarity filter.
+
+        This function saves the materials whose condensed structures (see GetCondensedStructures) are most similar to that of reference,
+        adding their "similarity" (0 to 1) and sorting them from most to least similar. reference is a MaterialId whose condensed structure
+        has been worked out in this or an earlier search, or a structure file (which is condensed here). top (optional) keeps only that many
+        materials, and minSimilarity only those at least that similar.
+
+        Uses the condensed structure index (see CondensedIndex.py), so no material is condensed again - materials whose condensed
+        structures haven't been worked out are removed.
+        """
+        self.condensedIndex.add_results(results)
+        self.condensedIndex.save()
+        if(reference in self.condensedIndex):
+            features = self.condensedIndex.features_of(reference)
+        elif(os.path.isfile(reference)):
+            features = condensed_features(Analysis._condense(Structure.from_file(reference)))
+        else:
+            raise ValueError(f"SimilarTo reference {reference} is neither a material with a condensed structure nor a structure file.")
+
+        ids = [material_id(result) for result in results]
+        with Perf.stage(Perf.current_stage(), "similarity_search", rows_in=len(results)) as perfEntry:
+            matches = self.condensedIndex.search(features, top=top, within=ids, minSimilarity=minSimilarity)
+            perfEntry["indexed"] = sum(materialId in self.condensedIndex for materialId in ids)
+            perfEntry["rows_out"] = len(matches)
+        if(perfEntry["indexed"] < len(results)):
+            print(f"{len(results)-perfEntry['indexed']} materials have no condensed structure, so were removed (run GetCondensedStructures on them first).")
+        resultOf = dict(zip(ids, results))
+        return [dict(resultOf[materialId], similarity=similarity) for materialId, similarity in matches]
+
     def GetStructures(self, results): #this is a non-static method, hence the lack of the @staticmethod decorator - this relies on an instance of the Analysis class.
         """
         Not a filter, but can be called like one in the usual way.
@@ -784,6 +1266,7 @@ class Analysis:
 
         return results
 
+    @rowwise
     def InputStructuresIntoData(self, results):
         counter = 0
         numOfResults = len(results)
@@ -806,14 +1289,15 @@ class Analysis:
         counter = 0
         numOfResults = len(results)
         loadedResults = []
-        for result in results:
-            item = {k:(Structure.from_dict(v) if k=="structure" else v) for (k,v) in result.items()}
-            loadedResults.append(item)
-            counter += 1
-            if(counter%500==0): #print info on progress every 100 entries
-                now = datetime.now()
-                current_time = now.strftime("%H:%M:%S")
-                print(f"[{current_time}]: {counter}/{numOfResults}")
+        with Perf.stage(Perf.current_stage(), "load_structures", rows_in=numOfResults):
+            for result in results:
+                item = {k:(decode_structure(v) if k=="structure" else v) for (k,v) in result.items()}
+                loadedResults.append(item)
+                counter += 1
+                if(counter%500==0): #print info on progress every 100 entries
+                    now = datetime.now()
+                    current_time = now.strftime("%H:%M:%S")
+                    print(f"[{current_time}]: {counter}/{numOfResults}")
         return loadedResults
     
 
@@ -823,14 +1307,15 @@ class Analysis:
         counter = 0
         numOfResults = len(results)
         storedResults = []
-        for result in results:
-            item = {k:(v.as_dict() if k=="structure" else v) for (k,v) in result.items()}
-            storedResults.append(item)
-            counter += 1
-            if(counter%500==0): #print info on progress every 100 entries
-                now = datetime.now()
-                current_time = now.strftime("%H:%M:%S")
-                print(f"[{current_time}]: {counter}/{numOfResults}")
+        with Perf.stage(Perf.current_stage(), "store_structures", rows_in=numOfResults):
+            for result in results:
+                item = {k:(encode_structure(v) if k=="structure" else v) for (k,v) in result.items()}
+                storedResults.append(item)
+                counter += 1
+                if(counter%500==0): #print info on progress every 100 entries
+                    now = datetime.now()
+                    current_time = now.strftime("%H:%M:%S")
+                    print(f"[{current_time}]: {counter}/{numOfResults}")
         return storedResults
 
     @staticmethod
@@ -840,15 +1325,9 @@ class Analysis:
 
         This function takes a formula and returns a dictionary in the form {element_symbol: charge}
         """
-        chemical = Composition(formula) #converting formula to pymatgen Composition object
-        oxStates = list(chemical.add_charges_from_oxi_state_guesses(max_sites=-1)) #max_sites=-1 fully reduces the formula for oxidation calc
-        oxStates = [str(element) for element in oxStates]
-        alphabetRegex = re.compile('[a-zA-Z]+')
-        elements = [alphabetRegex.findall(element)[0] for element in oxStates]
-        chargesInStruct = [oxState.replace(elem,"") for (oxState,elem) in zip(oxStates,elements)]
-        chargesInStruct=[oxState[::-1] for oxState in chargesInStruct]
-        chargesInStruct = [1 if charge == "+" else -1 if charge == "-" else charge for charge in chargesInStruct]
-        chargesInStruct = [int(charge) for charge in chargesInStruct]
+        species = species_of(formula, reduce=True) #the formula is fully reduced for the oxidation state guess
+        elements = [symbol for symbol, _, _ in species]
+        chargesInStruct = [charge for _, charge, _ in species]
         #Checking for charge disproportionation
         CDcharges = [] #will only be filled if a CD atom is found
         for i in range(len(elements)):
@@ -1,52 +1,143 @@
 import numpy as np
 import os
+import shutil
+import multiprocess
 import pandas as pd
-from Filters import Analysis
-from Util import get_NElems, TurnElementsIntoList, APIkeyChecker, SaveDictAsJSON
-from pymatgen.ext.matproj import MPRester
+from Filters import Analysis, GNOME_ONLY_FILTERS
+from Util import get_NElems, TurnElementsIntoList, APIkeyChecker, ConvertJSONresultsToExcel
+from StageIO import StageFile, SaveStage, StageWriter, IterStageChunks, DEFAULT_STAGE_FORMAT, DEFAULT_CHUNK_SIZE
+from StructureIndex import material_id
 
 import Batching
-Batching.setup()
+import Perf
+import Compositions
+Batching.setup(initializer=Compositions.warm) #workers start with the element tables already built
 
-def MaterialSearch_GNOME(searchName, orderOfFilters, homeDir, database):
+def _explorationOptions(limit, sample, topK):
+    """Checks the limit/sample/topK options of MaterialSearch. Returns (limit, sample as (n, seed), topK as (k, key, descending))."""
+    given = [name for name, option in (("limit", limit), ("sample", sample), ("topK", topK)) if option is not None]
+    if(len(given) > 1):
+        raise ValueError(f"Only one of limit, sample and topK can be used at a time, not {' and '.join(given)}.")
+    if(sample is not None):
+        sample = (sample, 0) if isinstance(sample, int) else tuple(sample)
+        limit = sample[0]
+    if(topK is not None):
+        if(len(topK) == 2):
+            topK = (*topK, "ascending")
+        if(topK[2] not in ("ascending", "descending")):
+            raise ValueError(f"topK is ranked in 'ascending' or 'descending' order, not {topK[2]}.")
+        topK = (topK[0], topK[1], topK[2] == "descending")
+        limit = topK[0]
+    if(limit is not None and limit < 1):
+        raise ValueError(f"The number of materials to keep has to be at least 1, not {limit}.")
+    return limit, sample, topK
+
+def _orderForExploration(results, sample=None, topK=None):
+    """
+    Puts the initial stage (a DataFrame for GNoME, a list of dictionaries for MP) in the order a limited search should read it:
+    shuffled for sample, best first for topK. The first materials to pass every filter are then a random sample of, or the top
+    ranked of, all the materials that would pass. Materials without the topK property are put last.
+    """
+    if(sample is not None):
+        _, seed = sample
+        if(isinstance(results, pd.DataFrame)):
+            return results.sample(frac=1, random_state=seed).reset_index(drop=True)
+        return [results[i] for i in np.random.default_rng(seed).permutation(len(results))]
+    if(topK is not None):
+        _, key, descending = topK
+        if(isinstance(results, pd.DataFrame)):
+            if(key not in results.columns):
+                raise ValueError(f"topK property {key} is not in the database. Options are: {', '.join(results.columns)}")
+            return results.sort_values(key, ascending=not descending, na_position="last", kind="stable").reset_index(drop=True)
+        ranked = sorted((result for result in results if result.get(key) is not None), key=lambda result: result[key], reverse=descending)
+        return ranked + [result for result in results if result.get(key) is None]
+    return results
+
+
+_gnomeDatabases = {} #(path, size, mtime) -> prepared GNoME database, kept for the life of the process (e.g. a SearchDaemon, see SearchDaemon.py)
+
+def LoadGNoMEDatabase(databasePath):
+    """
+    Reads the GNoME database CSV and prepares it for searching (elements as lists, nelements added, property headings renamed to MP names).
+    Returns (database, perf records of reading and preparing it).
+
+    The prepared database is kept in memory, so later searches in the same process don't read it again unless the file changes; the
+    DataFrame returned is shared between them, so it must not be changed in place.
+    """
+    stat = os.stat(databasePath)
+    key = (os.path.abspath(databasePath), stat.st_size, stat.st_mtime_ns)
+    if(key in _gnomeDatabases):
+        results = _gnomeDatabases[key]
+        return results, [{"stage": "Database", "step": "in_memory", "depth": 0, "rows_out": len(results.index)}]
+
+    perfEntries = []
+    with Perf.stage("Database", "read_csv", bytes_read=stat.st_size) as perfEntry:
+        results = pd.read_csv(databasePath) #loading database information
+        perfEntry["rows_out"] = len(results.index)
+    perfEntries.append(perfEntry)
+    with Perf.stage("Database", "prepare", rows_in=len(results.index)) as perfEntry:
+        results['Elements'] = results['Elements'].apply(TurnElementsIntoList)
+        NElements = results['Elements'].apply(get_NElems)
+        results.insert(loc = 5,
+                        column = 'NElements',
+                        value = NElements)
+        results = results.replace([np.inf, -np.inf, np.nan], None) #replace infinite values and NaN with "None"
+
+        ###converting property headings in GNoME database for MP property names (in cases where there's a direct translation)
+        results_headings = results.columns.to_list()
+        GNoME_to_MP_propertyNames={
+                        "Composition": "full_formula",
+                        "Reduced Formula": "pretty_formula",
+                        "Elements": "elements",
+                        "NElements": "nelements",
+                        "NSites": "nsites",
+                        "Volume": "volume",
+                        "Density": "density",
+                        "Space Group": "spacegroup.symbol",
+                        "Space Group Number": "spacegroup.number",
+                        "Crystal System": "spacegroup.crystal_system"
+        }
+        newHeadings = [GNoME_to_MP_propertyNames[prop] if prop in list(GNoME_to_MP_propertyNames.keys()) else prop for prop in results_headings]
+        results=results.set_axis(newHeadings, axis=1)
+        ###
+    perfEntries.append(perfEntry)
+    _gnomeDatabases.clear() #only the latest version of the file is kept
+    _gnomeDatabases[key] = results
+    return results, perfEntries
+
+
+def MaterialSearch_GNOME(searchName, orderOfFilters, homeDir, database, profileFilters=[], profiler="cprofile", stageCache=True, chunkSize=None,
+                         stageFormat=DEFAULT_STAGE_FORMAT, parallelParse=False, limit=None, sample=None, topK=None, deduplicate=None, pipelined=False):
     if(not os.path.isdir(searchName)):
         print(f"Creating search directory {searchName} and reading in GNOME database.")
         if(os.path.isfile("gnome_data_stable_materials_summary.csv")): #new version of the database has a different name than before, so I'm just renaming it to what it used to be lol
             os.rename("gnome_data_stable_materials_summary.csv", "stable_materials_summary.csv")
 
-        results = pd.read_csv(os.path.join(homeDir, "stable_materials_summary.csv")) #loading database information
+        databasePath = os.path.join(homeDir, "stable_materials_summary.csv")
+        results, perfEntries = LoadGNoMEDatabase(databasePath)
         os.mkdir(searchName)
         os.chdir(searchName)
+        Perf.enable(os.getcwd(), searchName)
+        for perfEntry in perfEntries: #the search directory didn't exist while the database was being read, so these records are written now
+            Perf.record(perfEntry)
 
         initialFilterName = "Database"
         initialSearchFilename = f"0_{initialFilterName}"
-        if(not os.path.isfile(f"{initialSearchFilename}.json")):
-            results['Elements'] = results['Elements'].apply(TurnElementsIntoList)
-            NElements = results['Elements'].apply(get_NElems)
-            results.insert(loc = 5,
-                            column = 'NElements',
-                            value = NElements)
-            results = results.replace([np.inf, -np.inf, np.nan], None) #replace infinite values and NaN with "None"
-            
-            ###converting property headings in GNoME database for MP property names (in cases where there's a direct translation)
-            results_headings = results.columns.to_list()
-            GNoME_to_MP_propertyNames={
-                            "Composition": "full_formula",
-                            "Reduced Formula": "pretty_formula",
-                            "Elements": "elements",
-                            "NElements": "nelements",
-                            "NSites": "nsites",
-                            "Volume": "volume",
-                            "Density": "density",
-                            "Space Group": "spacegroup.symbol",
-                            "Space Group Number": "spacegroup.number",
-                            "Crystal System": "spacegroup.crystal_system"
-            }
-            newHeadings = [GNoME_to_MP_propertyNames[prop] if prop in list(GNoME_to_MP_propertyNames.keys()) else prop for prop in results_headings]
-            results=results.set_axis(newHeadings, axis=1)
-            ###
-
-            results.to_json(f"{initialSearchFilename}.json", orient="records", indent=4)
+        if(StageFile(initialSearchFilename) is None):
+            if(sample is not None or topK is not None):
+                with Perf.stage(initialFilterName, "order", rows_in=len(results.index), sample=sample, topK=topK):
+                    results = _orderForExploration(results, sample, topK)
+
+            with Perf.stage(initialFilterName, "write", rows_in=len(results.index), format=stageFormat) as perfEntry:
+                if(stageFormat == "json"):
+                    results.to_json(f"{initialSearchFilename}.json", orient="records", indent=4)
+                    perfEntry["bytes_written"] = Perf.file_size(f"{initialSearchFilename}.json")
+                else: #encoded by pandas as for the json format, so the rows read back are the same whichever format is used
+                    with StageWriter(initialSearchFilename, stageFormat) as writer:
+                        for start in range(0, len(results.index), DEFAULT_CHUNK_SIZE):
+                            rows = results.iloc[start:start+DEFAULT_CHUNK_SIZE]
+                            writer.writeEncoded(rows.to_json(orient="records", lines=True).rstrip("\n").encode() + b"\n", len(rows.index))
+                    perfEntry["bytes_written"] = Perf.file_size(writer.path)
 
             #logging
             with open("SearchLog.txt", mode="w") as f:
@@ -55,25 +146,31 @@ def MaterialSearch_GNOME(searchName, orderOfFilters, homeDir, database):
     else:
         print(f"Search directory {searchName} already exists.")
         os.chdir(searchName)
+        Perf.enable(os.getcwd(), searchName)
 
 
-    Analysis(searchName, orderOfFilters, homeDir, database)
+    Analysis(searchName, orderOfFilters, homeDir, database, profileFilters, profiler, stageCache, chunkSize, stageFormat, parallelParse, limit, deduplicate, pipelined)
     os.chdir(homeDir)
 
 
-def MaterialSearch_MP(searchName, APIkey, criteria, properties, orderOfFilters, homeDir, database):
+def MaterialSearch_MP(searchName, APIkey, criteria, properties, orderOfFilters, homeDir, database, profileFilters=[], profiler="cprofile", stageCache=True, chunkSize=None,
+                      stageFormat=DEFAULT_STAGE_FORMAT, parallelParse=False, limit=None, sample=None, topK=None, deduplicate=None, pipelined=False):
 
     if(not os.path.isdir(searchName)):
         print(f"Creating search directory {searchName}.")
         os.mkdir(searchName)
         os.chdir(searchName)
+        Perf.enable(os.getcwd(), searchName)
 
         initialFilterName = "MPquery"
         initialSearchFilename = f"0_{initialFilterName}"
-        if(not os.path.isfile(f"{initialSearchFilename}.json")):
+        if(StageFile(initialSearchFilename) is None):
             print("Performing Materials Project query.")
-            with MPRester(APIkey) as mpr:
-                results = mpr.query(criteria, properties, chunk_size=10000)
+            from pymatgen.ext.matproj import MPRester #only needed for MP searches, so imported when first needed
+            with Perf.stage(initialFilterName, "query") as perfEntry:
+                with MPRester(APIkey) as mpr:
+                    results = mpr.query(criteria, properties, chunk_size=10000)
+                perfEntry["rows_out"] = len(results)
             print("Query complete.\n")
 
             #logging
@@ -83,20 +180,28 @@ def MaterialSearch_MP(searchName, APIkey, criteria, properties, orderOfFilters,
             #New code
             #############
             if("structure" in list(results[0].keys())):
-                results = Analysis._storeStructures(results)
+                with Perf.stage(initialFilterName, "prepare", rows_in=len(results)):
+                    results = Analysis._storeStructures(results)
             #############
-            SaveDictAsJSON(initialSearchFilename, results)
+            if(sample is not None or topK is not None):
+                with Perf.stage(initialFilterName, "order", rows_in=len(results), sample=sample, topK=topK):
+                    results = _orderForExploration(results, sample, topK)
+            with Perf.stage(initialFilterName, "write", rows_in=len(results), format=stageFormat) as perfEntry:
+                perfEntry["bytes_written"] = Perf.file_size(SaveStage(initialSearchFilename, results, stageFormat))
             print("Initial search completed.")
     else:
         print(f"Search directory {searchName} already exists.")
         os.chdir(searchName)
+        Perf.enable(os.getcwd(), searchName)
 
 
-    Analysis(searchName, orderOfFilters, homeDir, database)
+    Analysis(searchName, orderOfFilters, homeDir, database, profileFilters, profiler, stageCache, chunkSize, stageFormat, parallelParse, limit, deduplicate, pipelined)
     os.chdir(homeDir)
     print("\n"*4)
 
-def MaterialSearch(searchName:str, orderOfFilters:list[str], database:str, MPcriteria={}, MPproperties=['material_id', 'pretty_formula', 'spacegroup.number', 'nsites', "nelements"]):
+def MaterialSearch(searchName:str, orderOfFilters:list, database:str, MPcriteria={}, MPproperties=['material_id', 'pretty_formula', 'spacegroup.number', 'nsites', "nelements"],
+                   profileFilters:list[str]=[], profiler:str="cprofile", stageCache:bool=True, chunkSize:int=None, stageFormat:str=DEFAULT_STAGE_FORMAT,
+                   parallelParse:bool=False, limit:int=None, sample=None, topK=None, deduplicate:str=None, pipelined:bool=False):
     """
     The core function used to interact with this codebase.
     This is the function that user interacts with in order to perform a search of either the GNoME or MP databases.
@@ -104,12 +209,42 @@ def MaterialSearch(searchName:str, orderOfFilters:list[str], database:str, MPcri
     Args:
     
     searchName - the name of the search you want to perform.
-    orderOfFilters - a list of filter names (analysis tags) that you want to apply to your search in the order provided.
+    orderOfFilters - a list of filter names (analysis tags) that you want to apply to your search in the order provided. Parameterized filters are
+                     given as (name, parameters) pairs, e.g. ("ContainsAny", ["Cu", "Ni"]) or ("Dimensionality", {"dim": 2}) - see Analysis.ParameterizedFilterRegistry.
     database - either "mp" or "gnome"; this determines which database will be searched (Materials Project or GNoME).
     MPcriteria - a dictionary of criteria required when performing a Materials Project query. Only required when database="mp".
     MPproperties - a list of properties asked for in a Materials Project query. Only required when database="mp".
+    profileFilters - (optional) a list of filter names from orderOfFilters to profile, e.g. ["ChargeBalance"]. Work done in Batching worker processes is included.
+                     The merged profile for each is written to {n}_{filterName}_profile.txt (plus a .prof or .folded file) in the search directory.
+    profiler - either "cprofile" (deterministic, exact call counts) or "sampling" (low overhead, collapsed stacks for flame graphs).
+    stageCache - whether to use the stage cache in StageCache/ (see StageCache.py). When on, a stage that has already been computed from identical
+                 data with the same filter code - in any search - is reused instead of being run again.
+    chunkSize - (optional) turns on out-of-core mode for searches larger than memory: stages are read, filtered and written chunkSize rows at a time
+                (e.g. 10000), so only one chunk is held in memory. Applies to filters marked @rowwise; others are still given the whole stage.
+    stageFormat - the format stage files are saved in: "json" (the default - one indented JSON document per stage), or JSON lines (one material per line),
+                  "jsonl", "jsonl.gz" (gzip compressed) or "jsonl.zst" (zstd compressed, needs the zstandard package). See StageIO.py.
+                  Stages saved in any format can be read, so this can be changed between runs of the same search.
+    parallelParse - (with chunkSize) JSON-lines stages are parsed and filtered a block at a time in the Batching worker processes, on every core.
+    limit - (optional) for quick, exploratory searches: the search stops once this many materials have passed every filter, e.g. limit=20.
+            Consecutive @rowwise filters are run together a chunk at a time, so only as much of the database is read as is needed to find them
+            (see Analysis.LimitedPipeline); a filter that needs the whole of its previous stage is only given the first limit materials of it.
+    sample - (optional) (n, seed), or just n for seed 0: as limit=n, for a random sample of n of the materials that pass every filter.
+    topK - (optional) (k, property) or (k, property, "descending"): as limit=k, for the k materials with the lowest (highest) property that
+           pass every filter, e.g. (10, "Decomposition Energy Per Atom").
+    Only one of limit, sample and topK can be used at a time. sample and topK set the order of the database stage when the search directory is
+    created, so give the search a new searchName when changing them (or to run it in full).
+    deduplicate - (optional) "fingerprint" or "matcher": Dimensionality and GetCondensedStructures analyse one material per class of equivalent structures
+                  and give the result to the rest of the class. Classes are found from a fingerprint of each structure (reduced formula, space group, volume
+                  per atom and nearest-neighbour distances), confirmed with pymatgen's StructureMatcher for "matcher". The classes are saved in
+                  StructureIndex/ and reused by later searches of the same database - see StructureIndex.py.
+    pipelined - (optional, with chunkSize) reads the next chunk of a stage and writes the previous one in background threads while the current
+                chunk is filtered. Worth it when reading (e.g. from a network drive or a compressed stage) takes about as long as filtering; the
+                stage files are the same either way.
+
+    Timings for every stage are written to PerfLog.jsonl (one JSON record per line) in the search directory, and a summary table is printed at the end of the search.
     """
     homeDir=os.getcwd()
+    limit, sample, topK = _explorationOptions(limit, sample, topK)
 
     database = database.lower()
     databaseDirName_dict = {"mp": "MP", "gnome": "GNoME"}
@@ -122,7 +257,8 @@ def MaterialSearch(searchName:str, orderOfFilters:list[str], database:str, MPcri
             os.chdir(databaseDirName)
         else:
             os.chdir(databaseDirName)
-        MaterialSearch_MP(searchName, APIkey, MPcriteria, MPproperties, orderOfFilters, homeDir, database)
+        MaterialSearch_MP(searchName, APIkey, MPcriteria, MPproperties, orderOfFilters, homeDir, database, profileFilters, profiler, stageCache, chunkSize, stageFormat, parallelParse,
+                          limit, sample, topK, deduplicate, pipelined)
     elif(database == "gnome"):
         databaseDirName = databaseDirName_dict[database]
         if(not os.path.isdir(databaseDirName)):
@@ -130,6 +266,315 @@ def MaterialSearch(searchName:str, orderOfFilters:list[str], database:str, MPcri
             os.chdir(databaseDirName)
         else:
             os.chdir(databaseDirName)
-        MaterialSearch_GNOME(searchName, orderOfFilters, homeDir, database)
+        MaterialSearch_GNOME(searchName, orderOfFilters, homeDir, database, profileFilters, profiler, stageCache, chunkSize, stageFormat, parallelParse, limit, sample, topK,
+                             deduplicate, pipelined)
     else:
         print("Database is not recognised. Only database options are 'mp' (Materials Project) and 'gnome' (Google's GNoME database).\nTry again with either of these options, please.")
+        return
+
+    Perf.print_summary()
+    Perf.disable()
+
+
+def _buildPrefixTree(searches:dict) -> dict:
+    """
+    Builds a prefix tree (trie) of filter chains. Each node is one stage, shared by every search whose chain starts with the
+    filters on the path to it, and is owned by the first of those searches - the one that will actually compute the stage.
+    """
+    tree = {"owner": None, "children": {}}
+    for searchName, orderOfFilters in searches.items():
+        node = tree
+        for filter in orderOfFilters:
+            node = node["children"].setdefault(Analysis.FilterTag(filter), {"owner": searchName, "children": {}})
+    return tree
+
+def _longestComputedPrefix(tree, searchName, orderOfFilters, completedSearches):
+    """Returns (owner, length) for the longest leading part of orderOfFilters that a completed search has already computed."""
+    owner, length = None, 0
+    node = tree
+    for counter, filter in enumerate(orderOfFilters):
+        node = node["children"][Analysis.FilterTag(filter)]
+        if(node["owner"] == searchName or node["owner"] not in completedSearches):
+            break
+        owner, length = node["owner"], counter+1
+    return owner, length
+
+INITIAL_STAGE_TAGS = ("Database", "MPquery")
+
+def _readSearchLog(path):
+    """The (analysis tag, number of materials) records of a SearchLog.txt, in order. Lines that aren't "{tag}: {number}" are skipped."""
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            tag, _, number = line.rstrip("\n").rpartition(": ") #analysis tags never contain ": " (see Analysis.FilterTag)
+            if(tag != "" and number.isdigit()):
+                records.append((tag, int(number)))
+    return records
+
+def _copySharedStages(sourceDir, targetDir, orderOfFilters, prefixLength):
+    """
+    Fills a new search directory with the first prefixLength stages (and the initial database stage) of an existing search,
+    so that Analysis skips them. Stage files and stage directories (batches, structures) are copied rather than linked, so
+    rerunning a stage or rewriting a report in one search can never change another search's files. The SearchLog.txt records
+    of the shared stages are copied over too.
+    """
+    sharedTags = [Analysis.FilterTag(filter) for filter in orderOfFilters[:prefixLength]]
+    def isSharedStage(entry):
+        if(entry.startswith("0_")):
+            return True
+        for counter, tag in enumerate(sharedTags):
+            stageName = f"{counter+1}_{tag}"
+            if(entry.startswith(stageName+".") or entry.startswith(stageName+"_")): #stage files and e.g. {stageName}_batches
+                return True
+        return False
+
+    os.mkdir(targetDir)
+    for entry in os.listdir(sourceDir):
+        if(not isSharedStage(entry)):
+            continue
+        sourcePath = os.path.join(sourceDir, entry)
+        if(os.path.isdir(sourcePath)):
+            shutil.copytree(sourcePath, os.path.join(targetDir, entry))
+        else:
+            shutil.copy2(sourcePath, os.path.join(targetDir, entry))
+
+    sharedLog = [] #the database/MP query record, then one record per shared stage, matched in order by tag
+    expected = iter(sharedTags)
+    nextTag = None
+    for tag, number in _readSearchLog(os.path.join(sourceDir, "SearchLog.txt")):
+        if(len(sharedLog) == 0):
+            if(tag in INITIAL_STAGE_TAGS):
+                sharedLog.append((tag, number))
+                nextTag = next(expected, None)
+        elif(tag == nextTag):
+            sharedLog.append((tag, number))
+            nextTag = next(expected, None)
+    with open(os.path.join(targetDir, "SearchLog.txt"), "w") as f:
+        f.writelines(f"{tag}: {number}\n" for tag, number in sharedLog)
+
+def MultiMaterialSearch(searches:dict[str, list], database:str, MPcriteria={}, MPproperties=['material_id', 'pretty_formula', 'spacegroup.number', 'nsites', "nelements"], **searchOptions):
+    """
+    Runs several searches over the same database, computing stages that several searches share only once.
+
+    The filter chains are arranged into a prefix tree: e.g. with
+        {"Oxides": ["Inorganic", "AntiActinide", "ContainsOxygen"], "Halides": ["Inorganic", "AntiActinide", "ContainsHalogen"]}
+    the Inorganic and AntiActinide stages are run for Oxides and reused by Halides, which only runs ContainsHalogen. Reused stages
+    are copied into each search directory, so every search directory still has all of its stage files and its own SearchLog.txt,
+    exactly as if it had been run on its own with MaterialSearch, and can be changed without affecting the others.
+
+    Args:
+
+    searches - a dictionary of {searchName: orderOfFilters}, run in the order given.
+    database, MPcriteria, MPproperties - as for MaterialSearch, shared by every search (the database/MP query stage is shared too).
+    searchOptions - any other keyword arguments of MaterialSearch, e.g. profileFilters.
+    """
+    homeDir = os.getcwd()
+    databaseDirName = {"mp": "MP", "gnome": "GNoME"}.get(database.lower())
+    tree = _buildPrefixTree(searches)
+    completedSearches = set()
+    for searchName, orderOfFilters in searches.items():
+        if(databaseDirName is not None and not os.path.isdir(os.path.join(homeDir, databaseDirName, searchName))):
+            owner, prefixLength = _longestComputedPrefix(tree, searchName, orderOfFilters, completedSearches)
+            if(owner is None and len(completedSearches) != 0):
+                owner = next(iter(completedSearches)) #nothing in common except the database stage, which is still worth sharing
+            if(owner is not None):
+                print(f"Search {searchName}: reusing the database stage and {prefixLength} filter stage(s) from search {owner}.")
+                _copySharedStages(os.path.join(homeDir, databaseDirName, owner), os.path.join(homeDir, databaseDirName, searchName), orderOfFilters, prefixLength)
+        MaterialSearch(searchName, orderOfFilters, database, MPcriteria, MPproperties, **searchOptions)
+        completedSearches.add(searchName)
+
+
+JOIN_MODES = ("merge", "intersect", "anti") #join options of JointMaterialSearch
+JOINT_DIR_NAME = "Joint"
+DATABASE_DIR_NAMES = {"mp": "MP", "gnome": "GNoME"}
+INITIAL_STAGE_NAMES = {"mp": "0_MPquery", "gnome": "0_Database"}
+
+def _finalStage(homeDir, database, searchName, orderOfFilters):
+    """The path (without extension) of the last stage of a search."""
+    stageName = f"{len(orderOfFilters)}_{Analysis.FilterTag(orderOfFilters[-1])}" if len(orderOfFilters) != 0 else INITIAL_STAGE_NAMES[database]
+    return os.path.join(homeDir, DATABASE_DIR_NAMES[database], searchName, stageName)
+
+def _joinKey(result, joinOn):
+    """The join key of a material - the values of joinOn, with formulas reduced the same way for both databases. None if one is missing."""
+    key = []
+    for name in joinOn:
+        value = result.get(name)
+        if(value is None):
+            return None
+        if(name == "pretty_formula"):
+            value = Compositions.get_composition(value).reduced_formula #e.g. the element order can differ between the databases
+        key.append(value)
+    return tuple(key)
+
+def JoinStages(stages:dict, newFileName, join="merge", joinOn=("pretty_formula",), stageFormat=DEFAULT_STAGE_FORMAT, chunkSize=DEFAULT_CHUNK_SIZE):
+    """
+    Joins the stage files of two databases, given as {database: stage file}, into stage newFileName. Returns {database: materials kept}.
+
+    Each material is kept with two new keys:
+        "database": the database it is from
+        "matches": the MaterialIds/material_ids of the materials in the other database with the same joinOn values
+    join is "merge" (every material of both), "intersect" (only materials with a match in the other database) or "anti" (only materials
+    without one, e.g. the GNoME materials whose reduced formula isn't in MP).
+
+    A hash join: the stages are read a chunk at a time, once to index the ids of each database by their join key, and again to write the
+    joined materials, so only the index (keys and ids) is ever held in memory, never the stages themselves.
+    """
+    if(join not in JOIN_MODES):
+        raise ValueError(f"join is one of {', '.join(JOIN_MODES)}, not {join}.")
+    if(len(stages) != 2):
+        raise ValueError(f"Two stages are joined at a time, not {len(stages)}.")
+    idsByKey = {} #database -> join key -> ids
+    with Perf.stage("Join", "index", join=join, joinOn=list(joinOn)) as perfEntry:
+        for database, fileName in stages.items():
+            index = idsByKey[database] = {}
+            for chunk in IterStageChunks(fileName, chunkSize):
+                for result in chunk:
+                    key = _joinKey(result, joinOn)
+                    if(key is not None):
+                        index.setdefault(key, []).append(material_id(result))
+        perfEntry["keys"] = {database: len(index) for database, index in idsByKey.items()}
+
+    kept = {}
+    with Perf.stage("Join", "write", format=stageFormat) as perfEntry:
+        with StageWriter(newFileName, stageFormat) as writer:
+            for database, fileName in stages.items():
+                otherIndex = next(index for other, index in idsByKey.items() if other != database)
+                kept[database] = 0
+                for chunk in IterStageChunks(fileName, chunkSize):
+                    joined = []
+                    for result in chunk:
+                        key = _joinKey(result, joinOn)
+                        matches = otherIndex.get(key, []) if key is not None else []
+                        if(join == "merge" or (join == "intersect") == (len(matches) != 0)):
+                            joined.append({**result, "database": database, "matches": matches})
+                    writer.write(joined)
+                    kept[database] += len(joined)
+        perfEntry["rows_out"] = sum(kept.values())
+        perfEntry["bytes_written"] = Perf.file_size(writer.path)
+    return kept
+
+def _searchProcess(homeDir, searchName, orderOfFilters, database, MPcriteria, MPproperties, processes, searchOptions):
+    """Runs one database's search of a JointMaterialSearch, in its own (forked) process."""
+    os.chdir(homeDir)
+    Batching.setup(processes=processes, initializer=Compositions.warm) #the cores are shared between the searches
+    MaterialSearch(searchName, orderOfFilters, database, MPcriteria, MPproperties, **searchOptions)
+
+def JointMaterialSearch(searchName:str, orderOfFilters:list, join:str="merge", joinOn=("pretty_formula",), MPcriteria={},
+                        MPproperties=['material_id', 'pretty_formula', 'spacegroup.number', 'nsites', "nelements"], parallel:bool=True, **searchOptions):
+    """
+    Runs the same search over both the MP and GNoME databases, then joins their results.
+
+    e.g. the GNoME binary oxides whose reduced formula has no entry in MP:
+        JointMaterialSearch("BinaryOxides", ["Inorganic", ("ContainsAny", ["O"]), "BinaryComp"], join="anti")
+    and then the materials with "database": "gnome" in Joint/BinaryOxides/anti-pretty_formula.json.
+    Filters that read structures from by_id/ (GNOME_ONLY_FILTERS, e.g. Dimensionality) can't be used, since the MP materials have none there.
+
+    Args:
+
+    searchName, orderOfFilters - as for MaterialSearch. Each database's search is in its usual directory (MP/{searchName} and GNoME/{searchName}),
+                                 and can be looked at, or resumed, as if it had been run on its own.
+    join - "merge", "intersect" or "anti" - see JoinStages. The joined materials are saved in Joint/{searchName}/{join}-{joinOn} (with an Excel report).
+    joinOn - the properties materials are matched on, e.g. ("pretty_formula", "spacegroup.number"). Reduced formulas are compared as compositions.
+    MPcriteria, MPproperties - as for MaterialSearch. MPproperties needs the joinOn properties.
+    parallel - runs the two searches at the same time, in separate processes with half of the worker processes each. Otherwise one after the other.
+    searchOptions - any other keyword arguments of MaterialSearch, e.g. chunkSize (also the number of rows read at a time by the join) or stageFormat.
+    """
+    if(join not in JOIN_MODES):
+        raise ValueError(f"join is one of {', '.join(JOIN_MODES)}, not {join}.")
+    gnomeOnly = [Analysis.FilterName(filter) for filter in orderOfFilters if Analysis.FilterName(filter) in GNOME_ONLY_FILTERS]
+    if(len(gnomeOnly) != 0): #checked before either search starts, rather than failing part way through the MP one
+        raise ValueError(f"{', '.join(gnomeOnly)} only work on the GNoME database (they read structures from by_id/), so can't be used in a joint search.")
+    homeDir = os.getcwd()
+    APIkeyChecker() #asks for the key here if it hasn't been saved, since the search processes can't
+    databases = ("mp", "gnome")
+    if(parallel):
+        context = multiprocess.get_context("fork")
+        processes = max(1, (os.cpu_count() or 1)//len(databases))
+        searches = {database: context.Process(target=_searchProcess, args=(homeDir, searchName, orderOfFilters, database, MPcriteria, MPproperties,
+                                                                           processes, searchOptions))
+                    for database in databases}
+        for process in searches.values():
+            process.start()
+        for process in searches.values():
+            process.join()
+        failed = [f"{database} (exit code {process.exitcode})" for database, process in searches.items() if process.exitcode != 0]
+        if(len(failed) != 0):
+            raise RuntimeError(f"Joint search {searchName} failed for {' and '.join(failed)} - see its output above.")
+    else:
+        for database in databases:
+            MaterialSearch(searchName, orderOfFilters, database, MPcriteria, MPproperties, **searchOptions)
+
+    jointDir = os.path.join(homeDir, JOINT_DIR_NAME, searchName)
+    os.makedirs(jointDir, exist_ok=True)
+    os.chdir(jointDir)
+    Perf.enable(os.getcwd(), searchName)
+    newFileName = Analysis.FilterTag((join, list(joinOn)))
+    if(StageFile(newFileName) is None):
+        stages = {database: _finalStage(homeDir, database, searchName, orderOfFilters) for database in databases}
+        kept = JoinStages(stages, newFileName, join, joinOn, searchOptions.get("stageFormat", DEFAULT_STAGE_FORMAT),
+                          searchOptions.get("chunkSize") or DEFAULT_CHUNK_SIZE)
+        with Perf.stage("Join", "report", rows_in=sum(kept.values())):
+            ConvertJSONresultsToExcel(newFileName, searchOptions.get("chunkSize"))
+        with open("SearchLog.txt", mode="a") as f:
+            f.writelines(f"{newFileName} ({database}): {numOfMaterials}\n" for database, numOfMaterials in kept.items())
+        print(f"{' and '.join(f'{numOfMaterials} {database}' for database, numOfMaterials in kept.items())} materials kept by the {join} join.")
+    else:
+        print(f"The {join} join has already been done for search {searchName}.")
+    os.chdir(homeDir)
+    Perf.print_summary()
+    Perf.disable()
+
+
+if __name__ == "__main__":
+    import tempfile
+    import unittest
+    from StageIO import ReadStage
+
+    GNOME_ROWS = [("id0", "Fe2O3", ["Fe", "O"]), ("id1", "NaCl", ["Na", "Cl"]), ("id2", "ZnO", ["Zn", "O"]), ("id3", "Li2O", ["Li", "O"]),
+                  ("id4", "LiFePO4", ["Li", "Fe", "P", "O"])]
+    MP_ROWS = [{"material_id": "mp-0", "pretty_formula": "O3Fe2", "spacegroup.number": 167, "nsites": 10, "nelements": 2}, #Fe2O3, with the elements the other way round
+               {"material_id": "mp-1", "pretty_formula": "NaCl", "spacegroup.number": 225, "nsites": 2, "nelements": 2},
+               {"material_id": "mp-2", "pretty_formula": "ZnO2", "spacegroup.number": 205, "nsites": 12, "nelements": 2}]
+
+    class JointMaterialSearchTest(unittest.TestCase):
+        """Runs small joint searches, with a made-up GNoME database and an MP query that has already been done (so no API key is needed)."""
+        def setUp(self):
+            self.previousDirectory = os.getcwd()
+            self.directory = tempfile.TemporaryDirectory()
+            os.chdir(self.directory.name)
+            pd.DataFrame([{"MaterialId": materialId, "Composition": formula, "Elements": str(elements), "Reduced Formula": formula, "NSites": 5,
+                           "Volume": 50.0, "Density": 3.0, "Space Group": "P1", "Space Group Number": 1, "Crystal System": "triclinic"}
+                          for materialId, formula, elements in GNOME_ROWS]).to_csv("stable_materials_summary.csv", index=False)
+            with open("APIkey.txt", "w") as f:
+                f.write("unused")
+
+        def tearDown(self):
+            os.chdir(self.previousDirectory)
+            self.directory.cleanup()
+
+        def _search(self, searchName, orderOfFilters, join, parallel):
+            os.makedirs(os.path.join("MP", searchName))
+            SaveStage(os.path.join("MP", searchName, "0_MPquery"), MP_ROWS, "json")
+            with open(os.path.join("MP", searchName, "SearchLog.txt"), "w") as f:
+                f.write(f"MPquery: {len(MP_ROWS)}\n")
+            JointMaterialSearch(searchName, orderOfFilters, join=join, parallel=parallel)
+            return {(result["database"], material_id(result)): result["matches"]
+                    for result in ReadStage(os.path.join(JOINT_DIR_NAME, searchName, f"{join}-pretty_formula"))}
+
+        def test_anti_join(self):
+            joined = self._search("BinaryOxides", ["Inorganic", ("ContainsAny", ["O"]), "BinaryComp"], "anti", parallel=True)
+            self.assertEqual(joined, {("mp", "mp-2"): [], ("gnome", "id2"): [], ("gnome", "id3"): []})
+
+        def test_merge_and_intersect(self):
+            joined = self._search("Binaries", ["BinaryComp"], "merge", parallel=False)
+            self.assertEqual(joined, {("mp", "mp-0"): ["id0"], ("mp", "mp-1"): ["id1"], ("mp", "mp-2"): [],
+                                      ("gnome", "id0"): ["mp-0"], ("gnome", "id1"): ["mp-1"], ("gnome", "id2"): [], ("gnome", "id3"): []})
+            JointMaterialSearch("Binaries", ["BinaryComp"], join="intersect") #reuses both searches
+            self.assertEqual(len(ReadStage(os.path.join(JOINT_DIR_NAME, "Binaries", "intersect-pretty_formula"))), 4)
+
+        def test_gnome_only_filters_are_rejected(self):
+            with self.assertRaises(ValueError):
+                JointMaterialSearch("2D", ["Inorganic", ("Dimensionality", {"dim": 2})], join="anti")
+            self.assertFalse(os.path.exists("MP") or os.path.exists("GNoME")) #before either search started
+
+    unittest.main()
@@ -0,0 +1,163 @@
+import math
+from functools import lru_cache
+from itertools import combinations_with_replacement
+
+import numpy as np
+from pymatgen.core.composition import Composition
+from pymatgen.core.periodic_table import Species
+
+from Compositions import COMPOSITION_CACHE_SIZE, get_composition, get_element
+
+#Fast oxidation state guessing, giving the same answers as pymatgen's Composition.add_charges_from_oxi_state_guesses.
+#
+#pymatgen works out each formula from scratch: for every element it enumerates every combination of oxidation states over its sites
+#(scoring each one with the ICSD occurrence statistics), then tries every combination of those per-element sums for charge balance.
+#Here the per-element part - the possible sums for n sites of an element, and the best scoring combination for each sum - is a table
+#worked out once per (element, n) with NumPy and shared by every formula, and the search over the elements of a formula is a NumPy
+#outer sum over those tables. Ties are broken as pymatgen breaks them, so the guesses are identical.
+#
+#Formulas are guessed one at a time, and each formula's guess is cached (species_of). The guesses for a list of formulas can be had as one
+#structured array of species, one row per (formula, element, charge):
+#       species = guess_oxidation_states(["Fe3O4", "NaCl"])
+#       species["formula"]  -> [0, 0, 0, 1, 1]            (index into the formulas)
+#       species["element"]  -> ["Fe", "Fe", "O", "Na", "Cl"]
+#       species["charge"]   -> [2, 3, -2, 1, -1]
+#       species["amount"]   -> [1., 2., 4., 1., 1.]
+#Formulas with no charge balanced guess have every element at charge 0, as in pymatgen; is_charge_balanced tells them apart from
+#formulas whose guess is all zeros (single elements, which pymatgen always counts as balanced).
+
+MAX_COMBINATIONS = 2_000_000 #oxidation state combinations enumerated for one element, or per-element sums tried for one formula; beyond this pymatgen is used
+SPECIES_DTYPE = np.dtype([("formula", np.int64), ("element", "U3"), ("charge", np.int8), ("amount", np.float64)])
+
+
+def _oxidationStateProbabilities():
+    if(Composition.oxi_prob is None):
+        get_composition("NaCl").oxi_state_guesses() #makes pymatgen load its table of ICSD oxidation state occurrences
+    return Composition.oxi_prob
+
+
+@lru_cache(maxsize=None)
+def _elementTable(symbol, numOfSites):
+    """
+    For numOfSites sites of an element: (possible sums of their oxidation states, in the order pymatgen finds them; the best score for each
+    sum; the oxidation states of the first combination with that score, one row per sum). None if there are too many combinations.
+    """
+    element = get_element(symbol)
+    oxidationStates = np.array(element.icsd_oxidation_states or element.common_oxidation_states, dtype=np.int64)
+    if(len(oxidationStates) == 0):
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros((0, numOfSites), dtype=np.int64)
+    if(math.comb(numOfSites+len(oxidationStates)-1, numOfSites) > MAX_COMBINATIONS):
+        return None
+    probabilities = _oxidationStateProbabilities()
+    stateProbabilities = np.array([probabilities.get(Species(symbol, state), 0) for state in oxidationStates], dtype=float)
+    combinations = np.array(list(combinations_with_replacement(range(len(oxidationStates)), numOfSites)), dtype=np.int64)
+    sums = oxidationStates[combinations].sum(axis=1)
+    scores = np.zeros(len(combinations))
+    for site in range(numOfSites): #added site by site, as pymatgen does, so the scores are bit for bit the same
+        scores += stateProbabilities[combinations[:, site]]
+
+    distinctSums, firstSeen, sumOfCombination = np.unique(sums, return_index=True, return_inverse=True)
+    #pymatgen keeps the first combination with the highest score for each sum
+    order = np.lexsort((np.arange(len(combinations)), -scores, sumOfCombination))
+    groupStarts = np.flatnonzero(np.r_[True, np.diff(sumOfCombination[order]) != 0])
+    best = order[groupStarts] #one per distinct sum, in order of the sums
+    appearance = np.argsort(firstSeen, kind="stable") #pymatgen lists the sums in the order it first meets them
+    return distinctSums[appearance], scores[best][appearance], oxidationStates[combinations[best][appearance]]
+
+
+def _fromPymatgen(composition, reduce):
+    guessed = composition.add_charges_from_oxi_state_guesses(max_sites=-1 if reduce else None)
+    species = tuple((species.symbol, int(species.oxi_state), float(amount)) for species, amount in guessed.items())
+    #no element has 0 among its oxidation states, so all zeros from more than one element is pymatgen's answer for no balanced guess
+    return species, len(species) == 1 or any(charge != 0 for _, charge, _ in species)
+
+@lru_cache(maxsize=COMPOSITION_CACHE_SIZE)
+def _guess(formula, reduce):
+    """(species, as returned by species_of; whether they are a charge balanced guess)"""
+    composition = get_composition(formula)
+    guessedComposition = composition.reduced_composition if reduce else composition
+    amounts = guessedComposition.get_el_amt_dict()
+    if(not all(amount == int(amount) for amount in amounts.values())):
+        raise ValueError("Charge balance analysis requires integer values in Composition!")
+    tables = [_elementTable(symbol, int(amount)) for symbol, amount in amounts.items()]
+    if(any(table is None for table in tables) or math.prod(len(table[0]) for table in tables) > MAX_COMBINATIONS):
+        return _fromPymatgen(composition, reduce)
+
+    totals, scores = np.zeros(()), np.zeros(())
+    for sums, sumScores, _ in tables: #every combination of one sum per element, in the order itertools.product gives them
+        totals = np.add.outer(totals, sums)
+        scores = np.add.outer(scores, sumScores)
+    balanced = totals == 0
+    if(not balanced.any()): #pymatgen counts a single element (at charge 0) as balanced
+        return tuple((symbol, 0, float(amount)) for symbol, amount in composition.get_el_amt_dict().items()), len(amounts) == 1
+    best = np.unravel_index(np.argmax(np.where(balanced, scores, -np.inf)), totals.shape) #the first of the highest scoring guesses
+    species = {}
+    for symbol, (_, _, states), sumIndex in zip(amounts, tables, best):
+        for state in states[sumIndex].tolist():
+            species[(symbol, state)] = species.get((symbol, state), 0) + 1
+    return tuple((symbol, state, float(amount)) for (symbol, state), amount in species.items()), True
+
+def species_of(formula, reduce=False):
+    """
+    The guessed species of one formula, as ((element, charge, amount), ...) in the order of
+    Composition(formula).add_charges_from_oxi_state_guesses(max_sites=-1 if reduce else None).
+    """
+    return _guess(formula, reduce)[0]
+
+def is_charge_balanced(formula, reduce=False):
+    """Whether species_of(formula, reduce) is a charge balanced guess - i.e. whether pymatgen's oxi_state_guesses finds any."""
+    return _guess(formula, reduce)[1]
+
+
+def guess_oxidation_states(formulas, reduce=False):
+    """
+    The guesses of species_of for every formula, collected into one structured array with SPECIES_DTYPE, sorted by formula: see above.
+    reduce as for species_of.
+    """
+    rows = [(i, symbol, charge, amount) for i, formula in enumerate(formulas) for symbol, charge, amount in species_of(formula, reduce)]
+    return np.array(rows, dtype=SPECIES_DTYPE)
+
+def by_formula(species, numOfFormulas):
+    """Splits the array from guess_oxidation_states into one array per formula."""
+    return np.split(species, np.searchsorted(species["formula"], np.arange(1, numOfFormulas)))
+
+
+if __name__ == "__main__":
+    import unittest
+
+    FORMULAS = ["NaCl", "Fe3O4", "Fe2O3", "BiO2", "LiCoO2", "MoS2", "CH4", "UO2", "Fe", "He", "NaCl2", "Ba2YCu3O7", "Mn3O4", "Pb3O4", "KFe2(CN)6",
+                "V2O5", "Cs2AgBiBr6", "Ti3C2", "Na2Cl2", "Co3(PO4)2"]
+
+    class OxidationStatesTest(unittest.TestCase):
+        def test_same_as_pymatgen(self):
+            for reduce in (False, True):
+                for formula in FORMULAS:
+                    expected = _fromPymatgen(Composition(formula), reduce)[0]
+                    self.assertEqual(species_of(formula, reduce), expected, formula)
+
+        def test_batch(self):
+            species = guess_oxidation_states(["Fe3O4", "He", "NaCl"])
+            self.assertEqual(species["formula"].tolist(), [0, 0, 0, 1, 2, 2])
+            self.assertEqual(species["element"].tolist(), ["Fe", "Fe", "O", "He", "Na", "Cl"])
+            self.assertEqual(species["charge"].tolist(), [2, 3, -2, 0, 1, -1])
+            self.assertEqual(species["amount"].tolist(), [1, 2, 4, 1, 1, 1])
+            self.assertEqual([len(rows) for rows in by_formula(species, 3)], [3, 1, 2])
+
+        def test_charge_balance(self):
+            for reduce in (False, True):
+                for formula in FORMULAS:
+                    expected = len(Composition(formula).oxi_state_guesses(max_sites=-1 if reduce else None)) > 0
+                    self.assertEqual(is_charge_balanced(formula, reduce), expected, formula)
+            self.assertFalse(is_charge_balanced("NaCl2")) #can't be balanced, so every charge is 0
+            self.assertEqual(species_of("NaCl2"), (("Na", 0, 1.0), ("Cl", 0, 2.0)))
+            self.assertTrue(is_charge_balanced("Fe"))
+            global MAX_COMBINATIONS
+            maxCombinations, MAX_COMBINATIONS = MAX_COMBINATIONS, 0 #through pymatgen
+            try:
+                _guess.cache_clear()
+                self.assertEqual([is_charge_balanced(formula) for formula in ("NaCl2", "Fe", "Fe3O4")], [False, True, True])
+            finally:
+                MAX_COMBINATIONS = maxCombinations
+                _guess.cache_clear()
+
+    unittest.main()
@@ -0,0 +1,176 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import resource #only available on Unix-like systems
+except ImportError:
+    resource = None
+
+#Performance instrumentation for searches.
+#When enabled (MaterialSearch does this for every search), each timed step is appended as one JSON object per line
+#to PerfLog.jsonl, which sits next to SearchLog.txt in the search directory. When disabled every call here is a no-op,
+#so the functions can be used freely in code that also runs outside of a search (e.g. the Batching canary tests).
+
+PERF_LOG_NAME = "PerfLog.jsonl"
+
+_perfLogPath = None
+_searchName = None
+_runId = None
+_stageStack = [] #names of the stages currently being timed, innermost last
+
+
+def enable(searchDir, searchName):
+    """Starts writing perf records to PerfLog.jsonl in searchDir. Records from this call onwards share a run id."""
+    global _perfLogPath, _searchName, _runId
+    _perfLogPath = os.path.join(os.path.abspath(searchDir), PERF_LOG_NAME)
+    _searchName = searchName
+    _runId = datetime.now().strftime("%Y%m%dT%H%M%S.%f")
+
+def disable():
+    global _perfLogPath, _searchName, _runId
+    _perfLogPath = None
+    _searchName = None
+    _runId = None
+
+def is_enabled():
+    return _perfLogPath is not None
+
+def current_log_path():
+    return _perfLogPath
+
+def current_run_id():
+    return _runId
+
+def current_stage(default="unknown"):
+    """The name of the innermost stage currently being timed, so nested code can label its records without being told."""
+    return _stageStack[-1] if len(_stageStack) != 0 else default
+
+
+def peak_rss_mb(children=False):
+    """Peak resident set size of this process (or of its largest child process) in MB. None if unavailable."""
+    if(resource is None):
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    if(sys.platform == "darwin"): #macOS reports bytes, Linux reports kilobytes
+        peak /= 1024
+    return round(peak/1024, 2)
+
+def file_size(path):
+    """Size of a file in bytes, or None if it doesn't exist."""
+    if(os.path.isfile(path)):
+        return os.path.getsize(path)
+    return None
+
+def latency_summary(latencies):
+    """Percentile summary (in seconds) of a list of per-task latencies."""
+    if(len(latencies) == 0):
+        return None
+    latencies = np.asarray(latencies, dtype=float)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {"n": int(latencies.size),
+            "mean": round(float(latencies.mean()), 6),
+            "p50": round(float(p50), 6),
+            "p90": round(float(p90), 6),
+            "p99": round(float(p99), 6),
+            "max": round(float(latencies.max()), 6)}
+
+
+def record(entry):
+    """Appends a single record to the perf log (if enabled)."""
+    if(not is_enabled()):
+        return
+    entry = {"time": datetime.now().isoformat(timespec="seconds"), "search": _searchName, "run": _runId, **entry}
+    with open(_perfLogPath, mode="a") as f:
+        f.write(json.dumps(entry, default=str) + "\n")
+
+
+@contextmanager
+def stage(stageName, step, **fields):
+    """
+    Times a block of code and writes one perf record for it.
+
+    The yielded dictionary can be filled in by the timed code with extra fields, e.g. rows_out or bytes_written.
+    Wall time, CPU time, throughput (if rows_in is given) and peak RSS are added automatically.
+
+    Usage:
+        with Perf.stage("Inorganic", "filter", rows_in=len(results)) as entry:
+            filteredResults = ...
+            entry["rows_out"] = len(filteredResults)
+    """
+    entry = {"stage": stageName, "step": step, "depth": len(_stageStack), **fields} #depth > 0 means this step is nested inside another timed step
+    _stageStack.append(stageName)
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    try:
+        yield entry
+    finally:
+        _stageStack.pop()
+        wall = time.perf_counter() - wallStart
+        entry["wall_s"] = round(wall, 6)
+        entry["cpu_s"] = round(time.process_time() - cpuStart, 6)
+        rows = entry.get("rows_in", entry.get("rows_out"))
+        if(rows is not None and wall > 0):
+            entry["rows_per_s"] = round(rows/wall, 2)
+        entry["peak_rss_mb"] = peak_rss_mb()
+        record(entry)
+
+
+def read_log(path=None, runId=None):
+    """Reads the records of a perf log. By default only the records of the current run are returned."""
+    path = path if path is not None else _perfLogPath
+    runId = runId if runId is not None else _runId
+    if(path is None or not os.path.isfile(path)):
+        return []
+    with open(path, "r") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    if(runId is not None):
+        entries = [entry for entry in entries if entry.get("run") == runId]
+    return entries
+
+
+def summary_table(entries):
+    """Formats perf records as a plain text table (one row per record)."""
+    def mb(value):
+        return "" if value is None else f"{value/1e6:.2f}"
+    def num(value, fmt):
+        return "" if value is None else format(value, fmt)
+
+    headings = ["stage", "step", "wall (s)", "cpu (s)", "rows in", "rows out", "rows/s", "MB read", "MB written", "peak RSS (MB)", "task p50/p99 (s)"]
+    rows = []
+    for entry in entries:
+        latency = entry.get("task_latency")
+        rows.append([str(entry.get("stage", "")),
+                     "  "*entry.get("depth", 0) + str(entry.get("step", "")),
+                     num(entry.get("wall_s"), ".3f"),
+                     num(entry.get("cpu_s"), ".3f"),
+                     num(entry.get("rows_in"), "d"),
+                     num(entry.get("rows_out"), "d"),
+                     num(entry.get("rows_per_s"), ".1f"),
+                     mb(entry.get("bytes_read")),
+                     mb(entry.get("bytes_written")),
+                     num(entry.get("peak_rss_mb"), ".1f"),
+                     "" if latency is None else f"{latency['p50']:.3f}/{latency['p99']:.3f}"])
+    widths = [max(len(row[i]) for row in rows+[headings]) for i in range(len(headings))]
+    lines = ["  ".join(heading.ljust(width) for heading, width in zip(headings, widths))]
+    lines.append("  ".join("-"*width for width in widths))
+    for row in rows:
+        lines.append("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+    return "\n".join(lines)
+
+
+def print_summary():
+    """Prints a summary table of the current run's perf log, if there is anything to show."""
+    entries = read_log()
+    if(len(entries) == 0):
+        return
+    total = sum(entry.get("wall_s", 0) for entry in entries if entry.get("depth", 0) == 0) #nested steps are already counted in their parent step
+    print(f"\nPerformance summary for search {_searchName} (full records in {_perfLogPath}):")
+    print(summary_table(entries))
+    print(f"Total recorded time: {total:.2f} s\n")
@@ -0,0 +1,199 @@
+import cProfile
+import io
+import os
+import pstats
+import shutil
+import sys
+import threading
+from collections import Counter
+from functools import wraps
+
+#Opt-in profiling of individual filters.
+#MaterialSearch(..., profileFilters=["ChargeBalance"]) wraps the named filters with a profiler. While a profiled filter is running,
+#Batching.batch_map also profiles every task inside the worker processes; each worker keeps its own profile file, and once the
+#filter finishes all of them are merged with the profile of the main process into a single per-stage profile in the search directory:
+#   "cprofile" -> {tag}_profile.prof (open with pstats or snakeviz) and a readable {tag}_profile.txt
+#   "sampling" -> {tag}_profile.folded (collapsed stacks, usable with flamegraph.pl/speedscope) and a readable {tag}_profile.txt
+
+PROFILERS = ("cprofile", "sampling")
+SAMPLING_INTERVAL = 0.005 #seconds between samples for the sampling profiler
+
+_workerProfileSpec = None #(directory, profiler) while a profiled filter is running in this process, None otherwise
+
+
+class SamplingProfiler():
+    """
+    A minimal statistical profiler.
+
+    A background thread periodically takes the stack of the thread that called start() and counts how often each stack is seen.
+    Much lower overhead than cProfile for filters that spend their time in many small calls (e.g. pymatgen/smact internals).
+    """
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.counts = Counter()
+        self._stopEvent = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._targetThreadId = threading.get_ident()
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopEvent.set()
+        if(self._thread is not None):
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        while(not self._stopEvent.wait(self.interval)):
+            frame = sys._current_frames().get(self._targetThreadId)
+            stack = []
+            while(frame is not None):
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if(len(stack) != 0):
+                self.counts[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        write_folded(path, self.counts)
+
+
+def write_folded(path, counts):
+    with open(path, "w") as f:
+        for stack, count in counts.most_common():
+            f.write(f"{stack} {count}\n")
+
+def read_folded(path):
+    counts = Counter()
+    with open(path, "r") as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if(stack != ""):
+                counts[stack] += int(count)
+    return counts
+
+def folded_report(counts, top=50):
+    """Readable summary of collapsed stacks: the functions with the most samples on top of the stack (self) and anywhere in it (total)."""
+    selfCounts = Counter()
+    totalCounts = Counter()
+    for stack, count in counts.items():
+        frames = stack.split(";")
+        selfCounts[frames[-1]] += count
+        for frame in set(frames):
+            totalCounts[frame] += count
+    numOfSamples = sum(counts.values())
+    lines = [f"{numOfSamples} samples ({SAMPLING_INTERVAL*1000:.0f} ms interval)", "", "Self samples:"]
+    lines += [f"{count:>10}  {100*count/max(numOfSamples, 1):6.2f}%  {frame}" for frame, count in selfCounts.most_common(top)]
+    lines += ["", "Total samples (including callees):"]
+    lines += [f"{count:>10}  {100*count/max(numOfSamples, 1):6.2f}%  {frame}" for frame, count in totalCounts.most_common(top)]
+    return "\n".join(lines) + "\n"
+
+
+def pstats_report(stats, top=50):
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats("cumulative").print_stats(top)
+    stats.sort_stats("tottime").print_stats(top)
+    return stream.getvalue()
+
+
+def worker_profile_spec():
+    """The (directory, profiler) that worker tasks should profile into, or None if no profiled filter is running."""
+    return _workerProfileSpec
+
+
+#worker side - pool processes outlive a stage, so each worker accumulates one profile over all of its tasks for the current stage
+#and starts afresh when it sees tasks for a different stage
+_workerProfileDir = None
+_workerCProfile = None
+_workerSampleCounts = None
+
+def profiled_task(profileSpec, func, *args):
+    """Runs a single batch_map task inside a worker process under the requested profiler, then saves the worker's cumulative profile."""
+    global _workerProfileDir, _workerCProfile, _workerSampleCounts
+    directory, profiler = profileSpec
+    if(directory != _workerProfileDir):
+        _workerProfileDir = directory
+        _workerCProfile = None
+        _workerSampleCounts = None
+    workerFile = os.path.join(directory, f"worker_{os.getpid()}")
+    if(profiler == "cprofile"):
+        if(_workerCProfile is None):
+            _workerCProfile = cProfile.Profile()
+        _workerCProfile.enable()
+        try:
+            return func(*args)
+        finally:
+            _workerCProfile.disable()
+            _workerCProfile.dump_stats(f"{workerFile}.prof")
+    else:
+        if(_workerSampleCounts is None):
+            _workerSampleCounts = Counter()
+        sampler = SamplingProfiler()
+        sampler.start()
+        try:
+            return func(*args)
+        finally:
+            sampler.stop()
+            _workerSampleCounts.update(sampler.counts)
+            write_folded(f"{workerFile}.folded", _workerSampleCounts)
+
+
+def profiled(func, stageName, profiler="cprofile", directory="."):
+    """
+    Wraps a filter so that every call to it is profiled, including the tasks it hands to Batching.batch_map.
+
+    The merged profile is written to {stageName}_profile.* in directory (the search directory by default).
+    """
+    if(profiler not in PROFILERS):
+        raise ValueError(f"Profiler {profiler} is not recognised. Options are: {', '.join(PROFILERS)}")
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        global _workerProfileSpec
+        outputBase = os.path.join(os.path.abspath(directory), f"{stageName}_profile")
+        workerDir = f"{outputBase}_workers"
+        if(os.path.isdir(workerDir)):
+            shutil.rmtree(workerDir) #left over from an interrupted run
+        os.mkdir(workerDir)
+        _workerProfileSpec = (workerDir, profiler)
+        if(profiler == "cprofile"):
+            mainProfiler = cProfile.Profile()
+            mainProfiler.enable()
+        else:
+            mainProfiler = SamplingProfiler()
+            mainProfiler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if(profiler == "cprofile"):
+                mainProfiler.disable()
+            else:
+                mainProfiler.stop()
+            _workerProfileSpec = None
+            _merge(mainProfiler, profiler, workerDir, outputBase)
+            shutil.rmtree(workerDir)
+            print(f"Profile for {stageName} written to {outputBase}.txt")
+    return wrapper
+
+
+def _merge(mainProfiler, profiler, workerDir, outputBase):
+    workerFiles = sorted(os.path.join(workerDir, fileName) for fileName in os.listdir(workerDir))
+    if(profiler == "cprofile"):
+        stats = pstats.Stats(mainProfiler)
+        for workerFile in workerFiles:
+            stats.add(workerFile)
+        stats.dump_stats(f"{outputBase}.prof")
+        report = pstats_report(stats)
+    else:
+        counts = Counter(mainProfiler.counts)
+        for workerFile in workerFiles:
+            counts.update(read_folded(workerFile))
+        write_folded(f"{outputBase}.folded", counts)
+        report = folded_report(counts)
+    with open(f"{outputBase}.txt", "w") as f:
+        f.write(f"Merged profile of the main process and {len(workerFiles)} worker process(es)\n\n")
+        f.write(report)
@@ -0,0 +1,260 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+#A columnar container for the results of a stage, as an alternative to a list of dictionaries.
+#
+#A stage's results are a list with one dictionary per material, repeating every key (and every formula and space group string)
+#for every row. A ResultSet keeps one NumPy array per property instead:
+#   - numbers and booleans are stored as int64/float64/bool arrays,
+#   - strings that repeat (formulas, space group symbols, crystal systems, ...) are categorical - an array of integer codes into
+#     an array of the distinct values - so each distinct value is stored (and e.g. parsed as a formula) only once,
+#   - everything else (unique IDs, lists, structures) is kept in object arrays.
+#Rows are selected with boolean masks or index arrays, so filters can be written as NumPy expressions over whole columns:
+#       keep = results["nsites"] <= 20
+#       return results.select(keep)
+#
+#For backward compatibility a ResultSet also behaves like the list of dictionaries it replaces: len(results), results[i],
+#results[a:b] and "for result in results" all work, and each row is a RowView - a read/write dictionary-like view of one row.
+#Existing filters that loop over rows and return a list of the rows they keep work unchanged.
+#
+#Filters opt in with the @columnar decorator; Analysis.ReadAnalyseWrite then hands them a ResultSet instead of a list of
+#dictionaries, and turns whatever they return back into records for the stage file.
+
+CATEGORICAL_MAX_FRACTION = 0.5 #string columns with fewer distinct values than this fraction of rows are stored as categorical
+
+class _Missing():
+    def __repr__(self):
+        return "MISSING"
+MISSING = _Missing() #marks rows that do not have a key, since rows don't have to share every key
+
+
+def columnar(func):
+    """Marks a filter as taking (and returning) a ResultSet rather than a list of dictionaries."""
+    func.columnar = True
+    return func
+
+def is_columnar(func):
+    return getattr(func, "columnar", False) #functools.wraps copies the marker onto wrappers (e.g. Profiling.profiled)
+
+
+def _columnFromValues(values):
+    """Picks the most compact storage for one column. Returns (kind, array, categories)."""
+    types = set(type(value) for value in values)
+    if(types == {bool}):
+        return "numeric", np.array(values, dtype=bool), None
+    if(types == {int}):
+        try:
+            return "numeric", np.array(values, dtype=np.int64), None
+        except OverflowError:
+            pass
+    if(types == {float}):
+        return "numeric", np.array(values, dtype=np.float64), None
+    if(types == {str} and len(values) != 0):
+        distinct = {} #value -> code, in order of first appearance (a dictionary is much faster than sorting the strings)
+        codes = [distinct.setdefault(value, len(distinct)) for value in values]
+        if(len(distinct) <= CATEGORICAL_MAX_FRACTION*len(values)):
+            categories = np.empty(len(distinct), dtype=object)
+            categories[:] = list(distinct)
+            return "categorical", np.array(codes, dtype=np.int32), categories
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return "object", column, None
+
+
+class ResultSet():
+    """
+    Usage:
+        results = ResultSet.from_records(ReadJSONFile("1_Inorganic"))
+        keep = results["nelements"] == 2
+        binaries = results.select(keep)
+        SaveDictAsJSON("2_BinaryComp", binaries.to_records())
+    """
+    def __init__(self, columns, kinds, categories, length):
+        self._columns = columns #name -> array (codes for categorical columns), in the order the keys first appear
+        self._kinds = kinds #name -> "numeric", "categorical" or "object"
+        self._categories = categories #name -> array of distinct values, for categorical columns
+        self._length = length
+
+    @classmethod
+    def from_records(cls, records):
+        records = list(records)
+        names = {}
+        for record in records:
+            for name in record:
+                names.setdefault(name, None)
+        columns, kinds, categories = {}, {}, {}
+        for name in names:
+            values = [record.get(name, MISSING) for record in records]
+            kinds[name], columns[name], categories[name] = _columnFromValues(values)
+        return cls(columns, kinds, categories, len(records))
+
+    @staticmethod
+    def as_records(results):
+        """Turns what a filter returned - a ResultSet, a list of RowViews or a list of dictionaries - into a list of dictionaries."""
+        if(isinstance(results, ResultSet)):
+            return results.to_records()
+        if(isinstance(results, list) and any(isinstance(row, RowView) for row in results)):
+            return [row.to_dict() if isinstance(row, RowView) else row for row in results]
+        return results
+
+    def to_records(self):
+        names = list(self._columns)
+        decoded = [self.column(name).tolist() for name in names] #tolist turns NumPy scalars back into Python ones
+        records = [dict(zip(names, row)) for row in zip(*decoded)] if len(names) != 0 else [{} for _ in range(self._length)]
+        for name, values in zip(names, decoded):
+            if(self._kinds[name] == "object" and any(value is MISSING for value in values)):
+                for record in records:
+                    if(record[name] is MISSING):
+                        del record[name]
+        return records
+
+    def __len__(self):
+        return self._length
+
+    def keys(self):
+        return list(self._columns)
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def column(self, name):
+        """The values of a column (categorical columns decoded back to their values)."""
+        if(self._kinds[name] == "categorical"):
+            return self._categories[name][self._columns[name]]
+        return self._columns[name]
+
+    def categorical(self, name):
+        """(distinct values, code of each row) for a column, e.g. to do per-formula work once per distinct formula."""
+        if(self._kinds[name] == "categorical"):
+            return self._categories[name], self._columns[name]
+        distinct = {}
+        codes = np.array([distinct.setdefault(value, len(distinct)) for value in self._columns[name].tolist()], dtype=np.int32)
+        categories = np.empty(len(distinct), dtype=object)
+        categories[:] = list(distinct)
+        return categories, codes
+
+    def __getitem__(self, key):
+        if(isinstance(key, str)):
+            return self.column(key)
+        if(isinstance(key, slice)):
+            return self.take(np.arange(self._length)[key])
+        if(key < 0):
+            key += self._length
+        if(not 0 <= key < self._length):
+            raise IndexError("ResultSet index out of range")
+        return RowView(self, key)
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield RowView(self, i)
+
+    def take(self, indices):
+        """A new ResultSet with the given rows, in the given order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        columns = {name: column[indices] for name, column in self._columns.items()}
+        return ResultSet(columns, dict(self._kinds), dict(self._categories), len(indices))
+
+    def select(self, mask):
+        """A new ResultSet with the rows for which mask is True."""
+        return self.take(np.flatnonzero(mask))
+
+    def _set(self, i, name, value):
+        if(name not in self._columns):
+            column = np.empty(self._length, dtype=object)
+            column[:] = [MISSING]*self._length
+            self._columns[name], self._kinds[name], self._categories[name] = column, "object", None
+        kind, column = self._kinds[name], self._columns[name]
+        if(kind == "numeric" and type(value) == type(column[i].item())):
+            column[i] = value
+            return
+        if(kind != "object"): #store the column as objects from now on rather than lose the value's type
+            decoded = self.column(name)
+            column = np.empty(self._length, dtype=object)
+            column[:] = [value.item() if isinstance(value, np.generic) else value for value in decoded]
+            self._columns[name], self._kinds[name], self._categories[name] = column, "object", None
+        column[i] = value
+
+    def nbytes(self):
+        """Approximate memory used by the arrays (object columns count their pointers only)."""
+        total = sum(column.nbytes for column in self._columns.values())
+        return total + sum(categories.nbytes for categories in self._categories.values() if categories is not None)
+
+
+class RowView(Mapping):
+    """A dictionary-like view of one row of a ResultSet. Writing to it writes to the ResultSet."""
+    __slots__ = ("_resultSet", "_index")
+
+    def __init__(self, resultSet, index):
+        self._resultSet = resultSet
+        self._index = index
+
+    def __getitem__(self, name):
+        if(name not in self._resultSet):
+            raise KeyError(name)
+        value = self._resultSet._columns[name][self._index]
+        if(self._resultSet._kinds[name] == "categorical"):
+            value = self._resultSet._categories[name][value]
+        if(value is MISSING):
+            raise KeyError(name)
+        return value.item() if isinstance(value, np.generic) else value
+
+    def __setitem__(self, name, value):
+        self._resultSet._set(self._index, name, value)
+
+    def __iter__(self):
+        for name in self._resultSet.keys():
+            if(self._resultSet._columns[name][self._index] is not MISSING):
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        return {name: self[name] for name in self}
+
+    def __repr__(self):
+        return f"RowView({self.to_dict()})"
+
+
+if __name__ == "__main__":
+    import unittest
+
+    RECORDS = [{"MaterialId": f"{i:010d}", "pretty_formula": ["NaCl", "Fe2O3", "MoS2"][i % 3], "nsites": 2 + i % 5,
+                "volume": 10.5*i, "is_stable": i % 2 == 0, "elements": [["Na", "Cl"], ["Fe", "O"], ["Mo", "S"]][i % 3]} for i in range(12)]
+    RECORDS[4]["dim"] = 2
+
+    class ResultSetTest(unittest.TestCase):
+        def test_round_trip(self):
+            results = ResultSet.from_records(RECORDS)
+            self.assertEqual(results.to_records(), RECORDS)
+            self.assertEqual([type(value) for value in results.to_records()[0].values()], [type(value) for value in RECORDS[0].values()])
+
+        def test_storage(self):
+            results = ResultSet.from_records(RECORDS)
+            self.assertEqual(results._kinds["pretty_formula"], "categorical")
+            self.assertEqual(results._kinds["MaterialId"], "object")
+            self.assertEqual(results._kinds["nsites"], "numeric")
+            self.assertEqual(list(results.categorical("pretty_formula")[0]), ["NaCl", "Fe2O3", "MoS2"])
+
+        def test_select_and_row_views(self):
+            results = ResultSet.from_records(RECORDS)
+            selected = results.select(results["nsites"] > 4)
+            self.assertEqual(selected.to_records(), [record for record in RECORDS if record["nsites"] > 4])
+            self.assertEqual(results[1:3].to_records(), RECORDS[1:3])
+            self.assertEqual(dict(results[4]), RECORDS[4])
+            self.assertNotIn("dim", results[0])
+            self.assertEqual(results[-1]["MaterialId"], RECORDS[-1]["MaterialId"])
+
+        def test_row_filters_work_unchanged(self):
+            results = ResultSet.from_records(RECORDS)
+            kept = []
+            for result in results:
+                if(result["pretty_formula"] == "MoS2"):
+                    result["dim"] = 2
+                    result["nsites"] = 100
+                    kept.append(result)
+            expected = [dict(record, nsites=100, dim=2) for record in RECORDS if record["pretty_formula"] == "MoS2"]
+            self.assertEqual(ResultSet.as_records(kept), expected)
+
+    unittest.main()
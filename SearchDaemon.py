@@ -0,0 +1,471 @@
+import argparse
+import importlib
+import inspect
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import error as urlerror
+from urllib import request as urlrequest
+
+import multiprocess
+
+import Batching
+import Compositions
+import MaterialSearchCore
+
+#A long-running search daemon, for running many small searches without paying for a cold start each time.
+#
+#Every MaterialSearch call in a new Python process re-imports pymatgen, pandas etc., rebuilds the element tables and re-reads the
+#GNoME database. The daemon does all of that once, when it starts, and then takes search jobs over a local HTTP API:
+#   python SearchDaemon.py serve --max-running 2                   #in the directory MaterialSearch would be run from
+#   python SearchDaemon.py submit job.json --wait                  #job.json: {"searchName": "Oxides", "orderOfFilters": [...], "database": "gnome"}
+#   python SearchDaemon.py status [job id]
+#or, from Python, SearchDaemon.submit({...}) / SearchDaemon.job_status(jobId) / SearchDaemon.wait(jobId).
+#A job is the keyword arguments of a MaterialSearch call (see MaterialSearchCore.MaterialSearch), as JSON.
+#
+#Endpoints (JSON in and out):
+#   POST   /jobs            queue a job -> 202 and the job's record (400: bad job, 409: same search already queued/running, 415: body not
+#                           sent as application/json, 503: queue full)
+#   GET    /jobs            records of every job since the daemon started
+#   GET    /jobs/{id}       record of one job: status ("queued", "running", "done", "failed" or "cancelled"), times, exit code and,
+#                           for a job that failed before it started, the error
+#   GET    /jobs/{id}/log   what the search printed (plain text)
+#   DELETE /jobs/{id}       cancel a queued job, or stop a running one
+#   GET    /status          the daemon's settings, what is warm and the number of queued/running jobs
+#
+#MaterialSearch changes the working directory and the perf log of the process it runs in, so each job runs in its own process,
+#forked from the daemon: it starts with the daemon's imports, element tables and databases already in memory (shared copy-on-write),
+#and at most maxRunning jobs run at once.
+#The worker pool (Batching) is the one thing that isn't kept in the daemon: a multiprocess pool can only be used by the process that
+#started it, so a pool in the daemon couldn't take tasks from the job processes. Instead a job that uses the pool starts its own when
+#it first needs it, and stops it when it ends. Its workers are forked from the job process, which is itself a copy of the warm daemon,
+#so they start with the imports, element tables and databases already loaded - starting them takes milliseconds per worker, not the
+#seconds a cold process spends importing.
+#The API has no authentication, so it only listens on localhost unless told otherwise. Jobs have to be posted as application/json, which
+#a web page can't send to another origin without the browser asking first, so a page open in a browser can't queue searches either.
+#Jobs have no terminal, so an MP search is failed before it starts if there is no APIkey.txt, rather than waiting forever to be asked for a key.
+
+DEFAULT_DAEMON_PORT = 8765
+DEFAULT_MAX_RUNNING = 1
+DEFAULT_MAX_QUEUED = 100
+POLL_INTERVAL = 0.2 #seconds between checks on running jobs
+JOB_LOG_DIR_NAME = "SearchDaemonLogs"
+WARM_IMPORTS = ["Filters", "robocrys", "smact", "pymatgen.analysis.dimensionality", "pymatgen.analysis.structure_matcher"] #imported by filters when first used
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+
+def warm(homeDir, databases=("gnome",), imports=WARM_IMPORTS):
+    """
+    Loads what every job would otherwise load for itself - imports, element tables and databases, which the job processes and their
+    worker pools inherit when they are forked. Returns a description of what was loaded, for /status.
+    """
+    warmed = {"imports": [], "databases": []}
+    for moduleName in imports:
+        try:
+            importlib.import_module(moduleName)
+            warmed["imports"].append(moduleName)
+        except ImportError as e: #the jobs that need it will fail with the same error
+            print(f"Could not import {moduleName} ahead of time: {e}")
+    Compositions.warm()
+    if("gnome" in databases):
+        databasePath = os.path.join(homeDir, "stable_materials_summary.csv")
+        if(os.path.isfile(databasePath)):
+            database, _ = MaterialSearchCore.LoadGNoMEDatabase(databasePath)
+            warmed["databases"].append({"database": "gnome", "path": databasePath, "rows": len(database.index)})
+        else:
+            print(f"GNoME database {databasePath} not found, so it will be read by each GNoME search.")
+    return warmed
+
+
+def check_job(job):
+    """Raises ValueError if job isn't a valid set of MaterialSearch arguments."""
+    if(not isinstance(job, dict)):
+        raise ValueError("A job is a JSON object of MaterialSearch arguments.")
+    try:
+        inspect.signature(MaterialSearchCore.MaterialSearch).bind(**job)
+    except TypeError as e:
+        raise ValueError(f"Not valid MaterialSearch arguments: {e}")
+    if(not isinstance(job["searchName"], str) or job["searchName"] in ("", ".", "..") or os.sep in job["searchName"]):
+        raise ValueError(f"searchName has to be a directory name, not {job['searchName']!r}.")
+    if(not isinstance(job["orderOfFilters"], list)):
+        raise ValueError("orderOfFilters has to be a list.")
+    if(str(job["database"]).lower() not in ("mp", "gnome")):
+        raise ValueError(f"database has to be 'mp' or 'gnome', not {job['database']!r}.")
+
+
+def job_error(homeDir, job):
+    """Returns why job can't be started now, or None if it can."""
+    if(str(job["database"]).lower() == "mp" and not os.path.isfile(os.path.join(homeDir, "APIkey.txt"))):
+        return f"MP searches need the Materials Project API key in {os.path.join(homeDir, 'APIkey.txt')}, and a job can't ask for it."
+    return None
+
+
+def _runJob(homeDir, job, logPath):
+    """Runs in the forked job process."""
+    devNull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devNull, 0) #anything that asks for input gets EOFError rather than waiting on the daemon's terminal
+    os.close(devNull)
+    logFile = open(logPath, "w", buffering=1)
+    os.dup2(logFile.fileno(), 1) #so output from C extensions and child processes is logged too
+    os.dup2(logFile.fileno(), 2)
+    sys.stdout = sys.stderr = logFile
+    os.chdir(homeDir)
+    try:
+        MaterialSearchCore.MaterialSearch(**job) #an exception is printed to the log and gives the process exit code 1
+    finally:
+        Batching.setup(initializer=Compositions.warm) #stops the worker pool this job started, if any
+
+
+class SearchDaemon():
+    """
+    Usage:
+        daemon = SearchDaemon(os.getcwd(), port=0)     #port=0 picks a free port; the address is in daemon.address
+        daemon.serve_forever()                         #or daemon.start() to serve from a background thread
+    """
+    def __init__(self, homeDir, host="127.0.0.1", port=DEFAULT_DAEMON_PORT, maxRunning=DEFAULT_MAX_RUNNING, maxQueued=DEFAULT_MAX_QUEUED,
+                 databases=("gnome",), imports=WARM_IMPORTS):
+        self.homeDir = os.path.abspath(homeDir)
+        self.maxRunning = maxRunning
+        self.maxQueued = maxQueued
+        self.logDir = os.path.join(self.homeDir, JOB_LOG_DIR_NAME)
+        os.makedirs(self.logDir, exist_ok=True)
+        self._started = time.time()
+        self._warmed = warm(self.homeDir, databases, imports)
+        self._lock = threading.Condition()
+        self._jobIds = itertools.count(1)
+        self._jobs = {} #job id -> record, in order of submission
+        self._arguments = {} #job id -> MaterialSearch arguments
+        self._queue = deque() #ids of queued jobs
+        self._processes = {} #job id -> process, for running jobs
+        self._stopping = False
+        self._context = multiprocess.get_context("fork") #job processes start from the daemon's memory rather than from scratch
+
+        self._server = ThreadingHTTPServer((host, port), type("Handler", (_RequestHandler,), {"searchDaemon": self}))
+        self.address = self._server.server_address[:2]
+        self._scheduler = threading.Thread(target=self._schedule, daemon=True)
+        self._scheduler.start()
+
+    def serve_forever(self):
+        print(f"Search daemon serving {self.homeDir} on http://{self.address[0]}:{self.address[1]} ({self.maxRunning} job(s) at a time).")
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def shutdown(self):
+        """Stops taking jobs, cancels the queued ones and waits for the running ones to finish."""
+        with self._lock:
+            self._stopping = True
+            while(len(self._queue) != 0):
+                self._jobs[self._queue.popleft()].update(status="cancelled", finished=datetime.now().isoformat(timespec="seconds"))
+            self._lock.notify_all()
+        self._scheduler.join()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def submit(self, job):
+        """
+        Queues a job. Returns its record.
+        Raises ValueError for invalid jobs, OverflowError if the queue is full and RuntimeError if the same search is already queued or running.
+        """
+        check_job(job)
+        with self._lock:
+            if(self._stopping):
+                raise RuntimeError("The daemon is shutting down.")
+            if(len(self._queue) >= self.maxQueued):
+                raise OverflowError(f"The queue is full ({self.maxQueued} jobs).")
+            searchDir = (job["searchName"], str(job["database"]).lower())
+            for jobId in itertools.chain(self._queue, self._processes):
+                if((self._arguments[jobId]["searchName"], str(self._arguments[jobId]["database"]).lower()) == searchDir):
+                    raise RuntimeError(f"Search {job['searchName']} is already queued or running as job {jobId}.")
+            jobId = str(next(self._jobIds))
+            self._jobs[jobId] = {"id": jobId, "searchName": job["searchName"], "database": str(job["database"]).lower(), "status": "queued",
+                                 "submitted": datetime.now().isoformat(timespec="seconds"), "started": None, "finished": None, "wall_s": None,
+                                 "exitcode": None, "error": None, "log": os.path.join(self.logDir, f"{jobId}.log")}
+            self._arguments[jobId] = job
+            self._queue.append(jobId)
+            self._lock.notify_all()
+            return dict(self._jobs[jobId])
+
+    def cancel(self, jobId):
+        """Cancels a queued job or stops a running one. Returns its record, or None if there is no such job."""
+        with self._lock:
+            if(jobId not in self._jobs):
+                return None
+            if(jobId in self._queue):
+                self._queue.remove(jobId)
+                self._jobs[jobId].update(status="cancelled", finished=datetime.now().isoformat(timespec="seconds"))
+            elif(jobId in self._processes):
+                self._jobs[jobId]["status"] = "cancelled" #kept when the scheduler sees the process has stopped
+                self._processes[jobId].terminate()
+            return dict(self._jobs[jobId])
+
+    def jobs(self):
+        with self._lock:
+            return [dict(job) for job in self._jobs.values()]
+
+    def job(self, jobId):
+        with self._lock:
+            return dict(self._jobs[jobId]) if jobId in self._jobs else None
+
+    def status(self):
+        with self._lock:
+            return {"homeDir": self.homeDir, "pid": os.getpid(), "uptime_s": round(time.time()-self._started, 1), "maxRunning": self.maxRunning,
+                    "maxQueued": self.maxQueued, "queued": len(self._queue), "running": len(self._processes), "warm": self._warmed}
+
+    def _schedule(self):
+        with self._lock:
+            while(not (self._stopping and len(self._processes) == 0)):
+                for jobId, process in list(self._processes.items()):
+                    if(not process.is_alive()):
+                        process.join()
+                        del self._processes[jobId]
+                        job = self._jobs[jobId]
+                        if(job["status"] != "cancelled"):
+                            job["status"] = "done" if process.exitcode == 0 else "failed"
+                        job.update(exitcode=process.exitcode, finished=datetime.now().isoformat(timespec="seconds"),
+                                   wall_s=round(time.time()-job["_startTime"], 3))
+                        del job["_startTime"]
+                while(len(self._queue) != 0 and len(self._processes) < self.maxRunning and not self._stopping):
+                    jobId = self._queue.popleft()
+                    job = self._jobs[jobId]
+                    error = job_error(self.homeDir, self._arguments[jobId])
+                    if(error is not None):
+                        job.update(status="failed", error=error, finished=datetime.now().isoformat(timespec="seconds"))
+                        continue
+                    process = self._context.Process(target=_runJob, args=(self.homeDir, self._arguments[jobId], job["log"]), name=f"SearchJob-{jobId}")
+                    process.start()
+                    self._processes[jobId] = process
+                    job.update(status="running", started=datetime.now().isoformat(timespec="seconds"), _startTime=time.time())
+                self._lock.wait(POLL_INTERVAL)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    searchDaemon = None #set on the subclass made by each SearchDaemon
+
+    def log_message(self, format, *args): #requests aren't logged
+        pass
+
+    def _send(self, code, body):
+        if(isinstance(body, str)):
+            data, contentType = body.encode(), "text/plain; charset=utf-8"
+        else:
+            data, contentType = json.dumps(body, default=str).encode(), "application/json"
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _public(self, job):
+        return {key: value for key, value in job.items() if not key.startswith("_")}
+
+    def do_GET(self):
+        parts = [part for part in self.path.split("?")[0].split("/") if part != ""]
+        if(parts == ["status"]):
+            return self._send(200, self.searchDaemon.status())
+        if(parts == ["jobs"]):
+            return self._send(200, [self._public(job) for job in self.searchDaemon.jobs()])
+        if(len(parts) in (2, 3) and parts[0] == "jobs"):
+            job = self.searchDaemon.job(parts[1])
+            if(job is None):
+                return self._send(404, {"error": f"No job {parts[1]}."})
+            if(len(parts) == 2):
+                return self._send(200, self._public(job))
+            if(parts[2] == "log"):
+                if(not os.path.isfile(job["log"])):
+                    return self._send(200, "")
+                with open(job["log"], "r", errors="replace") as f:
+                    return self._send(200, f.read())
+        self._send(404, {"error": f"Unknown path {self.path}."})
+
+    def do_POST(self):
+        if([part for part in self.path.split("/") if part != ""] != ["jobs"]):
+            return self._send(404, {"error": f"Unknown path {self.path}."})
+        if(self.headers.get("Content-Type", "").split(";")[0].strip().lower() != "application/json"):
+            return self._send(415, {"error": "Jobs have to be sent with Content-Type: application/json."})
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+            self._send(202, self._public(self.searchDaemon.submit(job)))
+        except (ValueError, json.JSONDecodeError) as e:
+            self._send(400, {"error": str(e)})
+        except OverflowError as e:
+            self._send(503, {"error": str(e)})
+        except RuntimeError as e:
+            self._send(409, {"error": str(e)})
+
+    def do_DELETE(self):
+        parts = [part for part in self.path.split("/") if part != ""]
+        if(len(parts) != 2 or parts[0] != "jobs"):
+            return self._send(404, {"error": f"Unknown path {self.path}."})
+        job = self.searchDaemon.cancel(parts[1])
+        if(job is None):
+            return self._send(404, {"error": f"No job {parts[1]}."})
+        self._send(200, self._public(job))
+
+
+def _request(address, method, path, body=None):
+    """Sends a request to a daemon. Returns (HTTP status, decoded response)."""
+    host, port = address
+    data = json.dumps(body).encode() if body is not None else None
+    request = urlrequest.Request(f"http://{host}:{port}{path}", data=data, method=method, headers={"Content-Type": "application/json"})
+    try:
+        with urlrequest.urlopen(request) as response:
+            code, payload, contentType = response.status, response.read(), response.headers.get("Content-Type", "")
+    except urlerror.HTTPError as e:
+        code, payload, contentType = e.code, e.read(), e.headers.get("Content-Type", "")
+    return code, json.loads(payload) if contentType.startswith("application/json") else payload.decode()
+
+def submit(job, address=("127.0.0.1", DEFAULT_DAEMON_PORT)):
+    """Queues a search (the keyword arguments of MaterialSearch) on a daemon. Returns the job's record; raises ValueError if it was refused."""
+    code, response = _request(address, "POST", "/jobs", job)
+    if(code != 202):
+        raise ValueError(f"Job refused ({code}): {response['error']}")
+    return response
+
+def job_status(jobId, address=("127.0.0.1", DEFAULT_DAEMON_PORT)):
+    code, response = _request(address, "GET", f"/jobs/{jobId}")
+    if(code != 200):
+        raise KeyError(response["error"])
+    return response
+
+def wait(jobId, address=("127.0.0.1", DEFAULT_DAEMON_PORT), timeout=None, interval=1.0):
+    """Waits for a job to finish. Returns its record."""
+    deadline = None if timeout is None else time.monotonic()+timeout
+    while(True):
+        job = job_status(jobId, address)
+        if(job["status"] in FINISHED_STATUSES):
+            return job
+        if(deadline is not None and time.monotonic() > deadline):
+            raise TimeoutError(f"Job {jobId} did not finish in time.")
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs searches from a long-running process with warm caches (see SearchDaemon.py).")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="start a daemon in the current directory")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=DEFAULT_DAEMON_PORT)
+    serve.add_argument("--max-running", type=int, default=DEFAULT_MAX_RUNNING, help="number of searches run at once")
+    serve.add_argument("--max-queued", type=int, default=DEFAULT_MAX_QUEUED, help="number of searches that can wait in the queue")
+    serve.add_argument("--warm", nargs="*", default=["gnome"], choices=["gnome"], help="databases to load when the daemon starts")
+    submitCommand = commands.add_parser("submit", help="queue a search, given as a JSON file of MaterialSearch arguments")
+    submitCommand.add_argument("job")
+    submitCommand.add_argument("--wait", action="store_true", help="wait for the search to finish and print its log")
+    statusCommand = commands.add_parser("status", help="show the daemon's status, or a job's")
+    statusCommand.add_argument("jobId", nargs="?")
+    for command in (submitCommand, statusCommand):
+        command.add_argument("--address", default=f"127.0.0.1:{DEFAULT_DAEMON_PORT}", help="host:port of the daemon")
+    args = parser.parse_args()
+
+    if(args.command == "serve"):
+        SearchDaemon(os.getcwd(), args.host, args.port, args.max_running, args.max_queued, args.warm).serve_forever()
+        return
+    host, _, port = args.address.rpartition(":")
+    address = (host, int(port))
+    if(args.command == "submit"):
+        with open(args.job, "r") as f:
+            job = submit(json.load(f), address)
+        print(json.dumps(job, indent=4))
+        if(args.wait):
+            job = wait(job["id"], address)
+            print(_request(address, "GET", f"/jobs/{job['id']}/log")[1])
+            print(json.dumps(job, indent=4))
+            sys.exit(0 if job["status"] == "done" else 1)
+    else:
+        print(json.dumps(_request(address, "GET", f"/jobs/{args.jobId}" if args.jobId is not None else "/status")[1], indent=4))
+
+
+if __name__ == "__main__" and sys.argv[1:2] != ["test"]:
+    main()
+elif __name__ == "__main__": #python SearchDaemon.py test
+    import http.client
+    import tempfile
+    import unittest
+    from StageIO import ReadStage
+
+    sys.argv = sys.argv[:1]
+    FORMULAS = [("Fe2O3", ["Fe", "O"]), ("NaCl", ["Na", "Cl"]), ("CH4", ["C", "H"]), ("UO2", ["U", "O"]), ("MoS2", ["Mo", "S"]), ("LiCoO2", ["Li", "Co", "O"])]
+
+    class SearchDaemonTest(unittest.TestCase):
+        """Runs a daemon on this machine over a small GNoME-style database."""
+        def setUp(self):
+            self.directory = tempfile.TemporaryDirectory()
+            self.homeDir = self.directory.name
+            with open(os.path.join(self.homeDir, "stable_materials_summary.csv"), "w") as f:
+                f.write("MaterialId,Composition,Elements,Reduced Formula,NSites,Volume,Density,Space Group,Space Group Number,Crystal System\n")
+                for i in range(60):
+                    formula, elements = FORMULAS[i % len(FORMULAS)]
+                    f.write(f"id{i},{formula},\"{elements}\",{formula},5,50.0,3.0,P1,1,triclinic\n")
+            self.searchDaemon = SearchDaemon(self.homeDir, port=0, maxRunning=2, maxQueued=3, imports=[]).start()
+
+        def tearDown(self):
+            self.searchDaemon.shutdown()
+            self.directory.cleanup()
+
+        def test_jobs_run_and_match_a_direct_search(self):
+            self.assertEqual(_request(self.searchDaemon.address, "GET", "/status")[1]["warm"]["databases"][0]["rows"], 60)
+            jobs = [submit({"searchName": name, "orderOfFilters": filters, "database": "gnome", "stageCache": False}, self.searchDaemon.address)
+                    for name, filters in [("Oxides", ["Inorganic", "ContainsOxygen"]), ("Binaries", ["Inorganic", "BinaryComp"])]]
+            for job in jobs:
+                self.assertEqual(wait(job["id"], self.searchDaemon.address, timeout=120, interval=0.1)["status"], "done")
+            oxides = ReadStage(os.path.join(self.homeDir, "GNoME", "Oxides", "2_ContainsOxygen"))
+            self.assertEqual(sorted(result["pretty_formula"] for result in oxides), sorted(["Fe2O3", "UO2", "LiCoO2"]*10))
+            self.assertIn("Creating search directory Oxides", _request(self.searchDaemon.address, "GET", f"/jobs/{jobs[0]['id']}/log")[1])
+
+        def test_bad_jobs_are_refused(self):
+            self.assertEqual(_request(self.searchDaemon.address, "POST", "/jobs", {"searchName": "x", "orderOfFilters": []})[0], 400)
+            self.assertEqual(_request(self.searchDaemon.address, "POST", "/jobs", {"searchName": "x", "orderOfFilters": [], "database": "icsd"})[0], 400)
+            self.assertEqual(_request(self.searchDaemon.address, "POST", "/jobs", {"searchName": "x", "orderOfFilters": [], "database": "gnome", "colour": 1})[0], 400)
+            self.assertEqual(_request(self.searchDaemon.address, "GET", "/jobs/1000")[0], 404)
+
+        def test_jobs_have_to_be_sent_as_json(self):
+            job = json.dumps({"searchName": "Oxides", "orderOfFilters": ["Inorganic"], "database": "gnome"}).encode()
+            def post(headers):
+                connection = http.client.HTTPConnection(*self.searchDaemon.address)
+                try:
+                    connection.request("POST", "/jobs", body=job, headers=headers) #no Content-Type unless given
+                    return connection.getresponse().status
+                finally:
+                    connection.close()
+            for headers in [{"Content-Type": "text/plain"}, {"Content-Type": "application/x-www-form-urlencoded"}, {}]:
+                self.assertEqual(post(headers), 415)
+            self.assertEqual(self.searchDaemon.jobs(), [])
+            self.assertEqual(post({"Content-Type": "application/json; charset=utf-8"}), 202)
+
+        def test_mp_jobs_without_an_api_key_fail_before_starting(self):
+            job = submit({"searchName": "Oxides", "orderOfFilters": ["Inorganic"], "database": "MP"}, self.searchDaemon.address)
+            job = wait(job["id"], self.searchDaemon.address, timeout=30, interval=0.1)
+            self.assertEqual(job["status"], "failed")
+            self.assertIn("APIkey.txt", job["error"])
+            self.assertIsNone(job["started"])
+            self.assertFalse(os.path.isdir(os.path.join(self.homeDir, "MP", "Oxides")))
+            self.assertEqual(self.searchDaemon.submit({"searchName": "Oxides", "orderOfFilters": ["Inorganic"], "database": "MP"})["status"], "queued")
+
+        def test_queue_limits_and_cancelling(self):
+            with self.searchDaemon._lock: #nothing is started while the queue is filled
+                jobs = [self.searchDaemon.submit({"searchName": f"Search{i}", "orderOfFilters": ["Inorganic"], "database": "gnome"}) for i in range(3)]
+                with self.assertRaises(OverflowError):
+                    self.searchDaemon.submit({"searchName": "Search3", "orderOfFilters": ["Inorganic"], "database": "gnome"})
+                self.searchDaemon.maxQueued = 4
+                with self.assertRaises(RuntimeError):
+                    self.searchDaemon.submit({"searchName": "Search0", "orderOfFilters": ["Inorganic"], "database": "gnome"})
+                self.assertEqual(self.searchDaemon.cancel(jobs[2]["id"])["status"], "cancelled")
+            finished = [wait(job["id"], self.searchDaemon.address, timeout=120, interval=0.1)["status"] for job in jobs]
+            self.assertEqual(finished, ["done", "done", "cancelled"])
+            self.assertFalse(os.path.isdir(os.path.join(self.homeDir, "GNoME", "Search2")))
+
+    unittest.main()
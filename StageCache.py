@@ -0,0 +1,333 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import types
+from datetime import datetime
+
+from StageIO import STAGE_EXTENSIONS
+
+#A content-addressed cache of stage outputs, shared by every search under the same home directory.
+#
+#A stage's output only depends on its input data and on the filter applied to it, so the cache key is a hash of
+#   (the previous stage's file, the filter name, the filter's parameters, the source code of the filter and of the helpers it calls).
+#If any of these change, the key changes and the stage is recomputed; if a stage with the same key was run before - in this
+#search or any other - its output files are copied into the search directory instead of running the filter again. They are
+#copies rather than links, so a search rewriting its own files (e.g. a report) can't change the cache or any other search.
+#Besides the stage file and its report, the files a stage writes next to them (e.g. ProblemChildren_*.json) are cached and
+#restored with it. Filters that read anything but their input stage (e.g. the by_id CIF files) are never cached.
+#Entries are evicted least-recently-used first once the cache grows beyond its size limit.
+
+STAGE_CACHE_DIR_NAME = "StageCache"
+STAGE_CACHE_MAX_BYTES = 20*1024**3
+OUTPUT_EXTENSIONS = STAGE_EXTENSIONS + (".html", ".xlsx") #stage data (in any format, see StageIO.py) and its report
+
+UNCACHEABLE_FILTERS = ["GetStructures", "PutStructuresIntoDB", "Dimensionality", "SimilarTo"] #depend on files other than their input stage, or only exist for their side effects
+SEARCH_FILES = ("SearchLog.txt", "PerfLog.jsonl") #written by every stage, so never side outputs
+
+_fileHashes = {} #(path, size, mtime) -> sha256, so a stage that is the input of several later stages is only hashed once
+_cacheBytes = {} #cache directory -> its size when last counted plus what this process has stored since, so it is only counted again on eviction
+
+
+def file_hash(path):
+    stat = os.stat(path)
+    memoKey = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if(memoKey not in _fileHashes):
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        _fileHashes[memoKey] = sha.hexdigest()
+    return _fileHashes[memoKey]
+
+
+def _isLocalCode(obj):
+    #only code from this repository is fingerprinted - library versions are not tracked
+    module = inspect.getmodule(obj)
+    moduleFile = getattr(module, "__file__", None)
+    return moduleFile is not None and os.path.dirname(os.path.abspath(moduleFile)) == os.path.dirname(os.path.abspath(__file__))
+
+def source_fingerprint(func):
+    """
+    Hash of the source code of a filter and of every function, method or class from this repository that it refers to by name
+    (e.g. Analysis._containsMetal from ContainsMetalFilter), followed recursively.
+    """
+    func = inspect.unwrap(func)
+    owner = getattr(func, "__self__", None)
+    ownerClass = owner if isinstance(owner, type) else type(owner) if owner is not None else None
+    sha = hashlib.sha256()
+    seen = set()
+    pending = [func]
+    while(len(pending) != 0):
+        obj = pending.pop()
+        obj = getattr(obj, "__func__", obj) #bound methods -> their function
+        if(id(obj) in seen):
+            continue
+        seen.add(id(obj))
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            continue
+        sha.update(source.encode())
+        if(inspect.isclass(obj)): #the source is already included, but the functions its methods call have to be followed too
+            pending += [member for member in vars(obj).values() if inspect.isfunction(getattr(member, "__func__", member))]
+            continue
+        code = getattr(obj, "__code__", None)
+        if(code is None):
+            continue
+        names = set(code.co_names)
+        for const in code.co_consts: #names used inside nested functions and lambdas
+            if(isinstance(const, types.CodeType)):
+                names |= set(const.co_names)
+        for name in sorted(names):
+            candidates = [getattr(obj, "__globals__", {}).get(name)]
+            for module in getattr(obj, "__globals__", {}).values(): #e.g. Dimensionality.prescreen_dimensionality
+                if(inspect.ismodule(module) and _isLocalCode(module) and hasattr(module, name)):
+                    candidates.append(getattr(module, name))
+            if(ownerClass is not None):
+                candidates.append(inspect.getattr_static(ownerClass, name, None))
+            globalsClass = getattr(obj, "__globals__", {}).get(obj.__qualname__.split(".")[0])
+            if(isinstance(globalsClass, type)):
+                candidates.append(inspect.getattr_static(globalsClass, name, None))
+            for candidate in candidates:
+                candidate = getattr(candidate, "__func__", candidate) #staticmethod/classmethod objects -> their function
+                candidate = inspect.unwrap(candidate) if callable(candidate) else candidate #e.g. functions wrapped by lru_cache
+                if(candidate is globalsClass or candidate is ownerClass): #e.g. "Analysis" in Analysis._containsMetal(...) - the methods used are followed individually
+                    continue
+                if((inspect.isfunction(candidate) or inspect.isclass(candidate)) and _isLocalCode(candidate)):
+                    pending.append(candidate)
+    return sha.hexdigest()
+
+
+def stage_key(inputPath, filterName, filterFunc, params=None):
+    """Cache key for applying filterFunc (registered as filterName, with params) to the stage file at inputPath."""
+    keyParts = {"input": file_hash(inputPath),
+                "filter": filterName,
+                "params": params,
+                "source": source_fingerprint(filterFunc)}
+    return hashlib.sha256(json.dumps(keyParts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def directory_state(directory="."):
+    """file name -> (size, modification time) of the files in a search directory, to find the side outputs of a stage (see side_outputs)."""
+    state = {}
+    for entry in os.scandir(directory):
+        if(entry.is_file()):
+            stat = entry.stat()
+            state[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return state
+
+def side_outputs(before, stageFileName, directory="."):
+    """The files of directory created or changed since directory_state gave before, other than the stage's own files and the search logs."""
+    return sorted(name for name, state in directory_state(directory).items()
+                  if before.get(name) != state and name not in SEARCH_FILES and not name.startswith(os.path.basename(stageFileName)))
+
+def _entrySize(entryPath):
+    return sum(os.path.getsize(os.path.join(root, fileName)) for root, _, fileNames in os.walk(entryPath) for fileName in fileNames)
+
+
+class StageCache():
+    """
+    Usage (see Analysis.ReadAnalyseWrite):
+        cache = StageCache(homeDir)
+        key = stage_key("1_Inorganic.json", "BinaryComp", Analysis.BinaryCompoundFilter)
+        meta = cache.fetch(key, "2_BinaryComp")     #copies the cached files in, returns None on a miss
+        before = directory_state()
+        ...run the stage...
+        cache.store(key, "2_BinaryComp", {"rows_in": 100, "rows_out": 10}, side_outputs(before, "2_BinaryComp"))
+    """
+    def __init__(self, homeDir, maxBytes=STAGE_CACHE_MAX_BYTES):
+        self.directory = os.path.join(homeDir, STAGE_CACHE_DIR_NAME)
+        self.maxBytes = maxBytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _entryPath(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, key, stageFileName):
+        """If the cache has key, copies its files in as stageFileName.* (and its side outputs) and returns its metadata, otherwise returns None."""
+        entryPath = self._entryPath(key)
+        metaPath = os.path.join(entryPath, "meta.json")
+        try:
+            with open(metaPath, "r") as f:
+                meta = json.load(f)
+            for extension in meta["extensions"]:
+                target = stageFileName + extension
+                if(os.path.isfile(target)):
+                    os.remove(target)
+                shutil.copy2(os.path.join(entryPath, "stage" + extension), target)
+            for sideFile in meta.get("side_files", []):
+                shutil.copy2(os.path.join(entryPath, "side", sideFile), os.path.join(os.path.dirname(stageFileName), sideFile))
+            os.utime(metaPath) #marks the entry as recently used
+        except FileNotFoundError: #not in the cache, or evicted by another search while being copied - the stage is run instead, replacing any partial copy
+            return None
+        return meta
+
+    def store(self, key, stageFileName, meta, sideFiles=()):
+        """
+        Adds the output files of a stage (stageFileName.json or .jsonl* and its report) to the cache under key, along with sideFiles -
+        other files the stage wrote in the search directory (see side_outputs).
+        """
+        entryPath = self._entryPath(key)
+        temporaryPath = f"{entryPath}.tmp{os.getpid()}"
+        os.makedirs(os.path.join(temporaryPath, "side"), exist_ok=True)
+        extensions = [extension for extension in OUTPUT_EXTENSIONS if os.path.isfile(stageFileName + extension)]
+        for extension in extensions:
+            shutil.copy2(stageFileName + extension, os.path.join(temporaryPath, "stage" + extension))
+        for sideFile in sideFiles:
+            shutil.copy2(os.path.join(os.path.dirname(stageFileName), sideFile), os.path.join(temporaryPath, "side", sideFile))
+        with open(os.path.join(temporaryPath, "meta.json"), "w") as f:
+            json.dump({**meta, "extensions": extensions, "side_files": list(sideFiles), "created": datetime.now().isoformat(timespec="seconds"),
+                       "source_stage": os.path.abspath(stageFileName)}, f, indent=4)
+        entrySize = _entrySize(temporaryPath)
+        try:
+            os.rename(temporaryPath, entryPath)
+        except OSError: #another search stored the same stage in the meantime
+            shutil.rmtree(temporaryPath)
+            if(not os.path.isdir(entryPath)):
+                raise
+            return
+        if(self.directory not in _cacheBytes):
+            _cacheBytes[self.directory] = sum(size for _, size, _ in self.entries()) #counted once per process, then kept up to date
+        else:
+            _cacheBytes[self.directory] += entrySize
+        if(_cacheBytes[self.directory] > self.maxBytes):
+            self.evict()
+
+    def entries(self):
+        """(last used time, size in bytes, path) of every entry in the cache."""
+        entries = []
+        for shard in os.listdir(self.directory):
+            shardPath = os.path.join(self.directory, shard)
+            if(not os.path.isdir(shardPath)):
+                continue
+            for key in os.listdir(shardPath):
+                if(".tmp" in key): #being stored by a search that is still running
+                    continue
+                entryPath = os.path.join(shardPath, key)
+                try:
+                    entries.append((os.path.getmtime(os.path.join(entryPath, "meta.json")), _entrySize(entryPath), entryPath))
+                except FileNotFoundError: #not a complete entry, or evicted by another search meanwhile
+                    continue
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until the cache is within maxBytes. Looks at every entry, so store only calls it once the cache is too big."""
+        entries = sorted(self.entries())
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, entryPath in entries:
+            if(totalSize <= self.maxBytes):
+                break
+            shutil.rmtree(entryPath, ignore_errors=True) #another search may be evicting it too
+            totalSize -= size
+        _cacheBytes[self.directory] = totalSize
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+    import unittest
+
+    def _threshold():
+        return 1
+
+    def _otherThreshold():
+        return 2
+
+    def keepLarge(results):
+        return [result for result in results if result["n"] > _threshold()]
+
+    def write(path, text):
+        with open(path, "w") as f:
+            f.write(text)
+
+    def read(path):
+        with open(path, "r") as f:
+            return f.read()
+
+    class StageCacheTest(unittest.TestCase):
+        def setUp(self):
+            self.previousDirectory = os.getcwd()
+            self.directory = tempfile.TemporaryDirectory()
+            os.chdir(self.directory.name)
+            _cacheBytes.clear()
+            self.cache = StageCache(self.directory.name)
+
+        def tearDown(self):
+            os.chdir(self.previousDirectory)
+            self.directory.cleanup()
+
+        def stage(self, searchDir, fileName, text, sideFiles={}):
+            """Writes a stage (and its report) as ReadAnalyseWrite would, returning (path without extension, side outputs)."""
+            os.makedirs(searchDir, exist_ok=True)
+            before = directory_state(searchDir)
+            path = os.path.join(searchDir, fileName)
+            write(path + ".json", text)
+            write(path + ".xlsx", "report of " + text)
+            write(os.path.join(searchDir, "SearchLog.txt"), "Database: 3\n")
+            for name, content in sideFiles.items():
+                write(os.path.join(searchDir, name), content)
+            return path, side_outputs(before, fileName, searchDir)
+
+        def test_key_changes_with_input_params_and_source(self):
+            global _threshold
+            write("0_Database.json", '[{"n": 1}, {"n": 2}]')
+            key = stage_key("0_Database.json", "KeepLarge", keepLarge)
+            self.assertEqual(stage_key("0_Database.json", "KeepLarge", keepLarge), key)
+            self.assertNotEqual(stage_key("0_Database.json", "KeepLarge", keepLarge, {"n": 2}), key)
+            self.assertNotEqual(stage_key("0_Database.json", "KeepSmall", keepLarge), key)
+            time.sleep(0.01) #a new modification time, so the input is hashed again
+            write("0_Database.json", '[{"n": 1}, {"n": 3}]')
+            changedInput = stage_key("0_Database.json", "KeepLarge", keepLarge)
+            self.assertNotEqual(changedInput, key)
+            threshold, _threshold = _threshold, _otherThreshold #a helper the filter calls is changed
+            try:
+                self.assertNotEqual(stage_key("0_Database.json", "KeepLarge", keepLarge), changedInput)
+            finally:
+                _threshold = threshold
+            self.assertEqual(stage_key("0_Database.json", "KeepLarge", keepLarge), changedInput)
+
+        def test_fetch_restores_stage_and_side_files(self):
+            path, sideFiles = self.stage("first", "1_Dim", "[1, 2]", {"ProblemChildren_Dim.json": "[3]"})
+            self.assertEqual(sideFiles, ["ProblemChildren_Dim.json"]) #not the stage's own files or the search log
+            self.cache.store("ab" + "0"*62, path, {"search": "first", "rows_in": 3, "rows_out": 2}, sideFiles)
+            os.makedirs("second")
+            meta = self.cache.fetch("ab" + "0"*62, os.path.join("second", "1_Dim"))
+            self.assertEqual((meta["search"], meta["rows_out"]), ("first", 2))
+            self.assertEqual(sorted(os.listdir("second")), ["1_Dim.json", "1_Dim.xlsx", "ProblemChildren_Dim.json"])
+            self.assertEqual(read(os.path.join("second", "ProblemChildren_Dim.json")), "[3]")
+            write(os.path.join("second", "1_Dim.json"), "[]") #the files fetched are copies, so changing them doesn't change the cache
+            self.assertEqual(read(os.path.join(self.cache._entryPath("ab" + "0"*62), "stage.json")), "[1, 2]")
+            self.assertIsNone(self.cache.fetch("cd" + "0"*62, os.path.join("second", "1_Dim")))
+
+        def test_store_losing_a_race(self):
+            key = "ef" + "0"*62
+            firstPath, _ = self.stage("first", "1_X", "[1]")
+            secondPath, _ = self.stage("second", "1_X", "[1] from second")
+            self.cache.store(key, firstPath, {"search": "first"})
+            cacheBytes = _cacheBytes[self.cache.directory]
+            self.cache.store(key, secondPath, {"search": "second"}) #renaming its entry into place fails, as when another search stores the same stage first
+            self.assertEqual(self.cache.fetch(key, os.path.join("second", "1_X"))["search"], "first")
+            self.assertEqual(os.listdir(os.path.dirname(self.cache._entryPath(key))), [key]) #no temporary entry left behind
+            self.assertEqual(_cacheBytes[self.cache.directory], cacheBytes)
+
+        def test_evict_least_recently_used(self):
+            keys = [f"{i:02d}" + "0"*62 for i in range(4)]
+            paths = [self.stage(f"search{i}", "1_X", "x"*1000)[0] for i in range(4)]
+            for i, key in enumerate(keys[:3]):
+                self.cache.store(key, paths[i], {"search": f"search{i}"})
+                os.utime(os.path.join(self.cache._entryPath(key), "meta.json"), (1000+i, 1000+i)) #stored in this order
+            entrySize = _entrySize(self.cache._entryPath(keys[0]))
+            self.assertEqual(_cacheBytes[self.cache.directory], 3*entrySize) #counted once, then added to
+            self.cache.fetch(keys[0], paths[0]) #now the most recently used
+            self.cache.maxBytes = 2*entrySize + entrySize//2
+            self.cache.store(keys[3], paths[3], {"search": "search3"})
+            self.assertEqual(sorted(os.path.basename(path) for _, _, path in self.cache.entries()), [keys[0], keys[3]]) #the two least recently used are gone
+            self.assertEqual(_cacheBytes[self.cache.directory], 2*entrySize)
+            _cacheBytes.clear() #as in a new process - counted again from the entries
+            self.cache.maxBytes = STAGE_CACHE_MAX_BYTES
+            self.cache.store(keys[1], paths[1], {"search": "search1"})
+            self.assertEqual(_cacheBytes[self.cache.directory], 3*entrySize)
+
+    unittest.main()
@@ -0,0 +1,655 @@
+import gzip
+import io
+import json
+import math
+import os
+import queue
+import threading
+
+from json_tricks import dumps, loads
+from json_tricks.decoders import TricksPairHook
+from json_tricks.nonp import DEFAULT_HOOKS
+
+try:
+    import orjson #optional - a much faster encoder/decoder for the JSON-lines format (json_tricks is used without it)
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard #optional - only needed for the "jsonl.zst" stage format
+except ImportError:
+    zstandard = None
+
+#Reading and writing stage files.
+#
+#A stage ({n}_{filterName}) can be saved in one of these formats:
+#   "json"      - {n}_{filterName}.json, one indented json_tricks document holding the whole list (the original format, and still the default).
+#   "jsonl"     - {n}_{filterName}.jsonl, JSON lines: one material per line. Lines are written with orjson when it is installed.
+#   "jsonl.gz"  - the same, gzip compressed.
+#   "jsonl.zst" - the same, zstd compressed (needs the zstandard package).
+#JSON-lines files are written in blocks of about BLOCK_BYTES. Each compressed block is a complete gzip member or zstd frame, so the
+#file as a whole is still an ordinary .gz/.zst file (e.g. for zcat), but any block can also be decompressed on its own. The offset,
+#size and row count of every block are kept in an index next to the data ({n}_{filterName}.jsonl.gz.idx), which lets a stage be
+#parsed a block at a time on several cores (see StageBlocks and ReadStageBlock). Writers can also append to an existing stage
+#(JSONLinesWriter(..., append=True)), e.g. one batch at a time; a JSON-lines file without an index (e.g. one made by hand with
+#cat or tail) can still be read, just not in parallel.
+#
+#Rows that plain JSON can't hold (e.g. NumPy arrays from MAPI) are written with json_tricks instead, on their own line, and read back
+#with json_tricks, so every format gives back the same data. NaN and infinite floats are rejected (ValueError) in every format, as
+#json_tricks rejects them for "json" - orjson would silently write them as null. The databases are read in with them replaced by None.
+#Every reader accepts every format, so stages written in different formats (e.g. by older versions of this code) can be mixed freely.
+#
+#PrefetchChunks and BackgroundWriter pipeline a streamed stage (see Analysis.StreamFilter): the next chunk is read and decoded, and the
+#previous one encoded, compressed and written, in background threads while the current one is filtered. At most PIPELINE_DEPTH chunks
+#wait between two steps, so memory stays bounded, and the writes happen in the same order through the same writer, so the files written
+#are byte for byte the ones written without pipelining.
+
+STAGE_FORMATS = {"json": ".json", "jsonl": ".jsonl", "jsonl.gz": ".jsonl.gz", "jsonl.zst": ".jsonl.zst"} #format -> file extension
+DEFAULT_STAGE_FORMAT = "json"
+INDEX_SUFFIX = ".idx" #appended to the data file's name
+STAGE_EXTENSIONS = tuple(STAGE_FORMATS.values()) + tuple(extension + INDEX_SUFFIX for extension in STAGE_FORMATS.values() if extension != ".json")
+
+DEFAULT_CHUNK_SIZE = 10000 #rows per chunk
+READ_BLOCK_SIZE = 1 << 20 #characters read from a .json stage file at a time
+BLOCK_BYTES = 4 << 20 #uncompressed bytes per block of a JSON-lines stage file
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+PIPELINE_DEPTH = 2 #chunks that can be waiting between two steps of a pipelined stage
+
+
+def _compression(stageFormat):
+    if(stageFormat not in STAGE_FORMATS):
+        raise ValueError(f"Stage format {stageFormat} is not recognised. Options are: {', '.join(STAGE_FORMATS)}")
+    if(stageFormat == "jsonl.zst" and zstandard is None):
+        raise ImportError("The jsonl.zst stage format needs the zstandard package (pip install zstandard).")
+    return stageFormat.partition(".")[2] or None #"gz", "zst" or None
+
+def StageFile(fileName):
+    """Path of the data file of stage fileName (e.g. "2_BinaryComp"), whichever format it was saved in, or None if it hasn't been saved."""
+    for extension in STAGE_FORMATS.values():
+        if(os.path.isfile(fileName + extension)):
+            return fileName + extension
+    return None
+
+def StageFormat(path):
+    for stageFormat, extension in sorted(STAGE_FORMATS.items(), key=lambda item: -len(item[1])): #longest first - ".jsonl.gz" before ".jsonl"
+        if(path.endswith(extension)):
+            return stageFormat
+    raise ValueError(f"{path} is not a stage file.")
+
+def _stagePath(fileName):
+    path = StageFile(fileName)
+    if(path is None):
+        raise FileNotFoundError(f"Stage {fileName} has not been saved in any format ({', '.join(STAGE_FORMATS.values())}).")
+    return path
+
+
+def ReadStage(fileName):
+    """The whole of stage fileName as a list, whichever format it was saved in."""
+    path = _stagePath(fileName)
+    if(StageFormat(path) == "json"):
+        with open(path, "r") as f:
+            return loads(f.read())
+    return [row for chunk in IterStageChunks(fileName) for row in chunk]
+
+def IterStageChunks(fileName, chunkSize=DEFAULT_CHUNK_SIZE):
+    """Yields stage fileName as lists of up to chunkSize rows, whichever format it was saved in, without reading it all into memory."""
+    path = _stagePath(fileName)
+    stageFormat = StageFormat(path)
+    if(stageFormat == "json"):
+        yield from IterJSONChunks(fileName, chunkSize)
+        return
+    with _openLines(path, _compression(stageFormat)) as f:
+        chunk = []
+        for line in f:
+            if(line.strip() == b""):
+                continue
+            chunk.append(_decodeRow(line))
+            if(len(chunk) == chunkSize):
+                yield chunk
+                chunk = []
+        if(len(chunk) != 0):
+            yield chunk
+
+def SaveStage(fileName, results, stageFormat=DEFAULT_STAGE_FORMAT):
+    """Saves a list as stage fileName in stageFormat. The "json" format is exactly what SaveDictAsJSON writes."""
+    with StageWriter(fileName, stageFormat) as writer:
+        writer.write(results)
+    return writer.path
+
+def StageWriter(fileName, stageFormat=DEFAULT_STAGE_FORMAT):
+    """
+    A writer for stage fileName in stageFormat - a JSONListWriter or a JSONLinesWriter. Both are used as write(chunk) ... close(),
+    or writeEncoded(*EncodeRows(chunk, stageFormat)) ... close() when the rows are encoded somewhere else (e.g. in a worker process).
+    """
+    if(stageFormat == "json"):
+        return JSONListWriter(fileName)
+    return JSONLinesWriter(fileName, stageFormat)
+
+def EncodeRows(rows, stageFormat=DEFAULT_STAGE_FORMAT):
+    """(encoded rows, number of rows) for the writeEncoded method of a StageWriter for stageFormat."""
+    if(stageFormat == "json"):
+        return _encodeJSONRows(rows, 4), len(rows)
+    return _encodeLines(rows), len(rows)
+
+
+def IterJSONChunks(fileName, chunkSize=DEFAULT_CHUNK_SIZE): #do not need to give the .json extension - that's assumed
+    """
+    Yields the list saved in fileName.json as lists of up to chunkSize entries, without reading the whole file into memory.
+    Each entry is decoded exactly as ReadJSONFile would decode it.
+    """
+    properties = {"preserve_order": True, "ignore_comments": False, "decompression": False, "cls_lookup_map": None, "allow_duplicates": True}
+    decoder = json.JSONDecoder(object_pairs_hook=TricksPairHook(ordered=True, obj_pairs_hooks=DEFAULT_HOOKS, allow_duplicates=True, properties=properties))
+    with open(fileName+".json", "r") as f:
+        buffer = ""
+        position = 0
+        endOfFile = False
+
+        def refill(minimum=READ_BLOCK_SIZE): #appends at least minimum characters to the buffer (unless the file ends), returns False at the end of the file
+            nonlocal buffer, position, endOfFile
+            if(endOfFile):
+                return False
+            buffer = buffer[position:] #forgets everything already decoded
+            position = 0
+            block = f.read(max(minimum, READ_BLOCK_SIZE))
+            endOfFile = len(block) == 0
+            buffer += block
+            return not endOfFile
+
+        def nextCharacter(): #skips whitespace, returns "" at the end of the file
+            nonlocal position
+            while(True):
+                while(position < len(buffer) and buffer[position].isspace()):
+                    position += 1
+                if(position < len(buffer)):
+                    return buffer[position]
+                if(not refill()):
+                    return ""
+
+        if(nextCharacter() != "["):
+            raise ValueError(f"{fileName}.json does not contain a list.")
+        position += 1
+        if(nextCharacter() == "]"):
+            return
+        chunk = []
+        while(True):
+            nextCharacter()
+            while(True):
+                try:
+                    entry, end = decoder.raw_decode(buffer, position)
+                    if(end < len(buffer) or endOfFile): #an entry that ends exactly at the end of the buffer (e.g. a number) may continue in the file
+                        break
+                except json.JSONDecodeError:
+                    if(endOfFile):
+                        raise
+                refill(len(buffer)-position) #doubles what is buffered each time, for entries larger than a block
+            position = end
+            chunk.append(entry)
+            if(len(chunk) == chunkSize):
+                yield chunk
+                chunk = []
+            separator = nextCharacter()
+            position += 1
+            if(separator == "]"):
+                break
+            if(separator != ","):
+                raise ValueError(f"Expected ',' or ']' between entries of {fileName}.json, found {separator!r}.")
+        if(len(chunk) != 0):
+            yield chunk
+
+
+class JSONListWriter():
+    """
+    Writes a list to fileName.json (the "json" stage format) one chunk at a time. The finished file is byte-for-byte what SaveDictAsJSON would write for the whole list.
+    The file is written under a temporary name and only appears once it is complete, so an interrupted stage is not mistaken for a finished one.
+
+    Usage:
+        with JSONListWriter("2_BinaryComp") as writer:
+            for chunk in IterJSONChunks("1_Inorganic"):
+                writer.write(Analysis.BinaryCompoundFilter(chunk))
+    """
+    def __init__(self, fileName, indent=4):
+        self.fileName = fileName
+        self.indent = indent
+        self.path = fileName + ".json"
+        self.temporaryPath = f"{fileName}.json.partial"
+        self.file = open(self.temporaryPath, "w")
+        self.count = 0
+
+    def write(self, chunk):
+        self.writeEncoded(_encodeJSONRows(chunk, self.indent), len(chunk))
+
+    def writeEncoded(self, text, rows):
+        """Writes rows encoded by EncodeRows."""
+        if(rows == 0):
+            return
+        if(self.indent is None):
+            self.file.write((", " if self.count != 0 else "[") + text)
+        else:
+            self.file.write((",\n" if self.count != 0 else "[\n") + text)
+        self.count += rows
+
+    def close(self):
+        if(self.count == 0):
+            self.file.write("[]")
+        else:
+            self.file.write("]" if self.indent is None else "\n]")
+        self.file.close()
+        os.replace(self.temporaryPath, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if(excType is None):
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.temporaryPath)
+
+
+def _checkFinite(value):
+    if(isinstance(value, float) and not math.isfinite(value)):
+        raise ValueError("Out of range float values are not JSON compliant") #as raised by json_tricks
+    items = value.values() if isinstance(value, dict) else value if isinstance(value, (list, tuple)) else ()
+    for item in items:
+        _checkFinite(item)
+
+def _encodeRow(row):
+    if(orjson is not None):
+        try:
+            encoded = orjson.dumps(row)
+        except TypeError: #types plain JSON can't hold (e.g. NumPy arrays and scalars, which json_tricks keeps as NumPy types), or integers larger than 64 bits
+            pass
+        else:
+            if(b"null" in encoded): #orjson writes NaN and infinite floats as null
+                _checkFinite(row)
+            return encoded
+    return dumps(row).encode() #json_tricks, on a single line
+
+def _encodeJSONRows(rows, indent):
+    if(len(rows) == 0):
+        return ""
+    text = dumps(list(rows), indent=indent) #the same encoding as SaveDictAsJSON, less the brackets
+    return text[1:-1] if indent is None else text[2:-2]
+
+def _encodeLines(rows):
+    return b"".join([_encodeRow(row) + b"\n" for row in rows])
+
+def _decodeRow(line):
+    if(orjson is None or b'"__' in line): #json_tricks encodings of types plain JSON can't hold look like {"__ndarray__": ...}
+        return loads(line.decode())
+    return orjson.loads(line)
+
+def _compress(data, compression):
+    if(compression == "gz"):
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0) #mtime=0 so that identical data gives identical files
+    if(compression == "zst"):
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return data
+
+def _decompress(data, compression):
+    if(compression == "gz"):
+        return gzip.decompress(data)
+    if(compression == "zst"):
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+def _openLines(path, compression):
+    #a binary file object over the uncompressed lines, read as a stream
+    if(compression == "gz"):
+        return gzip.open(path, "rb")
+    if(compression == "zst"):
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True))
+    return open(path, "rb")
+
+
+def ReadStageIndex(path):
+    """The index of the JSON-lines stage file at path: {"rows": ..., "blocks": [[offset, size in bytes, rows], ...]}, or None if it has none."""
+    if(not os.path.isfile(path + INDEX_SUFFIX)):
+        return None
+    with open(path + INDEX_SUFFIX, "r") as f:
+        index = json.load(f)
+    if(index["bytes"] != os.path.getsize(path)): #the data file has been changed (e.g. appended to) without the index
+        return None
+    return index
+
+def StageBlocks(fileName):
+    """(path, blocks) of a JSON-lines stage with an index, where blocks is a list of [offset, size in bytes, rows]; None otherwise."""
+    path = _stagePath(fileName)
+    if(StageFormat(path) == "json"):
+        return None
+    index = ReadStageIndex(path)
+    return None if index is None else (os.path.abspath(path), index["blocks"])
+
+def ReadStageBlock(path, block):
+    """The rows in one block (an entry of StageBlocks) of the JSON-lines stage file at path. Blocks can be read in any order, in any process."""
+    offset, size, _ = block
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = _decompress(f.read(size), _compression(StageFormat(path)))
+    return [_decodeRow(line) for line in data.split(b"\n") if line.strip() != b""]
+
+
+class JSONLinesWriter():
+    """
+    Writes a list to a JSON-lines stage file (see the top of this file) one chunk at a time, along with its index.
+    A new file is written under a temporary name and only appears once it is complete; with append=True rows are added to the end of an
+    existing stage file instead (which is left readable if the writer is interrupted).
+
+    Usage:
+        with JSONLinesWriter("2_BinaryComp", "jsonl.gz") as writer:
+            for chunk in IterStageChunks("1_Inorganic"):
+                writer.write(Analysis.BinaryCompoundFilter(chunk))
+    """
+    def __init__(self, fileName, stageFormat="jsonl", append=False):
+        self.compression = _compression(stageFormat)
+        self.path = fileName + STAGE_FORMATS[stageFormat]
+        self.blocks = []
+        self.pending = [] #encoded lines not yet written
+        self.pendingBytes = 0
+        self.pendingRows = 0
+        self.count = 0
+        if(append and os.path.isfile(self.path)):
+            index = ReadStageIndex(self.path)
+            if(index is None): #no usable index - what is already there is counted as one block
+                rows = sum(len(chunk) for chunk in IterStageChunks(fileName))
+                index = {"blocks": [[0, os.path.getsize(self.path), rows]]}
+            self.blocks = index["blocks"]
+            self.writePath = self.path
+            self.file = open(self.path, "ab")
+        else:
+            self.writePath = f"{self.path}.partial"
+            self.file = open(self.writePath, "wb")
+        self.offset = self.file.tell()
+
+    def write(self, chunk):
+        lines = [_encodeRow(row) + b"\n" for row in chunk]
+        start = 0
+        size = self.pendingBytes
+        for i, line in enumerate(lines): #blocks end between rows, once they reach BLOCK_BYTES
+            size += len(line)
+            if(size >= BLOCK_BYTES):
+                self.writeEncoded(b"".join(lines[start:i+1]), i+1-start)
+                start = i+1
+                size = 0
+        self.writeEncoded(b"".join(lines[start:]), len(lines)-start)
+
+    def writeEncoded(self, lines, rows):
+        """Writes rows that are already encoded as one line of JSON each (bytes, each line ending in a newline) - by EncodeRows, or e.g. by pandas."""
+        if(rows == 0):
+            return
+        self.pending.append(lines)
+        self.pendingBytes += len(lines)
+        self.pendingRows += rows
+        self.count += rows
+        if(self.pendingBytes >= BLOCK_BYTES):
+            self._flushBlock()
+
+    def _flushBlock(self):
+        if(len(self.pending) == 0):
+            return
+        data = _compress(b"".join(self.pending), self.compression)
+        self.file.write(data)
+        self.blocks.append([self.offset, len(data), self.pendingRows])
+        self.offset += len(data)
+        self.pending = []
+        self.pendingBytes = 0
+        self.pendingRows = 0
+
+    def close(self):
+        self._flushBlock()
+        self.file.close()
+        if(self.writePath != self.path):
+            os.replace(self.writePath, self.path)
+        index = {"format": StageFormat(self.path), "rows": sum(block[2] for block in self.blocks), "bytes": self.offset, "blocks": self.blocks}
+        with open(f"{self.path}{INDEX_SUFFIX}.partial", "w") as f:
+            json.dump(index, f)
+        os.replace(f"{self.path}{INDEX_SUFFIX}.partial", self.path + INDEX_SUFFIX)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if(excType is None):
+            self.close()
+        elif(self.writePath != self.path):
+            self.file.close()
+            os.remove(self.writePath)
+        else: #appending - the rows already in the file are kept, along with whole blocks written before the error
+            self.pending = []
+            self.pendingRows = 0
+            self.close()
+
+
+def _put(items, item, stopped):
+    #a put that gives up once the consumer has stopped, so a background thread never waits forever on a full queue
+    while(not stopped.is_set()):
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def PrefetchChunks(chunks, depth=PIPELINE_DEPTH):
+    """
+    Yields the chunks of the iterator chunks (e.g. IterStageChunks), which is run in a background thread up to depth chunks ahead,
+    so the next chunk is read and decoded while this one is being used. Errors raised while reading are raised here.
+    """
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    def produce():
+        try:
+            for chunk in chunks:
+                if(not _put(items, (True, chunk), stopped)):
+                    return
+            _put(items, (False, None), stopped)
+        except BaseException as e:
+            _put(items, (False, e), stopped)
+        finally:
+            if(hasattr(chunks, "close")): #e.g. closes the stage file if the consumer stopped early
+                chunks.close()
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while(True):
+            more, value = items.get()
+            if(not more):
+                if(value is not None):
+                    raise value
+                return
+            yield value
+    finally:
+        stopped.set()
+        thread.join()
+
+
+class BackgroundWriter():
+    """
+    Makes the write and writeEncoded calls of a stage writer (see StageWriter) in a background thread, in order, with up to depth chunks
+    waiting. An error raised by the writer is raised by the next call, or by close. Usage:
+        with StageWriter(fileName, stageFormat) as writer, BackgroundWriter(writer) as background:
+            for chunk in chunks:
+                background.write(chunk)
+    """
+    def __init__(self, writer, depth=PIPELINE_DEPTH):
+        self.writer = writer
+        self.path = writer.path
+        self._calls = queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while(True):
+            call = self._calls.get()
+            if(call is None):
+                return
+            if(self._error is None): #after an error the remaining calls are dropped
+                method, args = call
+                try:
+                    method(*args)
+                except BaseException as e:
+                    self._error = e
+
+    def _submit(self, method, args):
+        if(self._error is not None):
+            raise self._error
+        self._calls.put((method, args))
+
+    def write(self, chunk):
+        self._submit(self.writer.write, (chunk,))
+
+    def writeEncoded(self, payload, rows):
+        self._submit(self.writer.writeEncoded, (payload, rows))
+
+    def close(self):
+        """Waits for every write to finish. Doesn't close the writer itself."""
+        self._calls.put(None)
+        self._thread.join()
+        if(self._error is not None):
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if(excType is None):
+            self.close()
+        else: #the error being raised is the one to report
+            self._calls.put(None)
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    import unittest
+    from collections import OrderedDict
+
+    import numpy as np
+
+    ROWS = [{"MaterialId": f"id{i}", "pretty_formula": ["NaCl", "MoS2", "Fe2O3"][i % 3], "nsites": i % 7, "volume": 1.5*i,
+             "is_stable": i % 2 == 0, "elements": ["Na", "Cl"], "band_gap": None, "note": "line\nbreak é"} for i in range(500)]
+    FORMATS = [stageFormat for stageFormat in STAGE_FORMATS if stageFormat != "jsonl.zst" or zstandard is not None]
+
+    class StageIOTest(unittest.TestCase):
+        def setUp(self):
+            self.directory = tempfile.mkdtemp()
+            self.previousDirectory = os.getcwd()
+            os.chdir(self.directory)
+
+        def tearDown(self):
+            os.chdir(self.previousDirectory)
+            shutil.rmtree(self.directory)
+
+        def test_round_trip_in_every_format(self):
+            for stageFormat in FORMATS:
+                path = SaveStage(f"stage_{stageFormat}", ROWS, stageFormat)
+                self.assertEqual(StageFile(f"stage_{stageFormat}"), path)
+                self.assertEqual(StageFormat(path), stageFormat)
+                self.assertEqual(ReadStage(f"stage_{stageFormat}"), ROWS)
+                self.assertEqual([len(chunk) for chunk in IterStageChunks(f"stage_{stageFormat}", 200)], [200, 200, 100])
+
+        def test_json_format_matches_json_tricks(self):
+            SaveStage("stage", ROWS, "json")
+            with open("stage.json", "r") as f:
+                self.assertEqual(f.read(), dumps(ROWS, indent=4))
+            self.assertEqual(ReadStage("stage"), loads(dumps(ROWS, indent=4)))
+
+        def test_json_chunks_with_small_read_blocks(self):
+            global READ_BLOCK_SIZE
+            SaveStage("stage", ROWS, "json")
+            readBlockSize, READ_BLOCK_SIZE = READ_BLOCK_SIZE, 37
+            try:
+                chunks = list(IterJSONChunks("stage", 64))
+            finally:
+                READ_BLOCK_SIZE = readBlockSize
+            self.assertEqual([row for chunk in chunks for row in chunk], ROWS)
+            self.assertIsInstance(chunks[0][0], OrderedDict) #decoded exactly as ReadJSONFile decodes it
+
+        def test_blocks_and_appends(self):
+            global BLOCK_BYTES
+            blockBytes, BLOCK_BYTES = BLOCK_BYTES, 4096
+            try:
+                with JSONLinesWriter("stage", "jsonl.gz") as writer:
+                    writer.write(ROWS[:300])
+                with JSONLinesWriter("stage", "jsonl.gz", append=True) as writer:
+                    writer.write(ROWS[300:])
+            finally:
+                BLOCK_BYTES = blockBytes
+            path, blocks = StageBlocks("stage")
+            self.assertGreater(len(blocks), 2)
+            self.assertEqual(sum(rows for _, _, rows in blocks), len(ROWS))
+            self.assertEqual([row for block in reversed(blocks) for row in reversed(ReadStageBlock(path, block))], ROWS[::-1])
+            with gzip.open(path, "rb") as f: #still an ordinary .gz file
+                self.assertEqual(f.read().count(b"\n"), len(ROWS))
+
+        def test_unindexed_and_hand_appended_files(self):
+            SaveStage("stage", ROWS[:10], "jsonl")
+            with open("stage.jsonl", "ab") as f: #e.g. tail -n +1 batch.jsonl >> stage.jsonl
+                f.write(b"".join(_encodeRow(row) + b"\n" for row in ROWS[10:20]))
+            self.assertIsNone(StageBlocks("stage")) #the index no longer matches the data
+            self.assertEqual(ReadStage("stage"), ROWS[:20])
+
+        def test_rows_plain_json_cannot_hold(self):
+            rows = [{"MaterialId": "id0", "forces": np.arange(6.0).reshape(2, 3)}, {"MaterialId": "id1", "charge": 1+2j}]
+            SaveStage("stage", rows, "jsonl")
+            readBack = ReadStage("stage")
+            self.assertIsInstance(readBack[0]["forces"], np.ndarray)
+            self.assertTrue(np.array_equal(readBack[0]["forces"], rows[0]["forces"]))
+            self.assertEqual(readBack[1], rows[1])
+
+        def test_non_finite_floats_are_rejected_in_every_format(self):
+            for value in (float("nan"), float("inf"), [1.0, -float("inf")], {"x": np.float64("nan")}):
+                for stageFormat in FORMATS:
+                    with self.subTest(value=value, stageFormat=stageFormat):
+                        with self.assertRaises(ValueError):
+                            SaveStage("stage", [ROWS[0], dict(ROWS[1], band_gap=value)], stageFormat)
+                        self.assertIsNone(StageFile("stage"))
+            for stageFormat in FORMATS: #None, which the databases are read in with in place of NaN, round-trips
+                rows = [dict(row, volume=None) for row in ROWS[:5]]
+                SaveStage(f"stage_{stageFormat}", rows, stageFormat)
+                self.assertEqual(ReadStage(f"stage_{stageFormat}"), rows)
+
+        def test_pipelined_writes_are_identical(self):
+            for stageFormat in FORMATS:
+                SaveStage("stage", ROWS, stageFormat)
+                with StageWriter("pipelined", stageFormat) as writer, BackgroundWriter(writer) as background:
+                    for chunk in PrefetchChunks(IterStageChunks("stage", 64)):
+                        background.write([row for row in chunk if row["nsites"] != 3])
+                with StageWriter("sequential", stageFormat) as writer:
+                    for chunk in IterStageChunks("stage", 64):
+                        writer.write([row for row in chunk if row["nsites"] != 3])
+                for suffix in ([""] if stageFormat == "json" else ["", INDEX_SUFFIX]):
+                    with open(StageFile("pipelined") + suffix, "rb") as pipelined, open(StageFile("sequential") + suffix, "rb") as sequential:
+                        self.assertEqual(pipelined.read(), sequential.read())
+                for fileName in os.listdir("."):
+                    os.remove(fileName)
+
+        def test_pipeline_errors(self):
+            SaveStage("stage", ROWS, "jsonl")
+            def failingChunks():
+                yield ROWS[:10]
+                raise KeyError("bad chunk")
+            with self.assertRaises(KeyError):
+                list(PrefetchChunks(failingChunks()))
+            chunks = PrefetchChunks(IterStageChunks("stage", 10), depth=1)
+            next(chunks)
+            chunks.close() #stops the reading thread early
+            with self.assertRaises(TypeError):
+                with StageWriter("pipelined", "jsonl") as writer, BackgroundWriter(writer) as background:
+                    background.write([{"MaterialId": object()}]) #json_tricks can't encode it either
+            self.assertIsNone(StageFile("pipelined"))
+
+        def test_interrupted_writes_leave_no_stage(self):
+            for stageFormat in FORMATS:
+                with self.assertRaises(KeyError):
+                    with StageWriter("stage", stageFormat) as writer:
+                        writer.write(ROWS[:5])
+                        raise KeyError("interrupted")
+                self.assertIsNone(StageFile("stage"))
+            self.assertEqual(os.listdir("."), [])
+
+    unittest.main()
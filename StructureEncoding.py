@@ -0,0 +1,113 @@
+import base64
+
+import numpy as np
+from pymatgen.core.composition import Composition
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+
+#A compact encoding of pymatgen Structures, used for the "structure" of each material in stage files and between stages
+#(see Analysis._storeStructures and Analysis._loadStructures).
+#
+#Structure.as_dict() stores every site as a nested dictionary - species dictionaries, fractional and Cartesian coordinates, label and
+#properties - which, written as indented JSON, takes several times the space of the data itself. A compact structure is instead
+#       {"@encoding": "compact-v1",
+#        "lattice": 3x3 matrix,
+#        "species": the distinct species of the sites, each as [[species, occupancy], ...] (so disordered sites and oxidation states are kept),
+#        "site_species": index into species of each site,
+#        "frac_coords": the fractional coordinates as little-endian float64 (or float32) bytes, base64 encoded,
+#        "precision": "float64" or "float32",
+#and, only when they aren't the defaults, "pbc", "site_properties", "labels", "charge" and "properties".
+#With float64 coordinates (the default) decode_structure(encode_structure(s)) is the same structure, down to its as_dict(); float32
+#halves the size of the coordinates again at a precision of ~1e-7 in fractional coordinates.
+#decode_structure also reads structures in the as_dict() format, as stored by earlier versions, so old stage files can still be used.
+
+STRUCTURE_ENCODING = "compact-v1"
+COORDINATE_DTYPES = {"float64": "<f8", "float32": "<f4"}
+
+
+def _packArray(array, dtype):
+    return base64.b64encode(np.ascontiguousarray(array, dtype=dtype).tobytes()).decode("ascii")
+
+def _unpackArray(text, dtype, shape):
+    return np.frombuffer(base64.b64decode(text), dtype=dtype).reshape(shape).astype(np.float64)
+
+
+def is_encoded(value):
+    return isinstance(value, dict) and value.get("@encoding") == STRUCTURE_ENCODING
+
+def encode_structure(structure, precision="float64"):
+    """The compact encoding (a JSON-serialisable dictionary) of a pymatgen Structure."""
+    if(precision not in COORDINATE_DTYPES):
+        raise ValueError(f"precision has to be one of {', '.join(COORDINATE_DTYPES)}, not {precision}.")
+    distinctSpecies = {} #((species, occupancy), ...) -> index, in order of first appearance
+    siteSpecies = [distinctSpecies.setdefault(tuple((str(species), occupancy) for species, occupancy in site.species.items()), len(distinctSpecies))
+                   for site in structure]
+    encoded = {"@encoding": STRUCTURE_ENCODING,
+               "lattice": structure.lattice.matrix.tolist(),
+               "species": [[list(pair) for pair in species] for species in distinctSpecies],
+               "site_species": siteSpecies,
+               "frac_coords": _packArray(structure.frac_coords, COORDINATE_DTYPES[precision]),
+               "precision": precision}
+    if(not all(structure.lattice.pbc)):
+        encoded["pbc"] = list(structure.lattice.pbc)
+    if(len(structure.site_properties) != 0):
+        encoded["site_properties"] = structure.site_properties
+    labels = [site.label for site in structure]
+    if(any(label != site.species_string for label, site in zip(labels, structure))):
+        encoded["labels"] = labels
+    if(getattr(structure, "_charge", None) is not None):
+        encoded["charge"] = structure._charge
+    if(len(structure.properties) != 0):
+        encoded["properties"] = structure.properties
+    return encoded
+
+def decode_structure(encoded):
+    """The pymatgen Structure of a compact encoding - or of a Structure.as_dict(), as stored by earlier versions."""
+    if(not is_encoded(encoded)):
+        return Structure.from_dict(encoded)
+    species = [Composition(dict(pairs)) for pairs in encoded["species"]] #each distinct species is parsed once, and shared by its sites
+    numOfSites = len(encoded["site_species"])
+    lattice = Lattice(encoded["lattice"], pbc=tuple(encoded.get("pbc", (True, True, True))))
+    fracCoords = _unpackArray(encoded["frac_coords"], COORDINATE_DTYPES[encoded["precision"]], (numOfSites, 3))
+    optional = {name: encoded[name] for name in ("site_properties", "labels", "charge", "properties") if name in encoded}
+    return Structure(lattice, [species[i] for i in encoded["site_species"]], fracCoords, **optional)
+
+
+if __name__ == "__main__":
+    import json
+    import unittest
+    from pymatgen.core.periodic_table import Species
+
+    def structures():
+        yield "rock salt", Structure.from_spacegroup("Fm-3m", Lattice.cubic(5.64), ["Na", "Cl"], [[0, 0, 0], [0.5, 0.5, 0.5]])
+        yield "triclinic", Structure(Lattice.from_parameters(3.1, 4.2, 5.3, 70, 100, 115), ["Ti", "O", "O"], [[0, 0, 0], [0.3, 0.5, 0.1], [0.7, 0.2, 1.6]])
+        yield "oxidation states and disorder", Structure(Lattice.cubic(4.0), [{Species("Fe", 2): 0.5, Species("Ni", 2): 0.5}, Species("O", -2)],
+                                                         [[0, 0, 0], [0.5, 0.5, 0.5]])
+        yield "site properties, labels and charge", Structure(Lattice.hexagonal(3.16, 18.0), ["Mo", "S", "S"], [[1/3, 2/3, 0.25], [2/3, 1/3, 0.16], [2/3, 1/3, 0.34]],
+                                                              site_properties={"magmom": [0.5, 0.0, 0.0]}, labels=["Mo1", "S1", "S2"], charge=1,
+                                                              properties={"source": "test"})
+        yield "slab", Structure(Lattice(np.diag([3.0, 3.0, 20.0]), pbc=(True, True, False)), ["C", "C"], [[0, 0, 0.5], [1/3, 2/3, 0.5]])
+
+    class StructureEncodingTest(unittest.TestCase):
+        def test_lossless_round_trip(self):
+            for name, structure in structures():
+                with self.subTest(name):
+                    encoded = json.loads(json.dumps(encode_structure(structure))) #as it is written to and read back from a stage file
+                    decoded = decode_structure(encoded)
+                    self.assertEqual(decoded.as_dict(), Structure.from_dict(structure.as_dict()).as_dict())
+                    self.assertEqual(decoded, structure)
+
+        def test_float32(self):
+            for name, structure in structures():
+                with self.subTest(name):
+                    decoded = decode_structure(json.loads(json.dumps(encode_structure(structure, "float32"))))
+                    np.testing.assert_allclose(decoded.frac_coords, structure.frac_coords, atol=1e-6)
+                    self.assertEqual(decoded.lattice, structure.lattice)
+
+        def test_old_format_and_size(self):
+            structure = Structure.from_spacegroup("Fm-3m", Lattice.cubic(5.64), ["Na", "Cl"], [[0, 0, 0], [0.5, 0.5, 0.5]])
+            structure.make_supercell([2, 2, 2])
+            self.assertEqual(decode_structure(structure.as_dict()), structure)
+            self.assertLess(5*len(json.dumps(encode_structure(structure), indent=4)), len(json.dumps(structure.as_dict(), indent=4)))
+
+    unittest.main()
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import Dimensionality
+
+#An index of structurally equivalent materials, so that expensive per-structure analyses (DimensionalityFilter, GetCondensedStructures)
+#are run once per class of equivalent structures rather than once per material.
+#
+#GNoME and MP contain many entries with the same structure (or the same prototype relaxed to near-identical cells). Each material is given
+#a fingerprint made of
+#   - its reduced formula and space group number,
+#   - its volume per atom, rounded to VOLUME_DECIMALS,
+#   - the set of (species, nearest-neighbour distance rounded to DISTANCE_DECIMALS) over its sites,
+#none of which depend on the choice of cell, origin or site order. Materials with the same fingerprint are put in the same class; with
+#confirm=True (deduplicate="matcher" in MaterialSearch) pymatgen's StructureMatcher must also match a material to the class's first
+#structure, otherwise it starts a new class. Rounding can only split a class in two, never merge different structures, so the cost of
+#a fingerprint landing on the wrong side of a rounding boundary is one extra analysis.
+#
+#The class of every material is saved in homeDir/StructureIndex/{database}.jsonl (one JSON record per line) as it is worked out, so each
+#material is fingerprinted once per dataset, whichever search it turns up in.
+
+STRUCTURE_INDEX_DIR_NAME = "StructureIndex"
+DEDUPLICATION_MODES = ("fingerprint", "matcher") #deduplicate options of MaterialSearch
+DISTANCE_DECIMALS = 2 #Angstrom
+VOLUME_DECIMALS = 1 #Angstrom^3 per atom
+
+
+def structure_fingerprint(structure, spacegroupNumber=None):
+    """Fingerprint of a pymatgen Structure (see above). spacegroupNumber is worked out with spglib if it isn't given."""
+    if(spacegroupNumber is None):
+        spacegroupNumber = structure.get_space_group_info()[1]
+    nearest = Dimensionality.nearest_neighbor_distances(np.mod(structure.frac_coords, 1.0), structure.lattice.matrix)
+    environments = sorted(set(zip([site.species_string for site in structure], np.round(nearest, DISTANCE_DECIMALS).tolist())))
+    parts = [structure.composition.reduced_formula, int(spacegroupNumber), round(structure.volume/len(structure), VOLUME_DECIMALS), environments]
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+def material_id(result):
+    return result["MaterialId"] if "MaterialId" in result else result["material_id"] #GNoME and MP names
+
+def representatives(classIds):
+    """Positions of the first material of each class, in order."""
+    seen = set()
+    return [i for i, classId in enumerate(classIds) if not (classId in seen or seen.add(classId))]
+
+
+class StructureIndex():
+    """
+    Usage (see Analysis.DimensionalityFilter):
+        index = StructureIndex(homeDir, "gnome")
+        classIds, structures = index.classify(results, getStructure)   #getStructure(result) is only called for materials not in the index yet
+        ...analyse results[i] for i in representatives(classIds)...
+        index.save()
+    """
+    def __init__(self, homeDir, database, confirm=False):
+        self.path = os.path.join(homeDir, STRUCTURE_INDEX_DIR_NAME, f"{database}-matcher.jsonl" if confirm else f"{database}.jsonl")
+        self.confirm = confirm
+        self._classOf = {} #MaterialId -> class id ("{fingerprint}:{n}")
+        self._classesWith = {} #fingerprint -> class ids with that fingerprint
+        self._representatives = {} #class id -> structure, for classes started in this run (used by confirm)
+        self._memos = {}
+        self._new = [] #records added since the index was last saved
+        self._matcher = None
+        if(os.path.isfile(self.path)):
+            with open(self.path, "r") as f:
+                for line in f:
+                    if(line.strip() != ""):
+                        record = json.loads(line)
+                        self._classOf[record["id"]] = record["class"]
+                        classes = self._classesWith.setdefault(record["fingerprint"], [])
+                        if(record["class"] not in classes):
+                            classes.append(record["class"])
+
+    def __len__(self):
+        return len(self._classOf)
+
+    def class_of(self, result):
+        return self._classOf[material_id(result)]
+
+    def _assign(self, materialId, fingerprint, structure):
+        classes = self._classesWith.setdefault(fingerprint, [])
+        classId = None
+        if(not self.confirm):
+            classId = classes[0] if len(classes) != 0 else None
+        else:
+            if(self._matcher is None):
+                from pymatgen.analysis.structure_matcher import StructureMatcher #only needed with confirm, so imported when first needed
+                self._matcher = StructureMatcher()
+            for candidate in classes: #classes whose first structure was loaded in an earlier run can't be compared, so aren't joined
+                representative = self._representatives.get(candidate)
+                if(representative is not None and self._matcher.fit(representative, structure)):
+                    classId = candidate
+                    break
+        if(classId is None):
+            classId = f"{fingerprint}:{len(classes)}"
+            classes.append(classId)
+            if(self.confirm):
+                self._representatives[classId] = structure
+        self._classOf[materialId] = classId
+        self._new.append({"id": materialId, "fingerprint": fingerprint, "class": classId})
+        return classId
+
+    def classify(self, results, getStructure):
+        """
+        The class id of each result, adding the materials that aren't in the index yet.
+        Returns (class ids, {position: structure} for the structures that had to be loaded to fingerprint them).
+        """
+        classIds, structures = [], {}
+        for i, result in enumerate(results):
+            materialId = material_id(result)
+            if(materialId not in self._classOf):
+                structures[i] = getStructure(result)
+                self._assign(materialId, structure_fingerprint(structures[i], result.get("spacegroup.number")), structures[i])
+            classIds.append(self._classOf[materialId])
+        return classIds, structures
+
+    def memo(self, key):
+        """A dictionary of class id -> result of an analysis (named by key), kept for the rest of the run, e.g. across the chunks of a stage."""
+        return self._memos.setdefault(key, {})
+
+    def propagate(self, results, classIds, analysedResults):
+        """
+        Each of results, updated with the new keys of the analysed result for the first material of its class. Materials whose class has no
+        analysed result (e.g. the analysis failed for it) are left out.
+        """
+        analysedByClass = {self.class_of(result): result for result in analysedResults}
+        return [{**analysedByClass[classId], **result} for result, classId in zip(results, classIds) if classId in analysedByClass]
+
+    def save(self):
+        """Appends the materials added since the last save to the index file."""
+        if(len(self._new) == 0):
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.writelines(json.dumps(record) + "\n" for record in self._new)
+        self._new = []
+
+
+if __name__ == "__main__":
+    import tempfile
+    import unittest
+    from pymatgen.core import Lattice, Structure
+
+    def rockSalt(a, species=("Na", "Cl")):
+        return Structure.from_spacegroup("Fm-3m", Lattice.cubic(a), list(species), [[0, 0, 0], [0.5, 0.5, 0.5]])
+
+    class StructureIndexTest(unittest.TestCase):
+        def test_fingerprint_ignores_cell_and_site_order(self):
+            structure = rockSalt(5.64)
+            supercell = structure.copy()
+            supercell.make_supercell([2, 1, 1])
+            shuffled = Structure.from_sites(list(reversed(structure.sites)))
+            shuffled.translate_sites(list(range(len(shuffled))), [0.1, 0.2, 0.3])
+            fingerprint = structure_fingerprint(structure)
+            self.assertEqual(structure_fingerprint(supercell), fingerprint)
+            self.assertEqual(structure_fingerprint(shuffled), fingerprint)
+            self.assertEqual(structure_fingerprint(structure.get_primitive_structure()), fingerprint)
+            self.assertNotEqual(structure_fingerprint(rockSalt(5.9)), fingerprint)
+            self.assertNotEqual(structure_fingerprint(rockSalt(5.64, ("K", "Cl"))), fingerprint)
+
+        def test_classes_are_saved_and_reused(self):
+            structures = {"a": rockSalt(5.64), "b": rockSalt(5.64).get_primitive_structure(), "c": rockSalt(5.9), "d": rockSalt(5.64)}
+            results = [{"MaterialId": materialId} for materialId in structures]
+            loaded = []
+            def getStructure(result):
+                loaded.append(result["MaterialId"])
+                return structures[result["MaterialId"]]
+            for confirm in (False, True):
+                with tempfile.TemporaryDirectory() as homeDir:
+                    index = StructureIndex(homeDir, "test", confirm)
+                    classIds, _ = index.classify(results, getStructure)
+                    self.assertEqual(classIds[0], classIds[1])
+                    self.assertEqual(classIds[0], classIds[3])
+                    self.assertNotEqual(classIds[0], classIds[2])
+                    self.assertEqual(representatives(classIds), [0, 2])
+                    index.save()
+                    loaded.clear()
+                    reloaded = StructureIndex(homeDir, "test", confirm)
+                    self.assertEqual(reloaded.classify(results, getStructure)[0], classIds)
+                    self.assertEqual(loaded, [])
+                    analysed = [dict(results[0], dim=3)]
+                    self.assertEqual(reloaded.propagate(results, classIds, analysed), [{"MaterialId": "a", "dim": 3}, {"MaterialId": "b", "dim": 3},
+                                                                                      {"MaterialId": "d", "dim": 3}])
+
+    unittest.main()
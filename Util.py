@@ -4,7 +4,7 @@ import sys, os
 import pandas as pd
 from pymatgen.core.periodic_table import Element
 import numpy as np
-from pymatgen.ext.matproj import MPRester
+from StageIO import StageFile, ReadStage, IterStageChunks
 
 #Functions used by MaterialSearchCore.py to prep GNOME data.
 ########################################
@@ -22,6 +22,7 @@ def TurnElementsIntoList(elements):
 #########################################
 
 def APIkeyChecker():
+    from pymatgen.ext.matproj import MPRester #only needed for MP searches, so imported when first needed
     APIkey = None #done so that APIkey is not lost in the scope of the with block
     if(not os.path.isfile("APIkey.txt")): #if APIkey.txt doesn't exist, ask for key and create txt file
         print("\nIt seems you do not have an API key saved.")
@@ -44,28 +45,24 @@ def APIkeyChecker():
             APIkey= f.read()
             return APIkey
 
-def ConvertJSONresultsToExcel(JSONfileName): #do not need to give the .json extension - that's assumed
-    results = ReadJSONFile(JSONfileName)
-    df = pd.DataFrame.from_dict(results)
-    if("structure" in df.columns.to_list()):
-        df = df.drop("structure", axis=1)
-    if("condensed_struct" in df.columns.to_list()):
-        df = df.drop("condensed_struct", axis=1)
+def _reportDataFrame(JSONfileName, chunkSize=None):
+    #structures are left out of the reports; with chunkSize the stage is read a chunk at a time, so they are never all in memory
+    if(chunkSize is None):
+        chunks = [ReadStage(JSONfileName)]
+    else:
+        chunks = IterStageChunks(JSONfileName, chunkSize)
+    frames = [pd.DataFrame.from_dict(chunk).drop(columns=["structure", "condensed_struct"], errors="ignore") for chunk in chunks]
+    return pd.concat(frames, ignore_index=True) if len(frames) != 0 else pd.DataFrame()
+
+def ConvertJSONresultsToExcel(JSONfileName, chunkSize=None): #do not need to give the .json extension - that's assumed
+    df = _reportDataFrame(JSONfileName, chunkSize)
     df.to_excel(f"{JSONfileName}.xlsx")
 
 def make_mpid_clickable(mpid, name):
     return f'<a href="https://next-gen.materialsproject.org/materials/{mpid}" rel="noopener noreferrer" target="_blank">{name}</a>'
 
-def ConvertJSONresultsToHTML(JSONfileName): #do not need to give the .json extension - that's assumed
-    results = ReadJSONFile(JSONfileName)
-    df = pd.DataFrame.from_dict(results)
-    if("structure" in df.columns.to_list()):
-        df = df.drop("structure", axis=1)
-    
-    ########New code
-    if("condensed_struct" in df.columns.to_list()):
-        df = df.drop("condensed_struct", axis=1)
-    ########
+def ConvertJSONresultsToHTML(JSONfileName, chunkSize=None): #do not need to give the .json extension - that's assumed
+    df = _reportDataFrame(JSONfileName, chunkSize)
     #df=df.sort_values("e_above_hull")
     df['material_id'] = df.apply(lambda x: make_mpid_clickable(x['material_id'], x['material_id']), axis=1)
     html_df = df.to_html(render_links=True,escape=False)
@@ -87,9 +84,22 @@ def SaveDictAsJSON(fileName, dictionary, indent=4):
         f.write(dumps(dictionary, indent=indent)) #don't need to read this since it's just a 'checkpoint'
 
 def ReadJSONFile(fileName):
+    if(not os.path.isfile(fileName+".json") and StageFile(fileName) is not None): #a stage saved in one of the JSON-lines formats (see StageIO.py)
+        return ReadStage(fileName)
     with open(fileName+".json", "r") as f:
         return loads(f.read()) #loads() returns the string from f.read() as dict
 
+#Filter markers for out-of-core mode (see Analysis.StreamFilter).
+########################################
+def rowwise(func):
+    """Marks a filter as deciding on each row independently of the others, so it can be applied to a stage one chunk at a time."""
+    func.rowwise = True
+    return func
+
+def is_rowwise(func):
+    return getattr(func, "rowwise", False)
+#########################################
+
 def ListOfTheElements(elementsExcluded=None):
     noOfElements = 118 #as of 2021
     atomicNos = np.arange(1, noOfElements+1) #the function stops just before the given value (default step = 1)